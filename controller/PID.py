@@ -1,31 +1,97 @@
-import time
+import json
+import os
+from typing import TypedDict
+import clock
+
+# Tuned gains are written here by tuner.py and picked up by the lectern on start
+GAINS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gains.json')
+
+
+class Gains(TypedDict):
+    kp: float
+    ki: float
+    kd: float
+
+
+DEFAULT_GAINS = Gains(kp=0.65, ki=0.02, kd=0.1)
+
+
+def load_gains(path: str = GAINS_FILE) -> Gains:
+    '''
+    Load a gains profile, falling back to the default gains if there is none.
+
+    :param path: JSON file written by tuner.py
+    :return: The gains
+    '''
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        return Gains(DEFAULT_GAINS)
+    gains = Gains(kp=float(profile['kp']), ki=float(profile['ki']), kd=float(profile['kd']))
+    print(f"Loaded PID gains from {path}: {gains}")
+    return gains
+
+
+def save_gains(gains: Gains, path: str = GAINS_FILE, **info):
+    '''
+    Write a gains profile. Anything in info (score, plant, ...) is stored next to the gains for reference.
+    '''
+    with open(path, 'w') as f:
+        json.dump({**gains, **info}, f, indent=4)
+
 
 class PID:
-    def __init__(self, kp, ki, kd):
+    def __init__(self, kp, ki, kd, output_limit=1.0):
         self.kp = kp
         self.ki = ki
         self.kd = kd
+        self.output_limit = output_limit # The output saturates here (full motor speed)
         self.prev_error = 0
         self.integral = 0
         self.last_time = None
         self.enabled = True
+        self.terms = (0.0, 0.0, 0.0) # Proportional, integral and derivative parts of the last output
 
     def compute(self, target, actual, current_speed):
-        # if not self.enabled:
-        #     return current_speed
-        now = time.time()
+        if not self.enabled:
+            # No correction, and nothing accumulated while disabled is carried over
+            self.prev_error = 0
+            self.integral = 0
+            self.last_time = None
+            self.terms = (0.0, 0.0, 0.0)
+            return 0.0
+        now = clock.now()
         dt = (now - self.last_time) if self.last_time else 0.01
         self.last_time = now
 
         error = target - actual
-        self.integral += error * dt
         derivative = (error - self.prev_error) / dt if dt > 0 else 0
         self.prev_error = error
 
-        return self.kp * error + self.ki * self.integral + self.kd * derivative
-    
+        # Anti-windup: stop integrating while the motor or this output is saturated in the direction of the error,
+        # and never let the integral term alone exceed the output range
+        integral = self.integral + error * dt
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        motor_saturated = abs(current_speed) >= self.output_limit and (current_speed > 0) == (error > 0)
+        output_saturated = abs(output) > self.output_limit and (output > 0) == (error > 0)
+        if not motor_saturated and not output_saturated:
+            self.integral = integral
+        if self.ki:
+            bound = self.output_limit / abs(self.ki)
+            self.integral = max(min(self.integral, bound), -bound)
+
+        self.terms = (self.kp * error, self.ki * self.integral, self.kd * derivative)
+        return self.terms[0] + self.terms[1] + self.terms[2]
+
+    def set_gains(self, gains: Gains):
+        self.kp = gains['kp']
+        self.ki = gains['ki']
+        self.kd = gains['kd']
+
     def reset(self):
         self.prev_error = 0
         self.integral = 0
         self.last_time = None
+        self.terms = (0.0, 0.0, 0.0)
         print("PID controller reset")
@@ -1,4 +1,8 @@
-from typing import TypedDict, Any
+import asyncio
+import threading
+from collections import deque
+from typing import TypedDict, Any, Callable
+import clock
 
 class Command(TypedDict):
     command: str
@@ -11,23 +15,29 @@ class Command(TypedDict):
         }
 
 class System_Command:
-    def __init__(self, command: str):
+    '''
+    A command parsed against its route (see router.Router.parse). args holds the converted arguments.
+    '''
+    __slots__ = ('command', 'who', 'verb', 'args', 'route', 'queued_at', 'source')
+
+    def __init__(self, command: str, who: str, verb: str, args: tuple, route):
         self.command = command
-        self.args = command.split('/')[1:] # Split by '/' and ignore the first part
-        self.who = "all"  # Default to "all" if not specified
-        if self.args[0] == 'lectern':
-            self.who = "lectern"
-            self.args = self.args[1:]
-        elif self.args[0] == 'teleprompter':
-            self.who = "teleprompter"
-            self.args = self.args[1:]
+        self.who = who # lectern, teleprompter or all
+        self.verb = verb
+        self.args = args
+        self.route = route
+        self.queued_at = 0.0 # Set when the command is put on a SystemQueue
+        self.source: tuple[str, int] = None # Address of the sender, set at ingress
 
     def to_dict(self):
         return {
             "command": self.command,
-            "args": self.args
+            "args": list(self.args)
         }
 
+    def __repr__(self):
+        return f'System_Command({self.command!r})'
+
 class Queue:
     def __init__(self):
         self.queue: list[Command] = []
@@ -69,20 +79,120 @@ class Queue:
         # Restore the state from the serialized data
         self.from_dict(state)
 
+class QueueStats(TypedDict):
+    depth: int
+    max_depth: int
+    commands: int # Taken off the queue so far
+    coalesced: int # Replaced by a newer command before they ran
+    wait: float # s a command spent queued, smoothed
+    max_wait: float
+
+
+# Exponential smoothing factor used for the wait time average
+WAIT_SMOOTHING = 0.1
+
+
 class SystemQueue:
-    def __init__(self):
-        self.queue: list[System_Command] = []
+    '''
+    FIFO of System_Commands with one asyncio consumer. put() can be called from any thread: off the event loop thread
+    the append is handed to the loop with call_soon_threadsafe, so the deque and the waiting consumer are only ever
+    touched on the loop thread. get() sleeps until a command arrives instead of polling.
+
+    Setpoint commands (routes with coalesce set: move, go_to) are coalesced per target and verb: while one is still
+    queued, a newer one takes its place in line instead of queueing behind it. Any other command for the same target is a barrier, so
+    setpoints never jump over discrete commands (calibrate, bump, stop) and those keep their order.
+
+    Safety commands (routes with priority set: stop, e_stop, lock) skip the queue altogether when there is a priority
+    handler.
+    '''
+    def __init__(self, priority: Callable[[System_Command], None] = None):
+        self.queue: deque[System_Command] = deque()
+        self.priority = priority
+        self.loop: asyncio.AbstractEventLoop = None
+        self.loop_thread: int = None
+        self.waiter: asyncio.Future = None
+        self.pending: dict[tuple[str, str], System_Command] = {} # Queued setpoint commands that can still be replaced
+        try:
+            self.bind(asyncio.get_running_loop())
+        except RuntimeError:
+            pass # Bound by the first get()
+
+        self.max_depth = 0
+        self.commands = 0
+        self.coalesced = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
 
     def put(self, item: System_Command):
+        item.queued_at = clock.now()
+        if self.loop is None or threading.get_ident() == self.loop_thread:
+            self.append(item)
+        else:
+            self.loop.call_soon_threadsafe(self.append, item)
+
+    def append(self, item: System_Command):
+        route = item.route
+        if route.priority and self.priority is not None:
+            self.priority(item)
+            return
+        key = (item.who, item.verb)
+        if route.coalesce:
+            pending = self.pending.get(key)
+            if pending is not None:
+                # Latest value wins, keeping the place (and wait time) of the one already in line
+                pending.command = item.command
+                pending.args = item.args
+                pending.route = item.route
+                pending.source = item.source
+                self.coalesced += 1
+                return
+        if item.who == "all":
+            self.pending.clear()
+        else:
+            for other in [k for k in self.pending if k[0] == item.who]:
+                del self.pending[other]
+        if route.coalesce:
+            self.pending[key] = item
         self.queue.append(item)
-
-    def get(self):
-        if len(self.queue) == 0:
+        self.max_depth = max(self.max_depth, len(self.queue))
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def get(self) -> System_Command:
+        if self.loop is None:
+            self.bind(asyncio.get_running_loop())
+        while not self.queue:
+            self.waiter = self.loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.take()
+
+    def get_nowait(self):
+        if not self.queue:
             return None
-        return self.queue.pop(0)
-    
+        return self.take()
+
+    def take(self) -> System_Command:
+        item = self.queue.popleft()
+        key = (item.who, item.verb)
+        if self.pending.get(key) is item:
+            del self.pending[key]
+        wait = clock.now() - item.queued_at
+        self.commands += 1
+        self.wait += (wait - self.wait) * WAIT_SMOOTHING
+        self.max_wait = max(self.max_wait, wait)
+        return item
+
     def clear(self):
-        self.queue = []
+        self.queue.clear()
+        self.pending.clear()
     
     def qsize(self):
         return len(self.queue)
@@ -91,28 +201,33 @@ class SystemQueue:
         return len(self.queue)
     
     def __str__(self):
-        return str(self.queue)
+        return str(list(self.queue))
 
     def to_dict(self):
         # Convert the queue to a serializable format (a list)
-        return {'queue': self.queue}
-
-    def from_dict(self, data):
-        # Initialize the queue from a dictionary format
-        self.queue = data.get('queue', [])
-    
-    # Optional: Customize the serialization behavior
-    def __getstate__(self):
-        # Return the state that should be serialized
-        return self.to_dict()
-
-    def __setstate__(self, state):
-        # Restore the state from the serialized data
-        self.from_dict(state)
+        return {'queue': [cmd.to_dict() for cmd in self.queue]}
+
+    def stats(self) -> QueueStats:
+        return QueueStats(
+            depth=len(self.queue),
+            max_depth=self.max_depth,
+            commands=self.commands,
+            coalesced=self.coalesced,
+            wait=self.wait,
+            max_wait=self.max_wait,
+        )
 
     def clear_lectern(self):
         # Clear all commands related to the lectern
-        self.queue = [cmd for cmd in self.queue if cmd.who != "lectern"]
+        self.queue = deque(cmd for cmd in self.queue if cmd.who != "lectern")
+        self.pending = {key: cmd for key, cmd in self.pending.items() if cmd.who != "lectern"}
+
+    def clear_motion(self):
+        # Clear the commands that would drive the lectern (routes with motion set), anything else still runs
+        self.queue = deque(cmd for cmd in self.queue if not cmd.route.motion)
+        self.pending = {key: cmd for key, cmd in self.pending.items() if not cmd.route.motion}
+
     def clear_teleprompter(self):
         # Clear all commands related to the teleprompter
-        self.queue = [cmd for cmd in self.queue if cmd.who != "teleprompter"]
\ No newline at end of file
+        self.queue = deque(cmd for cmd in self.queue if cmd.who != "teleprompter")
+        self.pending = {key: cmd for key, cmd in self.pending.items() if cmd.who != "teleprompter"}
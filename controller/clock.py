@@ -0,0 +1,101 @@
+'''
+fileoverview: Time source for the controller. Everything that measures time (scheduler, PID, calibration, simulator)
+calls clock.now() instead of time.time()/time.monotonic(), and everything that waits uses asyncio.sleep.
+
+Normally now() is time.monotonic(). When a VirtualClock is installed, run() drives the program on a
+VirtualTimeEventLoop: whenever the loop would block waiting for a timer, virtual time jumps straight to that timer
+instead of sleeping. Paired with the simulated backend, a calibrate-then-move scenario runs as fast as the CPU allows,
+or at a fixed multiple of real time when a rate is given.
+'''
+
+import asyncio
+import selectors
+import time
+
+class VirtualClock:
+    def __init__(self, start: float = 0.0, rate: float = None):
+        self.time = start
+        self.rate = rate # Multiple of real time to run at, None to run as fast as possible
+
+    def now(self) -> float:
+        return self.time
+
+    def advance(self, seconds: float):
+        if seconds > 0:
+            self.time += seconds
+
+
+_clock: VirtualClock = None
+
+def install(clock: VirtualClock):
+    global _clock
+    _clock = clock
+
+def uninstall():
+    global _clock
+    _clock = None
+
+def is_virtual() -> bool:
+    return _clock is not None
+
+def now() -> float:
+    if _clock is not None:
+        return _clock.now()
+    return time.monotonic()
+
+
+class _VirtualSelector:
+    '''
+    Wraps the loop's selector. I/O is still polled for real, but time spent waiting for timers is virtual.
+    '''
+    def __init__(self, selector: selectors.BaseSelector, clock: VirtualClock):
+        self.selector = selector
+        self.clock = clock
+
+    def select(self, timeout: float = None):
+        if timeout is None:
+            # Nothing scheduled, only I/O can wake us up
+            return self.selector.select(None)
+        real_timeout = 0 if self.clock.rate is None else timeout / self.clock.rate
+        events = self.selector.select(real_timeout)
+        if not events:
+            self.clock.advance(timeout)
+        return events
+
+    def __getattr__(self, name: str):
+        return getattr(self.selector, name)
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        super().__init__(_VirtualSelector(selectors.DefaultSelector(), clock))
+
+    def time(self) -> float:
+        return self.clock.now()
+
+
+def run(main, virtual: bool = False, rate: float = None):
+    '''
+    Run a coroutine like asyncio.run. With virtual=True it runs on virtual time.
+
+    :param main: The coroutine to run.
+    :param virtual: Run on a VirtualClock instead of wall-clock time.
+    :param rate: Multiple of real time to run at when virtual, None to run as fast as possible.
+    :return: The result of the coroutine.
+    '''
+    if not virtual:
+        return asyncio.run(main)
+    clock = VirtualClock(rate=rate)
+    install(clock)
+    loop = VirtualTimeEventLoop(clock)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(main)
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            uninstall()
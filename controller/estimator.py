@@ -0,0 +1,120 @@
+'''
+fileoverview: Position/velocity estimator for the lectern. A two state Kalman filter that uses the commanded motor
+speed as its process model (the actuator approaches speed * Calibration.velocity with a first order lag) and raw TOF
+samples as measurements. It predicts every tick, so position and velocity are available between sensor samples
+without the lag of a moving average.
+'''
+
+import math
+from typing import TypedDict
+
+TIME_CONSTANT = 0.08 # s, actuator response to a speed change
+PROCESS_NOISE = 4.0 # (in/s^2)^2, how much the real velocity wanders from the model
+MEASUREMENT_NOISE = 0.15 ** 2 # in^2, variance of a raw TOF sample
+MEASUREMENT_LATENCY = 0.02 # s, how old the position a TOF sample reports is
+GATE = 25 # Squared innovation in standard deviations above which a sample is rejected as an outlier
+MAX_REJECTED = 5 # Consecutive rejected samples after which the filter gives up and resets to the measurement
+
+
+class Estimate(TypedDict):
+    position: float
+    velocity: float
+    position_std: float
+    velocity_std: float
+
+
+class KalmanEstimator:
+    def __init__(
+        self,
+        time_constant: float = TIME_CONSTANT,
+        process_noise: float = PROCESS_NOISE,
+        measurement_noise: float = MEASUREMENT_NOISE,
+        latency: float = MEASUREMENT_LATENCY
+    ):
+        self.time_constant = time_constant
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.latency = latency
+        self.reset(0)
+        self.initialized = False
+
+    def reset(self, position: float, velocity: float = 0):
+        self.position = position
+        self.velocity = velocity
+        # Covariance [[p00, p01], [p01, p11]]
+        self.p00 = self.measurement_noise
+        self.p01 = 0.0
+        self.p11 = 1.0
+        self.rejected = 0
+        self.initialized = True
+
+    def predict(self, dt: float, commanded_velocity: float):
+        if dt <= 0:
+            return
+        tau = self.time_constant
+        a = math.exp(-dt / tau)
+        b = tau * (1 - a)
+        # x = F x + B u, with F = [[1, b], [0, a]] and B = [dt - b, 1 - a]
+        self.position += b * self.velocity + (dt - b) * commanded_velocity
+        self.velocity = a * self.velocity + (1 - a) * commanded_velocity
+
+        # P = F P F' + Q, with Q from white acceleration noise
+        p00, p01, p11 = self.p00, self.p01, self.p11
+        q = self.process_noise
+        self.p00 = p00 + 2 * b * p01 + b * b * p11 + q * dt ** 3 / 3
+        self.p01 = a * (p01 + b * p11) + q * dt ** 2 / 2
+        self.p11 = a * a * p11 + q * dt
+
+    def update(self, measurement: float) -> bool:
+        '''
+        Fold in a TOF sample (in). The sample is compared against where the lectern was `latency` seconds ago.
+
+        :return: False if the sample was rejected as an outlier.
+        '''
+        # H = [1, -latency]
+        h1 = -self.latency
+        p00, p01, p11 = self.p00, self.p01, self.p11
+        innovation = measurement - (self.position + h1 * self.velocity)
+        ph0 = p00 + h1 * p01
+        ph1 = p01 + h1 * p11
+        s = ph0 + h1 * ph1 + self.measurement_noise
+        if innovation * innovation > GATE * s:
+            self.rejected += 1
+            if self.rejected >= MAX_REJECTED:
+                self.reset(measurement)
+            return False
+        self.rejected = 0
+        k0 = ph0 / s
+        k1 = ph1 / s
+        self.position += k0 * innovation
+        self.velocity += k1 * innovation
+        self.p00 = p00 - k0 * ph0
+        self.p01 = p01 - k0 * ph1
+        self.p11 = p11 - k1 * ph1
+        return True
+
+    def step(self, dt: float, commanded_velocity: float, measurement: float = None) -> Estimate:
+        '''
+        Advance the filter by one tick.
+
+        :param dt: Time since the last step (s).
+        :param commanded_velocity: Velocity the motor is being driven at (in/s).
+        :param measurement: A new TOF sample (in), or None if there is no new sample this tick.
+        :return: The current estimate.
+        '''
+        if not self.initialized:
+            if measurement is not None:
+                self.reset(measurement)
+            return self.to_dict()
+        self.predict(dt, commanded_velocity)
+        if measurement is not None:
+            self.update(measurement)
+        return self.to_dict()
+
+    def to_dict(self) -> Estimate:
+        return Estimate(
+            position=self.position,
+            velocity=self.velocity,
+            position_std=math.sqrt(max(self.p00, 0)),
+            velocity_std=math.sqrt(max(self.p11, 0)),
+        )
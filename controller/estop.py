@@ -0,0 +1,146 @@
+'''
+fileoverview: Out of band emergency stop. The normal stop path (socket, command queue, System, Lectern, next event
+loop tick) only works while the asyncio loop is healthy, and the loop can be held up by I2C reads or a blocking
+subprocess. The e-stop listener has its own thread and UDP socket, plus an optional GPIO input on the backend's
+callback thread. Either one cuts the motor output directly, latches a fault on the motor so nothing can drive it
+until the fault is cleared, and only then notifies the asyncio side.
+
+Trip it by sending one of E_STOP_MESSAGES (plain text or as an OSC address) to E_STOP_PORT:
+    echo -n e_stop | nc -u -w0 <lectern ip> 11112
+'''
+
+import asyncio
+import socket
+import threading
+import time
+from typing import Callable, TypedDict
+import hardware
+from motor import Motor
+
+E_STOP_PORT = 11112
+E_STOP_MESSAGES = (b'e_stop', b'estop', b'/e_stop', b'/lectern/e_stop')
+E_STOP_GLITCH_US = 1000 # An e-stop input has to hold its level this long to trip
+RECV_TIMEOUT = 0.5 # s, how often the listener checks whether it should stop
+
+
+class EStopStats(TypedDict):
+    fault: bool
+    source: str # What tripped the latched fault, None if not faulted
+    trips: int
+    latency: float # s from the trigger reaching the listener to the motor output being cut, last trip
+    max_latency: float
+
+
+class EStop:
+    def __init__(self, motor: Motor, host: str = '0.0.0.0', port: int = E_STOP_PORT, pin: int = None, trip_level: int = 1, on_trip: Callable[[str], None] = None):
+        '''
+        :param pin: Optional GPIO of a hardware e-stop input
+        :param trip_level: Level of pin that trips, 1 for a normally closed button to ground with a pull up
+        :param on_trip: Called on the event loop with the source after the motor has been cut
+        '''
+        self.motor = motor
+        self.host = host
+        self.port = port
+        self.pin = pin
+        self.trip_level = trip_level
+        self.on_trip = on_trip
+        self.loop: asyncio.AbstractEventLoop = None
+        self.lock = threading.Lock()
+        self.running = False
+        self.socket: socket.socket = None
+        self.thread: threading.Thread = None
+        self.callback = None
+
+        self.source: str = None
+        self.trips = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.settimeout(RECV_TIMEOUT)
+        self.thread = threading.Thread(target=self.listen, name='e-stop', daemon=True)
+        self.thread.start()
+        print(f"E-stop listening on {self.host}:{self.port}")
+
+        if self.pin is not None:
+            backend = hardware.get_backend()
+            backend.setup_input(self.pin)
+            backend.glitch_filter(self.pin, E_STOP_GLITCH_US)
+            self.callback = backend.callback(self.pin, hardware.EITHER_EDGE, self.on_edge)
+            if backend.read(self.pin) == self.trip_level:
+                self.trip(f'gpio {self.pin}', time.perf_counter())
+
+    def listen(self):
+        while self.running:
+            try:
+                data, address = self.socket.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                break # Socket closed
+            received = time.perf_counter()
+            message = data.split(b'\0', 1)[0].strip()
+            if message in E_STOP_MESSAGES:
+                self.trip(f'udp {address[0]}', received)
+
+    def on_edge(self, pin: int, level: int, tick: int):
+        if level == self.trip_level:
+            self.trip(f'gpio {pin}', time.perf_counter())
+
+    def trip(self, source: str, received: float):
+        # Cut first, everything else can wait
+        self.motor.trip()
+        latency = time.perf_counter() - received
+        with self.lock:
+            self.trips += 1
+            self.latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            if self.source is None:
+                self.source = source
+        print(f"E-stop tripped by {source}, motor cut in {latency * 1000:.2f}ms")
+        if self.on_trip is not None and self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.on_trip, source)
+            except RuntimeError:
+                pass # Event loop already closed, the motor is cut regardless
+
+    @property
+    def fault(self) -> bool:
+        return self.motor.fault
+
+    def clear(self) -> bool:
+        '''
+        Clear a latched fault. Refused while a hardware e-stop input is still in its tripped position.
+
+        :return: True if the fault was cleared
+        '''
+        if self.pin is not None and hardware.get_backend().read(self.pin) == self.trip_level:
+            print("E-stop input is still tripped, not clearing the fault")
+            return False
+        with self.lock:
+            self.source = None
+            self.motor.clear_fault()
+        print("E-stop fault cleared")
+        return True
+
+    def to_dict(self) -> EStopStats:
+        return EStopStats(
+            fault=self.motor.fault,
+            source=self.source,
+            trips=self.trips,
+            latency=self.latency,
+            max_latency=self.max_latency,
+        )
+
+    def stop(self):
+        self.running = False
+        if self.callback is not None:
+            self.callback.cancel()
+            self.callback = None
+        if self.socket is not None:
+            self.socket.close()
@@ -0,0 +1,255 @@
+'''
+fileoverview: Streaming filters for sensor samples. Each filter owns a fixed size, preallocated window and updates
+its statistics incrementally as samples arrive, instead of rebuilding a NumPy array from a list on every read.
+
+Run this file to benchmark the filters against utils.remove_outliers_zscore:
+    python3 filters.py
+'''
+
+import bisect
+import math
+
+# Running sums are recomputed from the window this often to stop floating point drift from building up
+RESYNC_INTERVAL = 1024
+
+
+class RollingWindow:
+    '''
+    Fixed capacity window with an O(1) running mean and variance.
+    '''
+    __slots__ = ('capacity', 'values', 'index', 'count', 'sum', 'sumsq', 'pushes')
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.values = [0.0] * capacity
+        self.index = 0 # Next slot to write
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.pushes = 0
+
+    def push(self, value: float):
+        i = self.index
+        if self.count == self.capacity:
+            old = self.values[i]
+            self.sum -= old
+            self.sumsq -= old * old
+        else:
+            self.count += 1
+        self.values[i] = value
+        self.sum += value
+        self.sumsq += value * value
+        self.index = (i + 1) % self.capacity
+
+        self.pushes += 1
+        if self.pushes % RESYNC_INTERVAL == 0:
+            self.resync()
+
+    def resync(self):
+        window = self.window()
+        self.sum = sum(window)
+        self.sumsq = sum(v * v for v in window)
+
+    def window(self) -> list[float]:
+        if self.count < self.capacity:
+            return self.values[:self.count]
+        return self.values
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def variance(self) -> float:
+        '''
+        Population variance, like np.var.
+        '''
+        if self.count == 0:
+            return 0.0
+        mean = self.sum / self.count
+        return max(self.sumsq / self.count - mean * mean, 0.0)
+
+    def std(self) -> float:
+        return math.sqrt(self.variance())
+
+    def __len__(self):
+        return self.count
+
+
+class MeanFilter:
+    __slots__ = ('window', 'value')
+
+    def __init__(self, capacity: int):
+        self.window = RollingWindow(capacity)
+        self.value = 0.0
+
+    def update(self, sample: float) -> float:
+        self.window.push(sample)
+        self.value = self.window.mean()
+        return self.value
+
+    def clear(self):
+        self.window.clear()
+        self.value = 0.0
+
+    def __len__(self):
+        return self.window.count
+
+
+class MedianFilter:
+    '''
+    Running median. Keeps a sorted copy of the window next to the ring, so each update is a bisect insert and remove.
+    '''
+    __slots__ = ('window', 'sorted', 'value')
+
+    def __init__(self, capacity: int):
+        self.window = RollingWindow(capacity)
+        self.sorted: list[float] = []
+        self.value = 0.0
+
+    def push(self, sample: float):
+        window = self.window
+        if window.count == window.capacity:
+            old = window.values[window.index]
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+        window.push(sample)
+        bisect.insort(self.sorted, sample)
+
+    def update(self, sample: float) -> float:
+        self.push(sample)
+        s = self.sorted
+        n = len(s)
+        mid = n // 2
+        self.value = s[mid] if n % 2 else (s[mid - 1] + s[mid]) / 2
+        return self.value
+
+    def clear(self):
+        self.window.clear()
+        self.sorted.clear()
+        self.value = 0.0
+
+    def __len__(self):
+        return self.window.count
+
+
+class ZScoreFilter(MedianFilter):
+    '''
+    Mean of the window after dropping samples whose z-score is at or above the threshold, the streaming equivalent of
+    np.average(utils.remove_outliers_zscore(window, threshold)).
+
+    In a window of n samples no z-score can exceed sqrt(n - 1), so for small windows (n <= 10 at the default threshold
+    of 3) nothing can ever be rejected and the result is the running mean in O(1). Larger windows also keep the window
+    sorted, like MedianFilter: the outliers are the two tails beyond mean +- threshold * std. Usually the smallest and
+    largest samples are inside those limits and the running mean stands; otherwise the tails are found by bisecting and
+    their sum comes off the running sum. No update scans the window.
+    '''
+    __slots__ = ('threshold', 'threshold_sq', 'rejects')
+
+    def __init__(self, capacity: int, threshold: float = 3):
+        super().__init__(capacity)
+        self.threshold = threshold
+        self.threshold_sq = threshold * threshold
+        self.rejects = capacity - 1 >= self.threshold_sq # Whether a full window can have outliers at all
+
+    def update(self, sample: float) -> float:
+        window = self.window
+        if not self.rejects:
+            window.push(sample)
+            self.value = window.sum / window.count
+            return self.value
+        s = self.sorted
+        if window.count == window.capacity:
+            del s[bisect.bisect_left(s, window.values[window.index])]
+        window.push(sample)
+        bisect.insort(s, sample)
+        count = window.count
+        mean = window.sum / count
+        variance = window.sumsq / count - mean * mean
+        if count - 1 < self.threshold_sq or variance <= 0:
+            self.value = mean
+            return mean
+        limit = self.threshold * math.sqrt(variance)
+        low = mean - limit
+        high = mean + limit
+        if s[0] > low and s[-1] < high:
+            self.value = mean # No outliers, the usual case
+            return mean
+        first = bisect.bisect_right(s, low) # s[:first] are outliers below
+        end = bisect.bisect_left(s, high) # s[end:] are outliers above
+        if end <= first:
+            self.value = mean
+            return mean
+        total = window.sum
+        for i in range(first):
+            total -= s[i]
+        for i in range(end, count):
+            total -= s[i]
+        self.value = total / (end - first)
+        return self.value
+
+
+class TrimmedMeanFilter(MedianFilter):
+    '''
+    Mean of the window after dropping the lowest and highest trim_percent of samples, the streaming equivalent of
+    utils.remove_outliers_trim.
+    '''
+    __slots__ = ('trim_percent',)
+
+    def __init__(self, capacity: int, trim_percent: float = 10):
+        super().__init__(capacity)
+        self.trim_percent = trim_percent
+
+    def update(self, sample: float) -> float:
+        self.push(sample)
+        s = self.sorted
+        n = len(s)
+        trim = int(n * self.trim_percent / 100)
+        if n - 2 * trim <= 0:
+            trim = (n - 1) // 2
+        total = 0.0
+        for i in range(trim, n - trim):
+            total += s[i]
+        self.value = total / (n - 2 * trim)
+        return self.value
+
+
+if __name__ == '__main__':
+    import random
+    import time
+    import warnings
+    import numpy as np
+    import utils
+
+    SAMPLES = 100_000
+    rng = random.Random(0)
+    samples = [300 + rng.gauss(0, 3) + (80 if rng.random() < 0.01 else 0) for _ in range(SAMPLES)]
+
+    def numpy_zscore(capacity: int):
+        points = []
+        def update(sample: float) -> float:
+            points.append(sample)
+            if len(points) > capacity:
+                points.pop(0)
+            return float(np.average(utils.remove_outliers_zscore(points, 3)))
+        return update
+
+    def bench(name: str, update):
+        start = time.perf_counter()
+        for sample in samples:
+            update(sample)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<32} {elapsed / SAMPLES * 1e9:8.0f} ns/sample')
+
+    for capacity in (5, 12):
+        print(f'Window of {capacity}:')
+        with warnings.catch_warnings(): # The original returns NaN, with warnings, for a window with no spread
+            warnings.simplefilter('ignore', RuntimeWarning)
+            bench('numpy remove_outliers_zscore', numpy_zscore(capacity))
+        bench('ZScoreFilter', ZScoreFilter(capacity, 3).update)
+        bench('MeanFilter', MeanFilter(capacity).update)
+        bench('MedianFilter', MedianFilter(capacity).update)
+        bench('TrimmedMeanFilter', TrimmedMeanFilter(capacity, 10).update)
@@ -0,0 +1,186 @@
+'''
+fileoverview: Hardware abstraction layer. Motor, TOF, Switch and the LEDs never talk to pigpio or the I2C bus
+directly, they go through the active backend. On the Pi this is PiBackend, which wraps the real drivers.
+Off the Pi, SimBackend (simulator.py) models the lectern so the whole controller can run headless.
+
+The backend is picked with the LECTERN_BACKEND environment variable ("pi" or "sim"), or explicitly with
+set_backend() before any hardware object is created.
+'''
+
+import os
+import time
+
+BACKEND = os.environ.get('LECTERN_BACKEND', 'pi')
+
+# Edge constants, same values as pigpio
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+
+
+class Backend:
+    # True when the backend runs against wall-clock time and can be driven from its own threads
+    realtime = True
+
+    def setup_input(self, pin: int):
+        raise NotImplementedError()
+
+    def setup_output(self, pin: int):
+        raise NotImplementedError()
+
+    def read(self, pin: int) -> int:
+        raise NotImplementedError()
+
+    def read_bank(self) -> int:
+        '''
+        Read the levels of GPIO 0-31 in one call, one bit per GPIO.
+        '''
+        raise NotImplementedError()
+
+    def write(self, pin: int, level: int):
+        raise NotImplementedError()
+
+    def set_servo_pulsewidth(self, pin: int, width: float):
+        raise NotImplementedError()
+
+    def callback(self, pin: int, edge: int, func):
+        '''
+        Call func(pin, level, tick) from a background thread when the input changes.
+        tick is a timestamp in microseconds that wraps at 2^32, like pigpio.
+        The returned object has a cancel() method.
+        '''
+        raise NotImplementedError()
+
+    def glitch_filter(self, pin: int, steady_us: int):
+        '''
+        Ignore level changes on an input that do not last at least steady_us.
+        '''
+        pass
+
+    def tick(self) -> int:
+        '''
+        Current time in the same microsecond units as callback ticks.
+        '''
+        return int(time.monotonic() * 1_000_000) & 0xFFFFFFFF
+
+    def pwm(self, pin: int, frequency: int):
+        '''
+        Create a PWM channel. The returned object follows the RPi.GPIO PWM interface
+        (start, ChangeDutyCycle, stop) with duty cycles in percent.
+        '''
+        raise NotImplementedError()
+
+    def tof(self):
+        '''
+        Create the time of flight sensor. The returned object follows the adafruit_vl53l0x.VL53L0X interface.
+        '''
+        raise NotImplementedError()
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds)
+
+    def cleanup(self, pins: list[int] = None):
+        pass
+
+
+class PigpioPWM:
+    '''
+    RPi.GPIO style PWM channel on the shared pigpio connection. Duty cycles are in percent, and writing the duty cycle
+    the channel already has is skipped.
+    '''
+    def __init__(self, pi, pin: int, frequency: int):
+        self.pi = pi
+        self.pin = pin
+        self.duty_cycle = None
+        pi.set_PWM_frequency(pin, frequency)
+        pi.set_PWM_range(pin, 100)
+
+    def start(self, duty_cycle: float):
+        self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float):
+        duty_cycle = int(round(duty_cycle))
+        if duty_cycle == self.duty_cycle:
+            return
+        self.pi.set_PWM_dutycycle(self.pin, duty_cycle)
+        self.duty_cycle = duty_cycle
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+
+class PiBackend(Backend):
+    '''
+    Everything goes through one pigpio connection: GPIO, the motor's servo output, LED PWM and edge callbacks.
+    '''
+    def __init__(self):
+        # Imported here so the rest of the controller can be imported off a Pi
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError("pigpio daemon not running or connection failed!")
+        self.outputs: set[int] = set()
+
+    def setup_input(self, pin: int):
+        self.pi.set_mode(pin, self.pigpio.INPUT)
+
+    def setup_output(self, pin: int):
+        self.pi.set_mode(pin, self.pigpio.OUTPUT)
+        self.outputs.add(pin)
+
+    def read(self, pin: int) -> int:
+        return self.pi.read(pin)
+
+    def read_bank(self) -> int:
+        return self.pi.read_bank_1()
+
+    def write(self, pin: int, level: int):
+        self.pi.write(pin, 1 if level else 0)
+
+    def set_servo_pulsewidth(self, pin: int, width: float):
+        self.pi.set_servo_pulsewidth(pin, width)
+
+    def callback(self, pin: int, edge: int, func):
+        return self.pi.callback(pin, edge, func)
+
+    def glitch_filter(self, pin: int, steady_us: int):
+        self.pi.set_glitch_filter(pin, steady_us)
+
+    def tick(self) -> int:
+        return self.pi.get_current_tick()
+
+    def pwm(self, pin: int, frequency: int):
+        return PigpioPWM(self.pi, pin, frequency)
+
+    def tof(self):
+        import busio
+        import board
+        import adafruit_vl53l0x
+        i2c = busio.I2C(board.SCL, board.SDA)
+        return adafruit_vl53l0x.VL53L0X(i2c)
+
+    def cleanup(self, pins: list[int] = None):
+        # Leave outputs low, pigpio has no per pin cleanup
+        for pin in (self.outputs if pins is None else pins):
+            if pin in self.outputs:
+                self.pi.write(pin, 0)
+
+
+_backend: Backend = None
+
+def set_backend(backend: Backend):
+    global _backend
+    _backend = backend
+
+def get_backend() -> Backend:
+    global _backend
+    if _backend is None:
+        if BACKEND == 'sim':
+            import simulator
+            _backend = simulator.SimBackend()
+        elif BACKEND == 'pi':
+            _backend = PiBackend()
+        else:
+            raise ValueError(f"Unknown hardware backend: {BACKEND}")
+    return _backend
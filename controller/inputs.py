@@ -0,0 +1,190 @@
+'''
+fileoverview: Edge triggered GPIO inputs. Instead of polling GPIO.input per switch per tick, every input registers an
+edge callback with the backend (pigpio callbacks, which carry microsecond tick timestamps) and is debounced from those
+timestamps. Callbacks run on the backend's thread, so an input can react immediately (the limit switches cut the motor
+straight from the callback) while the event loop consumes a latched, debounced state once per tick.
+
+The state of the whole bank is kept as bitmasks indexed by GPIO number. Once per tick sample() reads all GPIO levels
+in one call (pigpio read_bank_1), which also catches edges a callback missed, and returns a SwitchSnapshot that
+decodes individual switches through a precomputed mask table.
+
+Run this file to benchmark per-tick input cost:
+    python3 inputs.py
+'''
+
+import threading
+from typing import Callable
+import hardware
+
+TICK_WRAP = 0xFFFFFFFF # pigpio ticks are unsigned 32 bit microseconds
+GLITCH_FILTER_US = 300 # The pigpio glitch filter drops pulses shorter than this before they reach a callback
+
+
+def ticks_since(earlier: int, later: int) -> int:
+    return (later - earlier) & TICK_WRAP
+
+
+class SwitchSnapshot:
+    '''
+    Immutable debounced state of every switch, one bit per GPIO.
+    '''
+    __slots__ = ('bits', 'masks')
+
+    def __init__(self, bits: int, masks: dict[str, int]):
+        self.bits = bits
+        self.masks = masks
+
+    def __getitem__(self, name: str) -> bool:
+        return (self.bits & self.masks[name]) != 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.masks
+
+    def to_dict(self) -> dict[str, bool]:
+        bits = self.bits
+        return {name: (bits & mask) != 0 for name, mask in self.masks.items()}
+
+
+class InputBank:
+    '''
+    Each input is debounced like this: the first edge after a quiet period is accepted immediately (so a limit hit is
+    seen within microseconds), and further edges are ignored until the input has been stable for its debounce time.
+    If it bounced and settled on a different level than the one accepted, sample() picks that up once it has been
+    stable long enough. Activations shorter than a tick are latched so the event loop still sees them.
+    '''
+    def __init__(self, backend: hardware.Backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.masks: dict[str, int] = {}
+        self.pin_mask = 0 # Every pin in the bank
+        self.flip_mask = 0 # Pins that are active low
+        self.state = 0 # Debounced, active high
+        self.rose = 0 # Activated since the last sample
+        self.debounce: dict[int, int] = {}
+        self.changed_tick: dict[int, int] = {}
+        self.edge_tick: dict[int, int] = {}
+        self.on_change: dict[int, Callable[[bool], None]] = {}
+        self.callbacks = []
+
+    def add(self, name: str, pin: int, flip: bool, debounce_us: int, on_change: Callable[[bool], None] = None):
+        backend = self.backend
+        mask = 1 << pin
+        backend.setup_input(pin)
+        backend.glitch_filter(pin, min(debounce_us, GLITCH_FILTER_US))
+        now = backend.tick()
+        level = backend.read(pin)
+
+        with self.lock:
+            self.masks[name] = mask
+            self.pin_mask |= mask
+            if flip:
+                self.flip_mask |= mask
+            if (level == 0) == flip:
+                self.state |= mask
+            self.debounce[pin] = debounce_us
+            self.changed_tick[pin] = (now - debounce_us) & TICK_WRAP # Allow the first edge through straight away
+            self.edge_tick[pin] = now
+            if on_change is not None:
+                self.on_change[pin] = on_change
+        self.callbacks.append(backend.callback(pin, hardware.EITHER_EDGE, self.on_edge))
+
+        if on_change is not None and self.state & mask:
+            on_change(True)
+
+    def accept(self, pin: int, active: bool, tick: int) -> bool:
+        # Must be called with the lock held
+        mask = 1 << pin
+        if ((self.state & mask) != 0) == active:
+            return False
+        if active:
+            self.state |= mask
+            self.rose |= mask
+        else:
+            self.state &= ~mask
+        self.changed_tick[pin] = tick
+        return True
+
+    def on_edge(self, pin: int, level: int, tick: int):
+        if level not in (0, 1):
+            return # pigpio watchdog timeout, not an edge
+        mask = 1 << pin
+        active = (level == 0) == ((self.flip_mask & mask) != 0)
+        with self.lock:
+            self.edge_tick[pin] = tick
+            if ticks_since(self.changed_tick[pin], tick) < self.debounce[pin]:
+                return # Still bouncing from the last accepted change
+            changed = self.accept(pin, active, tick)
+        callback = self.on_change.get(pin)
+        if changed and callback is not None:
+            callback(active)
+
+    def sample(self) -> SwitchSnapshot:
+        levels = self.backend.read_bank()
+        tick = self.backend.tick()
+        raw = (levels ^ self.flip_mask) & self.pin_mask
+        changed = []
+        with self.lock:
+            pending = raw ^ self.state
+            while pending:
+                # Only pins whose level disagrees with the debounced state, normally none
+                mask = pending & -pending
+                pending ^= mask
+                pin = mask.bit_length() - 1
+                if ticks_since(self.edge_tick[pin], tick) >= self.debounce[pin]:
+                    active = (raw & mask) != 0
+                    if self.accept(pin, active, tick):
+                        changed.append((pin, active))
+            bits = self.state | self.rose
+            self.rose = 0
+        for pin, active in changed:
+            callback = self.on_change.get(pin)
+            if callback is not None:
+                callback(active)
+        return SwitchSnapshot(bits, self.masks)
+
+    def cleanup(self):
+        for callback in self.callbacks:
+            callback.cancel()
+
+
+if __name__ == '__main__':
+    import time
+    from sensors import Switch
+    from simulator import SimBackend
+
+    TICKS = 100_000
+    NAMES = ('min_limit', 'max_limit', 'power', 'main_up', 'main_down', 'secondary_up', 'secondary_down')
+    PINS = (19, 26, 18, 5, 6, 24, 23)
+    FLIPS = (True, True, False, False, False, False, False)
+
+    class CountingBackend(SimBackend):
+        # Stand in for a GPIO call's round trip so the number of calls per tick shows up in the result
+        def read(self, pin: int) -> int:
+            time.sleep(0)
+            return super().read(pin)
+
+        def read_bank(self) -> int:
+            time.sleep(0)
+            return super().read_bank()
+
+    backend = CountingBackend()
+    hardware.set_backend(backend)
+
+    switches = [Switch(pin, flip) for pin, flip in zip(PINS, FLIPS)]
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        state = {name: switch.read() for name, switch in zip(NAMES, switches)}
+        state['max_limit']
+    polled = (time.perf_counter() - start) / TICKS
+
+    bank = InputBank(backend)
+    for name, pin, flip in zip(NAMES, PINS, FLIPS):
+        bank.add(name, pin, flip, 20000)
+    start = time.perf_counter()
+    for _ in range(TICKS):
+        snapshot = bank.sample()
+        snapshot['max_limit']
+    banked = (time.perf_counter() - start) / TICKS
+
+    print(f'Per switch GPIO reads + dict: {polled * 1e6:6.2f} us/tick ({len(PINS)} reads)')
+    print(f'Bank read + SwitchSnapshot:   {banked * 1e6:6.2f} us/tick (1 read)')
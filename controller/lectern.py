@@ -13,23 +13,30 @@ messages. However, a single TCP connection is used to handle emergency stop comm
 the current operation, delete all commands in the queue, and stop the motor.
 '''
 
-from motor import Motor, MotorState
+from motor import Motor, MotorState, OutputStats
 from typing import TypedDict
-from RPi import GPIO
-from sensors import Switch, TOF
+import hardware
+from sensors import TOF
+from inputs import InputBank
 from enum import Enum, auto
 from led import Brightness, FlashingSpeed, AsyncLED
 from utils import round, clamp
+import utils
 import math
 import time
 import asyncio
-from PID import PID
+import clock
+from PID import PID, GAINS_FILE, load_gains
+from scheduler import TickScheduler, TickPolicy, TickStats
+from snapshot import SnapshotBus, SensorFrame
+from estimator import KalmanEstimator, Estimate, TIME_CONSTANT
+from planner import Profile, SetpointTable, MotionLimits, Setpoint
+from recorder import FlightRecorder
 
 def clear():
     print(chr(27) + "[2J")
 
 MAX_SPEED = .5
-ACCEL_RATE = 0.08 # Acceleration rate
 SPEED_TOLERANCE = 0.05
 POS_TOLERANCE = .1
 SLOW_DOWN_DISTANCE = 2
@@ -41,14 +48,21 @@ FAIL_STATE_TOLERANCE = 3 # in/s
 
 CALIBRATION_SPEED = 0.3 # 30% of MAX_SPEED
 
+PROFILE_VELOCITY = 0.9 # Fraction of the calibrated velocity a planned move cruises at, leaves the PID room to correct
+PROFILE_SETTLE_TIME = 1.5 # s the PID gets after a planned move ends to settle on the target before it is given up
+
 UDP_PORT = 41234
 E_STOP_PORT = 11111
 OSC_PORT = 12321
 SIG_FIGS = 2
 
+LIMIT_DEBOUNCE = 2000 # us
+BUTTON_DEBOUNCE = 20000 # us
+
 
 class LecternConfig(TypedDict):
     position_pin: int
+    tof_data_ready_pin: int
     tick_speed: int
     max_limit_pin: int
     min_limit_pin: int
@@ -62,6 +76,7 @@ class LecternConfig(TypedDict):
     secondary_speed_channel: int
     status_led_pin: int
     osc_led_pin: int
+    gains_file: str # PID gains profile written by tuner.py, defaults to PID.GAINS_FILE
     down_trigger_pin: int
     down_echo_pin: int
     up_trigger_pin: int
@@ -69,6 +84,9 @@ class LecternConfig(TypedDict):
 
 class SensorState(TypedDict):
     position: float = 0
+    position_age: float = 0
+    position_raw: float = 0
+    position_seq: int = 0
     min_limit: bool = False
     max_limit: bool = False
     power: bool = False
@@ -99,6 +117,13 @@ class GlobalState(Enum):
     def to_dict(self):
         return self.name
 
+class StopLatency(TypedDict):
+    count: int
+    last: float # s from a stop command arriving to the motor output changing
+    average: float
+    max: float
+    late: int # Stops that took longer than a tick
+
 class UDPSystemState(TypedDict):
     sensors: SensorState
     motor_speed: float
@@ -111,41 +136,45 @@ class UDPSystemState(TypedDict):
     motor_state: MotorState
     proximity_up: float
     proximity_down: float
+    scheduler: TickStats
+    estimate: Estimate
+    motor_output: OutputStats
+    setpoint: dict # Profile setpoint of the current move, None when not tracking one
+    eta: float
+    tracking_error: float
+    stop_latency: StopLatency
 
 class Sensors:
-    def __init__(self, config: LecternConfig):
-        GPIO.setmode(GPIO.BCM)
-        self.position = TOF()
-        self.max_limit = Switch(config['max_limit_pin'], True) # Inverted because we want it NC for safety
-        self.min_limit = Switch(config['min_limit_pin'], True) # Inverted because we want it NC for safety
-        self.power = Switch(config['power_pin'], False)
-        self.main_up = Switch(config['main_up_pin'], False)
-        self.main_down = Switch(config['main_down_pin'], False)
-        self.secondary_up = Switch(config['secondary_up_pin'], False)
-        self.secondary_down = Switch(config['secondary_down_pin'], False)
+    def __init__(self, config: LecternConfig, motor: Motor):
+        self.position = TOF(config.get('tof_data_ready_pin'))
+        self.inputs = InputBank(hardware.get_backend())
+        # Limits are inverted because we want them NC for safety. They cut the motor straight from the edge callback.
+        self.inputs.add('min_limit', config['min_limit_pin'], True, LIMIT_DEBOUNCE, lambda hit: motor.block(False, hit))
+        self.inputs.add('max_limit', config['max_limit_pin'], True, LIMIT_DEBOUNCE, lambda hit: motor.block(True, hit))
+        self.inputs.add('power', config['power_pin'], False, BUTTON_DEBOUNCE)
+        self.inputs.add('main_up', config['main_up_pin'], False, BUTTON_DEBOUNCE)
+        self.inputs.add('main_down', config['main_down_pin'], False, BUTTON_DEBOUNCE)
+        self.inputs.add('secondary_up', config['secondary_up_pin'], False, BUTTON_DEBOUNCE)
+        self.inputs.add('secondary_down', config['secondary_down_pin'], False, BUTTON_DEBOUNCE)
 
 
     def read(self):
-        return SensorState(
-            position=round(self.position.read(), SIG_FIGS),
-            min_limit=self.min_limit.read(),
-            max_limit=self.max_limit.read(),
-            power=self.power.read(),
-            main_up=self.main_up.read(),
-            main_down=self.main_down.read(),
-            secondary_up=self.secondary_up.read(),
-            secondary_down=self.secondary_down.read(),
+        '''
+        :return: The arguments for SnapshotBus.publish: position, position_age, position_raw, position_seq and switches.
+        '''
+        # One snapshot of the ring, the acquisition thread may push a new sample at any time
+        seq, timestamp, raw, position = self.position.sample()
+        return (
+            round(position, SIG_FIGS),
+            round(clock.now() - timestamp, 3),
+            utils.cm_to_in(raw / 10),
+            seq,
+            self.inputs.sample(),
         )
 
     def cleanup(self):
         self.position.cleanup()
-        self.max_limit.cleanup()
-        self.min_limit.cleanup()
-        self.power.cleanup()
-        self.main_up.cleanup()
-        self.main_down.cleanup()
-        self.secondary_up.cleanup()
-        self.secondary_down.cleanup()
+        self.inputs.cleanup()
 
 
 class CalibrationState(Enum):
@@ -161,17 +190,29 @@ class Calibration:
         self.top = 19.2
         self.bottom = 6.3
         self.velocity = 5.354 * MAX_SPEED # in/s at 100% velocity
+        self.acceleration = 8 # in/s^2 a planned move may use
+        self.jerk = 60 # in/s^3 a planned move may use
+
+    def motion_limits(self, headroom: float = PROFILE_VELOCITY) -> MotionLimits:
+        return MotionLimits(
+            velocity=self.velocity * headroom,
+            acceleration=self.acceleration,
+            jerk=self.jerk,
+        )
 
 class Lectern:
     def __init__(self, motor: Motor, config: LecternConfig):
         self.motor = motor
         self.config = config
-        self.sensors = Sensors(config)
+        self.sensors = Sensors(config, motor)
+        self.bus = SnapshotBus() # One sensor frame per tick, shared by everything that needs sensor data
         self.calibration = Calibration()
         self.calibration_state = CalibrationState.DONE
         self.state = SYSTEM_STATE.STAND_BY
         self.tick_speed = config['tick_speed']
-        self.pid = PID(kp=0.65, ki=0.02, kd=0.1)
+        self.scheduler = TickScheduler(self.tick_speed, TickPolicy.SKIP)
+        self.dt = self.tick_speed / 1000 # Measured duration of the last tick in seconds
+        self.pid = PID(**load_gains(config.get('gains_file', GAINS_FILE)))
 
         self.global_state = GlobalState.STARTUP
         self.leds = {
@@ -182,6 +223,9 @@ class Lectern:
         self.on = True
         self.stop_timer = 0
         self.locked = False
+        self.remote_locked = False # Locked by a lock command, until unlock
+        self.stop_requested: float = None # When the stop being measured arrived
+        self.stop_latency = StopLatency(count=0, last=0.0, average=0.0, max=0.0, late=0)
 
         self.connections = []
 
@@ -190,7 +234,8 @@ class Lectern:
         self.speed_multiplier = 1.0  # Used to adjust speed based on position or other factors
         
         self.velocity = 0
-        self.velocity_points = []
+        self.estimator = KalmanEstimator()
+        self.estimate: Estimate = self.estimator.to_dict()
 
         self.gpio_target_motor_speed = 0
         self.gpio_moving = False
@@ -198,10 +243,10 @@ class Lectern:
 
         self.start_pos = -1  # Used for position tracking when moving to a target position
         self.target_pos = -1
-        self.target_pos_with_time = -1
-        self.target_time = 0
-        self.target_time_start = 0
-        self.esitmated_speed = 0
+        self.profile: Profile | SetpointTable = None # Motion profile of the current move, tracked by the event loop
+        self.profile_start = 0
+        self.setpoint = Setpoint(0.0, 0.0, 0.0)
+        self.tracking_error = 0.0 # Setpoint minus estimated position, in
 
         self.command_ready = True
         self.fail_state = False
@@ -209,32 +254,47 @@ class Lectern:
         self.tasks = []
         self.calibration_task: asyncio.Task = None
 
+        # Set by the event loop when the state, a switch, a lock or the calibration step changes (see transition_key)
+        self.state_changed = asyncio.Event()
+        self.last_transition_key: tuple = None
+        self.recorder: FlightRecorder = None # Gets every tick, see recorder.py
+
     def set_speed(self, speed: float):
+        if self.profile is not None:
+            # A speed command takes over from a move to a position
+            self.profile = None
+            self.target_pos = -1
         self.prev_speed = self.motor.speed
         self.target_motor_speed = speed
 
-    def stop(self):
+    def stop(self, requested_at: float = None):
+        '''
+        :param requested_at: clock.now() when the stop command arrived, to measure how long until the motor output
+        changes. Only measured if the motor is running.
+        '''
+        if requested_at is not None and self.motor.speed != 0:
+            self.stop_requested = requested_at
         self.target_motor_speed = 0
         self.gpio_target_motor_speed = 0
         self.target_pos = -1
-        self.target_pos_with_time = -1
-        self.target_time = 0
-        self.target_time_start = 0
-        self.esitmated_speed = 0
+        self.profile = None
         if self.calibration_task:
             self.calibration_task.cancel()
             self.calibration_task = None
 
     def bump(self, distance: float):
         print(f"Bumping {distance} inches")
-        self.go_to(self.sensors.position.read() + distance)
+        if self.bus.latest is None:
+            print("Cannot bump, no sensor data yet")
+            return
+        self.go_to(self.bus.latest['position'] + distance)
 
     async def cleanup(self):
         print("Cleaning up system...")
         self.on = False
         self.motor.cleanup()
         self.sensors.cleanup()
-        GPIO.cleanup()
+        hardware.get_backend().cleanup()
         for task in self.tasks:
             task.cancel()
         await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -244,27 +304,65 @@ class Lectern:
         if self.calibration_state != CalibrationState.DONE:
             print("Cannot go to position, system is not calibrated")
             return
-        self.target_pos = pos
-        self.pid.reset()
+        pos = clamp(pos, self.calibration.bottom, self.calibration.top)
+        # Planned from the current velocity, so a new target mid-move blends into the move in progress
+        self.follow(Profile(self.estimate['position'], pos, self.calibration.motion_limits(), self.estimate['velocity']))
+
+    def go_to_in(self, pos: float, duration: float):
+        '''
+        Move to a position so it is reached duration seconds from now. The whole move is planned here and sampled into
+        a setpoint table, the event loop only looks up the setpoint for each tick.
 
-    def go_to_in(self, pos: float, time: float):
+        :raises ValueError: if the lectern cannot cover the distance in that time at its calibrated velocity.
+        '''
         if self.calibration_state != CalibrationState.DONE:
             print("Cannot go to position, system is not calibrated")
             return
-        distance = pos - self.sensors.position.read()
-        velocity = distance / time
-        velocity = clamp(velocity, -1, 1)
-        self.target_time = time
-        self.target_time_start = time.time()
-        self.target_pos_with_time = pos
-        self.estimated_speed = velocity
+        pos = clamp(pos, self.calibration.bottom, self.calibration.top)
+        profile = Profile.timed(self.estimate['position'], pos, duration, self.calibration.motion_limits(1), self.estimate['velocity'])
+        self.follow(profile.table(self.tick_speed / 1000))
+
+    def follow(self, profile: Profile | SetpointTable):
+        self.profile = profile
+        self.profile_start = clock.now()
+        self.start_pos = -1
+        self.target_pos = profile.end
+        self.pid.reset()
+
+    def transition_key(self, sensors: SensorFrame) -> tuple:
+        '''
+        Everything whose change is worth telling a display about right away.
+        '''
+        return (
+            self.state, self.global_state, self.calibration_state, self.motor.state, self.motor.fault,
+            self.remote_locked, self.locked, sensors.switches.bits,
+        )
+
+    def active(self) -> bool:
+        '''
+        :return: True while moving or calibrating, when displays get the state at their full rate
+        '''
+        return (
+            self.state in (SYSTEM_STATE.ACCELERATING, SYSTEM_STATE.MOVING)
+            or self.profile is not None
+            or self.global_state == GlobalState.CALIBRATING
+            or self.calibration_state not in (CalibrationState.DONE, CalibrationState.NOT_CALIBRATED)
+        )
+
+    def eta(self) -> float:
+        '''
+        :return: Seconds until the current move's setpoint reaches its target, 0 when not moving to a target.
+        '''
+        if self.profile is None:
+            return 0.0
+        return max(self.profile.duration - (clock.now() - self.profile_start), 0.0)
 
     def home(self):
         self.go_to(self.calibration.bottom)
 
     def print_state(self):
         clear()
-        sensors = self.sensors.read()
+        sensors = self.bus.latest
         print(f'State: {self.state}')
         print(f'Target Speed: {self.target_motor_speed}')
         print(f'Previous Speed: {self.prev_speed}')
@@ -274,9 +372,9 @@ class Lectern:
         print(f'Max Limit: {sensors["max_limit"]}')
         print(f'Ready: {self.command_ready}')
 
-    async def e_stop(self):
+    async def e_stop(self, requested_at: float = None):
         print("Emergency stop triggered")
-        self.stop()
+        self.stop(requested_at)
         self.command_ready = False
         await asyncio.sleep(2)  # Give some time for the motor to stop
         self.command_ready = True
@@ -289,8 +387,7 @@ class Lectern:
         self.command_ready = False
         # Wait for max limit to be hit
 
-        while not self.sensors.max_limit.read():
-            await asyncio.sleep(self.tick_speed / 1000)
+        await self.bus.wait_for(lambda frame: frame['max_limit'])
         self.set_speed(0) # Not neccessary, but good practice
         print('Max limit hit, slowly calibrating max position...')
         await asyncio.sleep(0.5) # Wait for the motor to stop
@@ -300,20 +397,18 @@ class Lectern:
         self.set_speed(0)
         await asyncio.sleep(0.5) # Wait for the motor to stop
         self.set_speed(CALIBRATION_SPEED / 2)
-        while not self.sensors.max_limit.read():
-            await asyncio.sleep(self.tick_speed / 1000)
+        frame = await self.bus.wait_for(lambda frame: frame['max_limit'])
         self.set_speed(0) # Not neccessary, but good practice
         print('Max position calibrated')
-        self.calibration.top = self.sensors.position.read()
+        self.calibration.top = frame['position']
         await asyncio.sleep(0.5)
     
         # Now calibrate the min position
         print('Calibrating min position...')
         self.calibration_state = CalibrationState.MIN_FAST
         self.set_speed(-CALIBRATION_SPEED)
-        start = time.time()
-        while not self.sensors.min_limit.read():
-            await asyncio.sleep(self.tick_speed / 1000)
+        start = clock.now()
+        await self.bus.wait_for(lambda frame: frame['min_limit'])
         self.set_speed(0)
         await asyncio.sleep(0.5) # Wait for the motor to stop
         self.set_speed(CALIBRATION_SPEED)
@@ -324,18 +419,16 @@ class Lectern:
         self.calibration_state = CalibrationState.MIN_SLOW
 
 
-        while not self.sensors.min_limit.read():
-            await asyncio.sleep(self.tick_speed / 1000)
-        end = time.time()
+        frame = await self.bus.wait_for(lambda frame: frame['min_limit'])
+        end = frame.timestamp
         self.set_speed(0)
         print('Min position calibrated')
-        self.calibration.bottom = self.sensors.position.read()
+        self.calibration.bottom = frame['position']
         await asyncio.sleep(0.5)
         self.calibration_state = CalibrationState.DONE
         print(f'Calibration done: Top={self.calibration.top}, Bottom={self.calibration.bottom}')
         self.set_speed(0)
         self.target_pos = -1
-        self.target_pos_with_time = -1
         self.start_pos = -1
         self.command_ready = True
         self.global_state = GlobalState.RUNNING
@@ -356,7 +449,6 @@ class Lectern:
         self.target_motor_speed = 0
         self.gpio_target_motor_speed = 0
         self.target_pos = -1
-        self.target_pos_with_time = -1
         self.stop_timer = 0
         self.state = SYSTEM_STATE.STAND_BY
         self.global_state = GlobalState.SHUTDOWN
@@ -390,10 +482,7 @@ class Lectern:
         self.gpio_moving = True
         self.command_ready = False
         self.target_pos = -1
-        self.target_pos_with_time = -1
-        self.target_time = 0
-        self.target_time_start = 0
-        self.esitmated_speed = 0
+        self.profile = None
 
     def gpio_stop(self):
         print("GPIO Stop")
@@ -413,6 +502,28 @@ class Lectern:
         self.command_ready = True
         self.locked = False
 
+    def lock(self, requested_at: float = None):
+        '''
+        Stop, and ignore motion commands and buttons until unlock().
+        '''
+        print("Lock")
+        self.stop(requested_at)
+        self.gpio_moving = False
+        self.remote_locked = True
+
+    def unlock(self):
+        print("Unlock")
+        self.remote_locked = False
+
+    def record_stop_latency(self, latency: float):
+        stats = self.stop_latency
+        stats['count'] += 1
+        stats['last'] = latency
+        stats['average'] += (latency - stats['average']) / stats['count']
+        stats['max'] = max(stats['max'], latency)
+        if latency > self.tick_speed / 1000:
+            stats['late'] += 1
+
     async def start_up(self):
         self.set_speed(0.3)
         await asyncio.sleep(1)
@@ -425,16 +536,28 @@ class Lectern:
 
     async def event_loop(self):
         start_power = None
-        prev_pos = None
+        position_seq = None
+        self.scheduler.reset()
+        self.motor.clocked = True # Ramps advance with the tick below instead of on their own timer
         try:
             while self.on:
-                sensors = self.sensors.read()
+                self.dt = await self.scheduler.wait()
+                sensors = self.bus.publish(*self.sensors.read())
+
+                # Only fold in the TOF sample when it is a new one, otherwise just predict from the motor command
+                measurement = None
+                if sensors['position_seq'] != position_seq:
+                    position_seq = sensors['position_seq']
+                    measurement = sensors['position_raw']
+                commanded_velocity = 0 if self.motor.state == MotorState.STOPPED else self.motor.speed * self.calibration.velocity
+                self.estimate = self.estimator.step(self.dt, commanded_velocity, measurement)
+                self.velocity = self.estimate['velocity']
 
                 if sensors['power']:
                     if start_power is None:
-                        start_power = time.time()
+                        start_power = clock.now()
                     else:
-                        if time.time - start_power > 5:
+                        if clock.now() - start_power > 5:
                             self.shutdown()
                 else:
                     start_power = None
@@ -452,7 +575,7 @@ class Lectern:
                     self.gpio_lock()
 
                 # Handle movement (only one input is active here)
-                if not self.gpio_moving and not self.locked and active_count == 1:
+                if not self.gpio_moving and not self.locked and not self.remote_locked and active_count == 1:
                     if sensors['main_up'] or sensors['secondary_up']:
                         self.gpio_move(True)
                     elif sensors['main_down'] or sensors['secondary_down']:
@@ -466,104 +589,84 @@ class Lectern:
                     if self.gpio_moving:
                         self.gpio_stop()
 
-                # if not within tolerance, accelerate
-                if self.target_motor_speed * self.speed_multiplier > self.motor.speed + SPEED_TOLERANCE:
-                    self.motor.set_speed(self.motor.speed + ACCEL_RATE)
-                    self.state = SYSTEM_STATE.ACCELERATING
-                    self.command_ready = False
-                elif self.target_motor_speed * self.speed_multiplier < self.motor.speed - SPEED_TOLERANCE:
-                    self.motor.set_speed(self.motor.speed - ACCEL_RATE)
-                    self.state = SYSTEM_STATE.ACCELERATING
-                    self.command_ready = False
-
-                # if within tolerance, set speed
-                if abs(self.target_motor_speed * self.speed_multiplier - self.motor.speed) < SPEED_TOLERANCE:
-                    self.motor.set_speed(self.target_motor_speed * self.speed_multiplier)
-                    self.state = SYSTEM_STATE.MOVING
-                    self.command_ready = True
+                # A planned move drives the motor itself below, the ramp only applies to plain speed commands
+                if self.profile is None:
+                    goal = self.target_motor_speed * self.speed_multiplier
+                    if self.motor.ramp_target() != goal:
+                        self.motor.ramp_to(goal)
+                    self.motor.step()
+                    if self.motor.ramp is not None:
+                        self.state = SYSTEM_STATE.ACCELERATING
+                        self.command_ready = False
+                    else:
+                        self.state = SYSTEM_STATE.MOVING
+                        self.command_ready = True
 
-                # if moving in the positive direction and the max limit is hit, stop
-                if self.motor.speed > 0 and sensors['max_limit']:
+                # if driving in the positive direction and the max limit is hit, stop
+                # (the limit callbacks have already cut the motor output, this settles the state)
+                if self.target_motor_speed > 0 and sensors['max_limit']:
                     self.motor.set_speed(0)
                     self.state = SYSTEM_STATE.STAND_BY
                     self.command_ready = True
-                if self.motor.speed < 0 and sensors['min_limit']:
+                if self.target_motor_speed < 0 and sensors['min_limit']:
                     self.motor.set_speed(0)
                     self.state = SYSTEM_STATE.STAND_BY
                     self.command_ready = True
 
-                if self.target_pos_with_time != -1:
-                    current_pos = sensors['position']
+                if self.profile is not None:
+                    current_pos = self.estimate['position']
                     if self.start_pos == -1:
                         self.start_pos = current_pos
 
-                    distance_to_target = self.target_pos_with_time - current_pos
-                    reached = abs(distance_to_target) <= POS_TOLERANCE
-
-                    if not reached:
-                        speed = self.pid.compute(self.target_pos, current_pos)
-                        speed = clamp(speed, -1.0, 1.0)  # prevent overspeeding
-                        self.set_speed(speed)
-                    else:
-                        self.stop()
-                        self.target_pos_with_time = -1
-                        self.start_pos = -1
-                        distance_to_target = 0
-                        self.command_ready = True
-
-                if self.target_pos != -1:
-                    current_pos = sensors['position']
-                    if self.start_pos == -1:
-                        self.start_pos = current_pos
-                    
-                    distance_to_target = self.target_pos - current_pos
-                    reached = abs(distance_to_target) < POS_TOLERANCE
-
-                    # slow_down = abs(distance_to_target) - SLOW_DOWN_DISTANCE if abs(distance_to_target) < SLOW_DOWN_DISTANCE else 0
-                    # if distance_to_target > 0 and not reached:
-                    #     self.set_speed(1 + slow_down / 50)
-                    # elif distance_to_target < 0 and not reached:
-                    #     self.set_speed(-1 - slow_down / 50)
-
-                    if not reached:
-                        speed = self.pid.compute(self.target_pos, current_pos, self.motor.speed)
-                        speed = clamp(speed, -1.0, 1.0)  # prevent overspeeding
-                        self.set_speed(speed)
-                    else:
+                    # Feedforward from the profile (the acceleration term makes up for the motor's lag), the PID only
+                    # corrects the tracking error
+                    elapsed = clock.now() - self.profile_start
+                    self.setpoint = self.profile.sample(elapsed)
+                    feedforward = (self.setpoint.velocity + TIME_CONSTANT * self.setpoint.acceleration) / self.calibration.velocity
+                    self.tracking_error = self.setpoint.position - current_pos
+                    correction = self.pid.compute(self.setpoint.position, current_pos, self.motor.speed)
+                    speed = clamp(feedforward + correction, -1.0, 1.0)
+
+                    done = elapsed >= self.profile.duration
+                    reached = done and abs(self.target_pos - current_pos) < POS_TOLERANCE
+                    if reached or elapsed >= self.profile.duration + PROFILE_SETTLE_TIME:
+                        if not reached:
+                            print(f"Move to {self.target_pos} did not settle, stopped at {current_pos}")
                         self.stop()
                         self.target_pos = -1
                         self.start_pos = -1
-                        distance_to_target = 0
+                        self.tracking_error = 0.0
                         self.command_ready = True
+                    else:
+                        self.prev_speed = self.motor.speed
+                        self.target_motor_speed = speed
+                        self.speed_multiplier = 1
+                        self.motor.set_speed(speed)
+                        self.state = SYSTEM_STATE.MOVING if done or self.setpoint.acceleration == 0 else SYSTEM_STATE.ACCELERATING
+                        self.command_ready = False
 
                 stop = False
 
+                # Slow plain speed commands down near the ends of travel. A planned move already stops within the
+                # calibrated travel, so it keeps full speed and PID correction up to its target.
                 if self.calibration_state == CalibrationState.DONE:
-                    position = sensors['position']
+                    position = self.estimate['position']
+                    self.speed_multiplier = 1
                     if self.motor.speed > 0:  # Moving up
                         distance_to_top = self.calibration.top - position
                         if distance_to_top <= 0:
                             stop = True
-                        elif distance_to_top < LIMIT_SLOW_DOWN_DISTANCE:
+                        elif distance_to_top < LIMIT_SLOW_DOWN_DISTANCE and self.profile is None:
                             self.speed_multiplier = 1 - math.log1p((LIMIT_SLOW_DOWN_DISTANCE - distance_to_top) / LIMIT_SLOW_DOWN_DISTANCE)
-                            self.pid.enabled = False  # Disable PID near upper limit
-                        else:
-                            self.speed_multiplier = 1
-                            self.pid.enabled = True
                     elif self.motor.speed < 0:  # Moving down
                         distance_to_bottom = position - self.calibration.bottom
                         if distance_to_bottom <= 0:
                             stop = True
-                        elif distance_to_bottom < LIMIT_SLOW_DOWN_DISTANCE:
+                        elif distance_to_bottom < LIMIT_SLOW_DOWN_DISTANCE and self.profile is None:
                             self.speed_multiplier = 1 - math.log1p((LIMIT_SLOW_DOWN_DISTANCE - distance_to_bottom) / LIMIT_SLOW_DOWN_DISTANCE)
-                            self.pid.enabled = False  # Disable PID near lower limit
-                        else:
-                            self.speed_multiplier = 1
-                            self.pid.enabled = True
-                    else:
-                        self.speed_multiplier = 1
-                        self.pid.enabled = True
 
+                if stop:
+                    self.stop() # Past the calibrated travel, drop whatever move got it there
                 if self.target_motor_speed == 0 and abs(self.motor.speed) < SPEED_TOLERANCE or stop:
                     self.prev_speed = 0
                     self.motor.disable()
@@ -578,6 +681,10 @@ class Lectern:
                 #     self.stop()
 
                     
+                if self.stop_requested is not None and self.motor.output.written_at >= self.stop_requested:
+                    self.record_stop_latency(self.motor.output.written_at - self.stop_requested)
+                    self.stop_requested = None
+
                 if self.global_state == SYSTEM_STATE.CALIBRATING:
                     self.command_ready = False
 
@@ -585,20 +692,19 @@ class Lectern:
                 if self.stop_timer > 0:
                     self.stop_timer = self.stop_timer - 1
 
-                if prev_pos is not None:
-                    distance = prev_pos - sensors['position']
-                    velocity = distance / (self.tick_speed / 1000)
-                    self.velocity_points.append(velocity)
-                    if len(self.velocity_points) > 5:
-                        self.velocity_points.pop(0)
-                    self.velocity = sum(self.velocity_points) / len(self.velocity_points)
+                key = self.transition_key(sensors)
+                if key != self.last_transition_key:
+                    self.last_transition_key = key
+                    self.state_changed.set()
 
-                prev_pos = sensors['position']
+                if self.recorder is not None:
+                    self.recorder.append(self)
 
-                await asyncio.sleep(self.tick_speed / 1000)
         except Exception as e:
             print(f"Error in event loop: {e}")
             exit()
+        finally:
+            self.motor.clocked = False
 
     async def start(self):
         print("Starting lectern...")
@@ -1,8 +1,8 @@
-from RPi import GPIO
 from time import sleep
 import threading
 from enum import Enum
 import asyncio
+import hardware
 
 
 class FlashingSpeed(Enum):
@@ -24,8 +24,9 @@ class LED:
         self.pin = pin
         self.tick_speed = tick_speed
         # print(tick_speed)
-        GPIO.setup(pin, GPIO.OUT)
-        self.pwm = GPIO.PWM(pin, 1000)
+        self.backend = hardware.get_backend()
+        self.backend.setup_output(pin)
+        self.pwm = self.backend.pwm(pin, 1000)
         self.pwm.start(0)
         self.flashing_speed = FlashingSpeed.NONE
         self.brightness = Brightness.OFF
@@ -60,14 +61,15 @@ class LED:
     def cleanup(self):
         self.running = False
         self.pwm.stop()
-        GPIO.cleanup(self.pin)
+        self.backend.cleanup([self.pin])
 
 class AsyncLED:
     def __init__(self, pin: int, tick_speed: int):
         self.pin = pin
         self.tick_speed = tick_speed
-        GPIO.setup(pin, GPIO.OUT)
-        self.pwm = GPIO.PWM(pin, 1000)
+        self.backend = hardware.get_backend()
+        self.backend.setup_output(pin)
+        self.pwm = self.backend.pwm(pin, 1000)
         self.pwm.start(0)
         self.flashing_speed = FlashingSpeed.NONE
         self.brightness = Brightness.OFF
@@ -107,4 +109,4 @@ class AsyncLED:
 
     def cleanup(self):
         self.stop()
-        GPIO.cleanup(self.pin)
\ No newline at end of file
+        self.backend.cleanup([self.pin])
\ No newline at end of file
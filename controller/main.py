@@ -1,11 +1,15 @@
 from motor import Motor, MotorConfig
 # from controller.oldsystem import System, SystemConfig
 from lectern import Lectern, LecternConfig
-from RPi import GPIO
+from simulator import SimBackend, SimConfig
 from time import sleep
 import signal
 import asyncio
 import system
+from telemetry import TelemetryFormat
+import hardware
+import os
+from recorder import RECORDER_DIR
 
 TICK_SPEED = 15
 
@@ -65,7 +69,12 @@ TICK_SPEED = 15
 #     return system
 
 async def async_main():
-    GPIO.setmode(GPIO.BCM)
+    if hardware.BACKEND == 'sim':
+        hardware.set_backend(SimBackend(SimConfig(
+            motor_pin=17,
+            max_limit_pin=26,
+            min_limit_pin=19,
+        )))
     motor = Motor(MotorConfig(
         pin=17,
         max=2000,
@@ -73,7 +82,7 @@ async def async_main():
         zero=1500,
         invert=False,
         tick_speed=TICK_SPEED,
-        acceleration=0.02
+        acceleration=5.33 # speed units/s, 0.08 per 15ms tick
     ))
     lectern = Lectern(motor, LecternConfig(
         position_pin=0,
@@ -98,7 +107,11 @@ async def async_main():
         osc_port=12321,
         udp_port=41234,
         tcp_port=11111,
-        emit_tick_speed=TICK_SPEED * 5, # Emit every 5 ticks (75ms)
+        e_stop_port=11112,
+        telemetry_format=TelemetryFormat.JSON, # app/src/lib/server/udp.ts parses JSON
+        emit_tick_speed=TICK_SPEED * 2, # Emit every 2 ticks (30ms) while moving or calibrating
+        idle_emit_tick_speed=250, # Heartbeat while idle
+        recorder_dir=os.environ.get('LECTERN_RECORDER_DIR', RECORDER_DIR), # Outside the checkout
     ))
 
     async def on_exit():
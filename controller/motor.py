@@ -1,10 +1,13 @@
 # from RPi import GPIO
-from time import sleep
+import asyncio
 from sensors import Switch, Potentiometer
 from enum import Enum, auto
 import sys
+import threading
+import time
+import clock
 # from pwm import PWM
-import pigpio
+import hardware
 from typing import TypedDict
 
 # FREQ = 100
@@ -70,7 +73,8 @@ class MotorConfig(TypedDict):
     zero: float
     invert: bool
     tick_speed: float
-    acceleration: float
+    acceleration: float # Default ramp rate, speed units/s (0 to full speed in 1/acceleration s)
+    resolution: float # Smallest pulse width step the servo output can make (us), 1 for pigpio
 
 def make_pulse_width(speed: float, config: MotorConfig):
     neutral = config['zero']
@@ -92,6 +96,117 @@ def make_pulse_width(speed: float, config: MotorConfig):
     else:
         return neutral + (neutral - min_speed) * speed
 
+class OutputStats(TypedDict):
+    writes: int
+    elided: int
+    writes_per_second: float
+    latency: float
+    max_latency: float
+
+
+# Exponential smoothing factor used for the write latency average
+LATENCY_SMOOTHING = 0.1
+
+
+class OutputStage:
+    '''
+    The servo output of the motor. Pulse widths are quantized to what the output can actually produce and a write is
+    skipped when it would not change the output, so an idle lectern does not send a pigpio command every tick.
+    Safe to call from the input callback threads. The lock is reentrant so Motor can hold it around a decision and
+    the write that carries it out.
+    '''
+    def __init__(self, backend: hardware.Backend, pin: int, resolution: float = 1):
+        self.backend = backend
+        self.pin = pin
+        self.resolution = resolution
+        self.lock = threading.RLock()
+        self.width = None # Last pulse width written, None if unknown
+        self.written_at = 0.0 # clock.now() of the last write that went out
+
+        self.writes = 0
+        self.elided = 0
+        self.latency = 0.0 # s, smoothed round trip of a write
+        self.max_latency = 0.0
+        self.rate_writes = 0
+        self.rate_time = clock.now()
+        self.rate = 0.0
+
+    def quantize(self, width: float) -> float:
+        return round(width / self.resolution) * self.resolution
+
+    def write(self, width: float) -> bool:
+        '''
+        :return: True if the output was written, False if the write was elided.
+        '''
+        width = self.quantize(width)
+        with self.lock:
+            if width == self.width:
+                self.elided += 1
+                return False
+            # Before the write: a limit callback the backend fires from inside it (the simulator does) may cut the
+            # output again, and its width has to be the one that sticks
+            self.width = width
+            start = time.perf_counter()
+            try:
+                self.backend.set_servo_pulsewidth(self.pin, width)
+            except Exception:
+                self.width = None
+                raise
+            latency = time.perf_counter() - start
+            self.written_at = clock.now()
+            self.writes += 1
+            self.latency += (latency - self.latency) * LATENCY_SMOOTHING
+            self.max_latency = max(self.max_latency, latency)
+        return True
+
+    def invalidate(self):
+        '''
+        Forget the last written width so the next write goes out, for when something else touched the output.
+        '''
+        with self.lock:
+            self.width = None
+
+    def to_dict(self) -> OutputStats:
+        now = clock.now()
+        elapsed = now - self.rate_time
+        if elapsed >= 1:
+            self.rate = (self.writes - self.rate_writes) / elapsed
+            self.rate_writes = self.writes
+            self.rate_time = now
+        return OutputStats(
+            writes=self.writes,
+            elided=self.elided,
+            writes_per_second=self.rate,
+            latency=self.latency,
+            max_latency=self.max_latency,
+        )
+
+
+class Ramp:
+    '''
+    A change of motor speed from start to target at a constant rate in speed units/s. The speed is a function of the
+    time since the ramp started, so it ramps the same no matter how often it is stepped. done resolves with the
+    target once it is reached, and is cancelled if the ramp is cancelled or replaced first.
+    '''
+    def __init__(self, start: float, target: float, rate: float, started: float):
+        self.start = start
+        self.target = target
+        self.rate = rate
+        self.started = started
+        self.duration = abs(target - start) / rate if rate > 0 else 0.0
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def speed_at(self, now: float) -> float:
+        elapsed = now - self.started
+        if elapsed >= self.duration:
+            return self.target
+        step = self.rate * elapsed
+        return self.start + step if self.target > self.start else self.start - step
+
+    def cancel(self):
+        self.done.cancel()
+
+
 class Motor:
     def __init__(self, config: MotorConfig):
         # if not GPIO.getmode():
@@ -105,17 +220,36 @@ class Motor:
         self.tick_speed = config["tick_speed"]
         self.state = MotorState.STOPPED
         self.speed = 0.0
+        # Set by the limit switch callbacks, no speed in a blocked direction is let through
+        self.blocked_up = False
+        self.blocked_down = False
+        # Latched by the e-stop, no speed is let through until clear_fault()
+        self.fault = False
+        self.acceleration = config['acceleration']
+        self.ramp: Ramp = None
+        # True while a control loop calls step() every tick, otherwise ramps step themselves on a timer
+        self.clocked = False
+        self.ramp_task: asyncio.Task = None
+        self.last_step = clock.now()
         # GPIO.setup(self.pin, GPIO.OUT)
         # self.pwm = GPIO.PWM(self.pin, FREQ)
         # self.pwm = PWM(self.pin, FREQ)
         # self.pwm.start(0)
-        self.pi = pigpio.pi()
-        self.pi.set_mode(self.pin, pigpio.OUTPUT)
+        self.backend = hardware.get_backend()
+        self.backend.setup_output(self.pin)
+        self.output = OutputStage(self.backend, self.pin, config.get('resolution', 1))
         self.set_speed(0)
-        # self.pi.set_servo_pulsewidth()
+        # self.backend.set_servo_pulsewidth()
         # self.servo = self.pi.gpioServo()
 
     def set_speed(self, speed: float):
+        '''
+        Set the speed straight away, cancelling any ramp in progress.
+        '''
+        self.cancel_ramp()
+        self.apply(speed)
+
+    def apply(self, speed: float):
         # if not self.pin:
         #     raise Exception('Motor not started')
         # print(f'Speed: {speed}')
@@ -123,71 +257,153 @@ class Motor:
         # normalized = (speed + 1) / 2
         # duty_cycle = normalized * 255
         # self.pwm.ChangeDutyCycle(make_duty_cycle(speed))
-        self.pi.set_servo_pulsewidth(self.pin, make_pulse_width(speed, self.config))
-        # self.pwm.ChangeDutyCycle(duty_cycle)
-        self.speed = speed
-        if speed == 0.0:
-            self.state = MotorState.STAND_BY
-        else:
-            self.state = MotorState.RUNNING
+        # Under the output lock, so a trip or block from another thread lands either before the check or after the
+        # write, never in between to be overwritten by a stale pulse
+        with self.output.lock:
+            if self.fault or (speed > 0 and self.blocked_up) or (speed < 0 and self.blocked_down):
+                speed = 0.0
+            self.speed = speed
+            if speed == 0.0:
+                self.state = MotorState.STAND_BY
+            else:
+                self.state = MotorState.RUNNING
+            self.output.write(make_pulse_width(speed, self.config))
+            # self.pwm.ChangeDutyCycle(duty_cycle)
 
 
     def cleanup(self):
-        self.pi.set_servo_pulsewidth(self.pin, 0)
-
-    def accelerate_to(self, target: float, time: float):
-        if self.speed == target:
-            return
-        # print(f'Accelerating to {target}')
-        
-        start = self.speed
-        ticks = time / (self.tick_speed / 1000)
-        acceleration = (target - start) / ticks
-        # print(f'Acceleration: {acceleration}')
-        # print(f'Ticks: {ticks}')
-
-        while True:
-            if target < start and self.speed <= target:
-                break
-            if target > start and self.speed >= target:
-                break
-            if target < start:
-                # print(f'Decelerating to {self.speed + acceleration}')
-                self.set_speed(self.speed + acceleration)
+        self.output.write(0)
+
+    def block(self, up: bool, blocked: bool):
+        '''
+        Block or unblock a direction of travel. Safe to call from an input callback thread: if the motor is moving in
+        the blocked direction its output is cut immediately.
+        '''
+        with self.output.lock:
+            if up:
+                self.blocked_up = blocked
             else:
-                # print(f'Accelerating to {self.speed + acceleration}')
-                self.set_speed(self.speed + acceleration)
-            sleep(self.tick_speed / 1000)
-
-    def calibrate(self, time: float = 10):
+                self.blocked_down = blocked
+            if blocked and ((up and self.speed > 0) or (not up and self.speed < 0)):
+                self.cut()
+
+    def cut(self):
+        '''
+        Stop the motor with the neutral pulse. Pulse width 0 turns the servo signal off, and what the actuator does
+        without a signal is up to its controller.
+        '''
+        with self.output.lock:
+            self.speed = 0.0
+            self.state = MotorState.STOPPED
+            self.output.write(make_pulse_width(0, self.config))
+
+    def trip(self):
+        '''
+        Latch a fault and cut the output. Safe to call from any thread, the motor stays stopped until clear_fault().
+        '''
+        with self.output.lock:
+            self.fault = True
+            self.cut()
+
+    def clear_fault(self):
+        self.fault = False
+
+    def ramp_to(self, target: float, rate: float = None) -> asyncio.Future:
+        '''
+        Ramp from the current speed to target at rate speed units/s (the configured acceleration by default),
+        replacing any ramp in progress. The ramp advances from step(), called by the control loop every tick when
+        the motor is clocked, or on its own timer otherwise.
+
+        :return: Future that resolves with the target speed when it is reached.
+        '''
+        self.cancel_ramp()
+        now = clock.now()
+        # A ramp requested between ticks starts from the last tick, so the very next step already moves
+        started = max(self.last_step, now - self.tick_speed / 1000) if self.clocked else now
+        ramp = Ramp(self.speed, target, rate or self.acceleration, started)
+        if ramp.duration == 0:
+            self.apply(target)
+            ramp.done.set_result(target)
+            return ramp.done
+        self.ramp = ramp
+        if not self.clocked:
+            self.ramp_task = asyncio.create_task(self.run_ramp(ramp))
+        return ramp.done
+
+    def ramp_target(self) -> float:
+        '''
+        :return: The speed the motor is heading to, the current speed if it is not ramping.
+        '''
+        return self.ramp.target if self.ramp is not None else self.speed
+
+    def step(self, now: float = None):
+        if now is None:
+            now = clock.now()
+        self.last_step = now
+        ramp = self.ramp
+        if ramp is None:
+            return
+        speed = ramp.speed_at(now)
+        self.apply(speed)
+        if speed == ramp.target:
+            self.ramp = None
+            if not ramp.done.done():
+                ramp.done.set_result(speed)
+
+    async def run_ramp(self, ramp: Ramp):
+        while self.ramp is ramp and not self.clocked:
+            await asyncio.sleep(self.tick_speed / 1000)
+            if self.ramp is ramp:
+                self.step()
+
+    def cancel_ramp(self):
+        if self.ramp is not None:
+            self.ramp.cancel()
+            self.ramp = None
+        if self.ramp_task is not None:
+            self.ramp_task.cancel()
+            self.ramp_task = None
+
+    def accelerate_to(self, target: float, duration: float) -> asyncio.Future:
+        '''
+        Ramp to target over duration seconds.
+        '''
+        if duration <= 0:
+            return self.ramp_to(target, float('inf'))
+        return self.ramp_to(target, abs(target - self.speed) / duration)
+
+    async def calibrate(self, duration: float = 10):
         self.state = MotorState.CALIBRATING
-        self.accelerate_to(1, 2)
-        sleep(time)
-        self.accelerate_to(-1, 2)
-        sleep(time)
-        self.accelerate_to(0, 2)
-        sleep(time)
+        await self.accelerate_to(1, 2)
+        await asyncio.sleep(duration)
+        await self.accelerate_to(-1, 2)
+        await asyncio.sleep(duration)
+        await self.accelerate_to(0, 2)
+        await asyncio.sleep(duration)
         self.state = MotorState.STAND_BY
 
-    def test(self, time: float = 10):
+    async def test(self, duration: float = 10):
         self.state = MotorState.TESTING
-        self.accelerate_to(1, 2)
-        sleep(time)
-        self.accelerate_to(-1, 2)
-        sleep(time)
-        self.accelerate_to(0, 2)
-        sleep(time)
+        await self.accelerate_to(1, 2)
+        await asyncio.sleep(duration)
+        await self.accelerate_to(-1, 2)
+        await asyncio.sleep(duration)
+        await self.accelerate_to(0, 2)
+        await asyncio.sleep(duration)
 
     def enable(self):
         self.state = MotorState.STAND_BY
         self.set_speed(0)
 
     def disable(self):
-        self.state = MotorState.STOPPING
-        # self.pwm.ChangeDutyCycle(0)
-        self.pi.set_servo_pulsewidth(self.pin, 0)
-        # self.set_speed(0)
-        self.state = MotorState.STOPPED
+        self.cancel_ramp()
+        with self.output.lock:
+            self.state = MotorState.STOPPING
+            # self.pwm.ChangeDutyCycle(0)
+            self.speed = 0.0
+            self.output.write(0)
+            # self.set_speed(0)
+            self.state = MotorState.STOPPED
 
 
 # def start_potentiometer_loop(potentiometer: Potentiometer, motor: Motor):
@@ -213,6 +429,6 @@ class Motor:
 #             tick_speed=15,
 #             acceleration=0.02
 #         ))
-#         motor.test(2)
+#         asyncio.run(motor.test(2))
 #         motor.cleanup()
 #         exit()
\ No newline at end of file
@@ -1,120 +1,348 @@
-import argparse
-import asyncio
-import queue
+'''
+fileoverview: OSC over UDP on the event loop. Datagrams arrive through an asyncio datagram endpoint, no threads, and
+are decoded straight out of the receive buffer: struct.unpack_from reads numbers in place, and only the address and
+string arguments are turned into str objects. Each message goes to the command router as it is decoded, so the queue
+only ever sees parsed commands.
 
-from pythonosc.dispatcher import Dispatcher
-from pythonosc import osc_server
+Arguments can be encoded in the address, typed, or both; these are the same command:
+    /lectern/go_to/12/in/5
+    /lectern/go_to 12.0 "in" 5.0
+    /lectern/go_to/12 "in" 5
 
-import threading
+Run this file to benchmark the decoder and the endpoint:
+    python3 osc.py
+'''
 
-from typing import TypedDict, Any
+import asyncio
+import struct
+from typing import TypedDict
 import Q
+from router import Router, CommandError
+
+BUNDLE = b'#bundle\0'
+MAX_LAYOUTS = 256 # Type tag strings whose struct layout is cached, so a hostile sender cannot grow the cache
+
+INT32 = struct.Struct('>i')
+UINT32 = struct.Struct('>I')
+FLOAT32 = struct.Struct('>f')
+# Fixed size argument types and their struct codes
+FIXED_TYPES = {'i': 'i', 'f': 'f', 'd': 'd', 'h': 'q', 'c': 'I', 'r': 'I', 'm': 'I', 't': 'Q'}
+# Argument types without data
+EMPTY_TYPES = {'T': True, 'F': False, 'N': None, 'I': None}
+
+
+class OSCDecodeError(ValueError):
+    pass
 
 
 class OSC_Config(TypedDict):
     ip: str
     port: int
     queue: Q.SystemQueue
-    threading: bool
+    router: Router # Commands are parsed against it before they are queued
 
-class OSC_Server:
-    def __init__(self, config: OSC_Config):
-        self.ip = config["ip"]
-        self.port = config["port"]
-        self.queue = config["queue"]
-        self.threading = config["threading"]
-        self.running = True
 
-    def server(self):
-        parser = argparse.ArgumentParser()
-        parser.add_argument("--ip",
-            default=self.ip, help="The ip to listen on")
-        parser.add_argument("--port",
-            type=int, default=self.port, help="The port to listen on")
-        args = parser.parse_args()
+class OSCStats(TypedDict):
+    commands: int # Parsed and queued
+    rejected: int # Unknown commands or bad arguments
+    malformed: int # Datagrams that are not valid OSC
 
-        def handler(name: str, *args):
-            if not self.running:
-                server.server_close()
-                return
-            # remove all commas
-            name = name.replace(",", "")
-            print(name, args)
-            self.queue.put(Q.System_Command(
-                command=name,
-                # args=args
-            ))
 
-        dispatcher = Dispatcher()
-        dispatcher.map("/*", handler)
+def read_string(data: bytes, offset: int, end: int) -> tuple[str, int]:
+    '''
+    :return: The null terminated string at offset, and the offset after its padding
+    '''
+    stop = data.find(b'\0', offset, end)
+    if stop < 0:
+        raise OSCDecodeError('Unterminated string')
+    return data[offset:stop].decode(), (stop + 4) & ~3
 
-        server = osc_server.ThreadingOSCUDPServer(
-            (args.ip, args.port), dispatcher)
-        print("Serving on {}".format(server.server_address))
-        server.serve_forever()
 
-    def stop(self):
-        self.running = False
+# Type tag string to the struct that unpacks all of its arguments at once, None if it has variable size arguments
+layouts: dict[str, struct.Struct] = {}
+
+
+def layout(tags: str) -> struct.Struct:
+    if tags in layouts:
+        return layouts[tags]
+    codes = [FIXED_TYPES.get(tag) for tag in tags]
+    packed = struct.Struct('>' + ''.join(codes)) if None not in codes else None
+    if len(layouts) < MAX_LAYOUTS:
+        layouts[tags] = packed
+    return packed
+
+
+def decode_message(data: bytes, view: memoryview, offset: int, end: int) -> tuple[str, tuple]:
+    '''
+    Decode the message between offset and end.
+
+    :return: (address, arguments)
+    :raises OSCDecodeError: if it is not a valid OSC message
+    '''
+    address, offset = read_string(data, offset, end)
+    if offset >= end or data[offset] != 0x2c: # ','
+        return address, () # No type tag string (OSC 1.0 senders), no arguments
+    tags, offset = read_string(data, offset + 1, end)
+    if not tags:
+        return address, ()
+    packed = layout(tags)
+    try:
+        if packed is not None:
+            if offset + packed.size > end:
+                raise OSCDecodeError(f'Arguments of {address} are truncated')
+            return address, packed.unpack_from(view, offset)
+        args = []
+        for tag in tags:
+            code = FIXED_TYPES.get(tag)
+            if code == 'f':
+                args.append(FLOAT32.unpack_from(view, offset)[0])
+                offset += 4
+            elif code == 'i':
+                args.append(INT32.unpack_from(view, offset)[0])
+                offset += 4
+            elif code is not None:
+                value, = struct.unpack_from('>' + code, view, offset)
+                args.append(value)
+                offset += struct.calcsize(code)
+            elif tag == 's' or tag == 'S':
+                value, offset = read_string(data, offset, end)
+                args.append(value)
+            elif tag == 'b':
+                size = INT32.unpack_from(view, offset)[0]
+                if size < 0:
+                    raise OSCDecodeError(f'Negative blob size in {address}')
+                args.append(view[offset + 4:offset + 4 + size]) # Blobs stay a view into the datagram
+                offset = (offset + 4 + size + 3) & ~3
+            elif tag in EMPTY_TYPES:
+                args.append(EMPTY_TYPES[tag])
+            else:
+                raise OSCDecodeError(f'Unsupported argument type {tag!r}')
+            if offset > end:
+                raise OSCDecodeError(f'Arguments of {address} are truncated')
+        return address, tuple(args)
+    except struct.error:
+        raise OSCDecodeError(f'Arguments of {address} are truncated')
+
 
-    def start(self):
-        if self.threading:
-            self.thread = threading.Thread(target=self.server)
-            self.thread.daemon = True
-            self.thread.start()
+def decode_packet(data: bytes, view: memoryview = None, offset: int = 0, end: int = None) -> list[tuple[str, tuple]]:
+    '''
+    Decode a datagram, a single message or a bundle (nested bundles included; time tags are ignored and everything
+    runs as it arrives).
+
+    :return: [(address, arguments), ...]
+    :raises OSCDecodeError: if it is not a valid OSC packet
+    '''
+    if view is None:
+        view = memoryview(data)
+    if end is None:
+        end = len(data)
+    if data.startswith(BUNDLE, offset):
+        messages = []
+        offset += 16 # '#bundle\0' and the time tag
+        while offset + 4 <= end:
+            size = INT32.unpack_from(view, offset)[0]
+            offset += 4
+            if size < 0 or offset + size > end:
+                raise OSCDecodeError('Bundle element is truncated')
+            messages.extend(decode_packet(data, view, offset, offset + size))
+            offset += size
+        return messages
+    if offset >= end or data[offset] != 0x2f: # '/'
+        raise OSCDecodeError('Not an OSC message')
+    return [decode_message(data, view, offset, end)]
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode()
+    return data + b'\0' * (4 - len(data) % 4)
+
+
+def encode_message(address: str, *args) -> bytes:
+    '''
+    Encode a message with int (i), float (f), str (s), bool (T/F) and None (N) arguments.
+    '''
+    tags = ','
+    payload = b''
+    for arg in args:
+        if arg is True or arg is False:
+            tags += 'T' if arg else 'F'
+        elif arg is None:
+            tags += 'N'
+        elif isinstance(arg, int):
+            tags += 'i'
+            payload += INT32.pack(arg)
+        elif isinstance(arg, float):
+            tags += 'f'
+            payload += FLOAT32.pack(arg)
+        elif isinstance(arg, str):
+            tags += 's'
+            payload += encode_string(arg)
         else:
-            self.server()
+            raise TypeError(f'Cannot encode {arg!r} as an OSC argument')
+    return encode_string(address) + encode_string(tags) + payload
 
-class AsyncOSCConfig(TypedDict):
-    ip: str
-    port: int
-    queue: Q.SystemQueue
 
-class AsyncOSCServer:
+class OSC_Server(asyncio.DatagramProtocol):
     def __init__(self, config: OSC_Config):
         self.ip = config["ip"]
         self.port = config["port"]
         self.queue = config["queue"]
+        self.router = config["router"]
         self.running = False
-        self.server = None
+        self.transport: asyncio.DatagramTransport = None
 
-    def start(self):
-        self.running = True
-        if self.server is not None:
+        self.commands = 0
+        self.rejected = 0
+        self.malformed = 0
+
+    async def start(self):
+        if self.transport is not None:
             print("OSC server already running")
             return
-        parser = argparse.ArgumentParser()
-        parser.add_argument("--ip",
-            default=self.ip, help="The ip to listen on")
-        parser.add_argument("--port",
-            type=int, default=self.port, help="The port to listen on")
-        args = parser.parse_args()
+        self.running = True
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(self.ip, self.port))
+        print(f"Serving OSC on {self.ip}:{self.port}")
 
-        def handler(name: str, *args):
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, address: tuple[str, int]):
+        if not self.running:
+            return
+        try:
+            messages = decode_packet(data)
+        except OSCDecodeError as e:
+            self.malformed += 1
+            print(f"Malformed OSC packet from {address[0]}: {e}")
+            return
+        for path, args in messages:
             try:
-                if not self.running:
-                    return
-                name = name.replace(",", "")
-                print(name, args)
-                self.queue.put(Q.System_Command(
-                    command=name,
-                ))
-            except Exception as e:
-                print(f"Error handling OSC message: {e}")
+                command = self.router.parse(path, args)
+            except CommandError as e:
+                self.rejected += 1
+                print(f"Rejected OSC command {path}: {e}")
+                continue
+            command.source = address
+            self.commands += 1
+            self.queue.put(command)
 
-        dispatcher = Dispatcher()
-        dispatcher.map("/*", handler)
+    def error_received(self, e: Exception):
+        print(f"OSC socket error: {e}")
 
-        self.server = osc_server.AsyncIOOSCUDPServer(
-            (args.ip, args.port),
-            dispatcher,
-            asyncio.get_event_loop()
-        )
-        print(f"Serving OSC on {self.ip}:{self.port}")
-        asyncio.create_task(self.server.create_serve_endpoint())
+    def to_dict(self) -> OSCStats:
+        return OSCStats(commands=self.commands, rejected=self.rejected, malformed=self.malformed)
 
     def stop(self):
         self.running = False
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
 
-    def restart(self):
+    async def restart(self):
         self.stop()
-        self.start()
+        await self.start()
+
+
+if __name__ == '__main__':
+    import socket
+    import threading
+    import time
+    from pythonosc.dispatcher import Dispatcher
+    from pythonosc.osc_message import OscMessage
+    from pythonosc.osc_server import ThreadingOSCUDPServer
+    from router import number
+
+    DECODES = 100_000
+    DATAGRAMS = 50_000
+    WINDOW = 125 # Datagrams in flight, small enough for the socket buffer
+    MESSAGES = [
+        encode_message('/lectern/move/0.5'),
+        encode_message('/lectern/move', 0.25),
+        encode_message('/lectern/go_to', 12.5, 'in', 4.0),
+        encode_message('/lectern/go_to/12/in/5'),
+        encode_message('/teleprompter/next', 1),
+    ]
+
+    def bench_decode(decode) -> float:
+        start = time.perf_counter()
+        for i in range(DECODES):
+            decode(MESSAGES[i % len(MESSAGES)])
+        return time.perf_counter() - start
+
+    def decode_pythonosc(data: bytes):
+        message = OscMessage(data)
+        return message.address, message.params
+
+    pythonosc = bench_decode(decode_pythonosc)
+    native = bench_decode(decode_packet)
+    for name, elapsed in (('python-osc OscMessage', pythonosc), ('decode_packet', native)):
+        print(f'Decode, {name + ":":23}{DECODES / elapsed:10.0f} messages/s')
+
+    class Sink:
+        '''
+        Stands in for the SystemQueue, counting what arrives.
+        '''
+        def __init__(self):
+            self.count = 0
+
+        def put(self, command: Q.System_Command):
+            self.count += 1
+
+    router = Router()
+    router.add('lectern', 'move', print, (number,), coalesce=True)
+    router.add('lectern', 'go_to', print, (number, 'in', number), required=1, coalesce=True)
+    router.add('teleprompter', None, print, None, required=0)
+
+    # Datagrams are sent in windows and each window waits to be handled, so this measures how fast an endpoint keeps
+    # up rather than how many datagrams the kernel drops. Sending is included in the time.
+    def bench_threading() -> tuple[int, float]:
+        sink = Sink()
+        lock = threading.Lock()
+
+        def handler(name: str, *args):
+            # What the threaded server did per message, minus the print
+            name = name.replace(",", "")
+            command = router.parse(name, args)
+            with lock:
+                sink.put(command)
+
+        dispatcher = Dispatcher()
+        dispatcher.map("/*", handler)
+        server = ThreadingOSCUDPServer(('127.0.0.1', 0), dispatcher)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        start = time.perf_counter()
+        for sent in range(0, DATAGRAMS, WINDOW):
+            for i in range(sent, sent + WINDOW):
+                sender.sendto(MESSAGES[i % len(MESSAGES)], server.server_address)
+            deadline = time.perf_counter() + 1
+            while sink.count < sent + WINDOW and time.perf_counter() < deadline:
+                time.sleep(0)
+        elapsed = time.perf_counter() - start
+        sender.close()
+        server.shutdown()
+        server.server_close()
+        return sink.count, elapsed
+
+    async def bench_endpoint() -> tuple[int, float]:
+        sink = Sink()
+        server = OSC_Server(OSC_Config(ip='127.0.0.1', port=0, queue=sink, router=router))
+        await server.start()
+        address = server.transport.get_extra_info('sockname')
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        start = time.perf_counter()
+        for sent in range(0, DATAGRAMS, WINDOW):
+            for i in range(sent, sent + WINDOW):
+                sender.sendto(MESSAGES[i % len(MESSAGES)], address)
+            deadline = time.perf_counter() + 1
+            while sink.count < sent + WINDOW and time.perf_counter() < deadline:
+                await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        sender.close()
+        server.stop()
+        return sink.count, elapsed
+
+    for name, (count, elapsed) in (('ThreadingOSCUDPServer', bench_threading()), ('OSC_Server', asyncio.run(bench_endpoint()))):
+        print(f'Endpoint, {name + ":":21}{count / elapsed:10.0f} commands/s decoded, parsed and queued ({DATAGRAMS - count} of {DATAGRAMS} lost)')
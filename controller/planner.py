@@ -0,0 +1,225 @@
+'''
+fileoverview: Motion planning for position moves. A move is planned as a jerk limited S-curve: seven constant jerk
+segments (jerk up, constant acceleration, jerk down, cruise, and the mirror image to stop) that respect the velocity,
+acceleration and jerk limits of the lectern. The controller tracks the profile with velocity feedforward plus PID
+feedback on the position error, instead of driving the raw error to a target.
+
+A move starts at the lectern's current velocity, so a new target that arrives mid-move blends into the move in
+progress. If the lectern is moving away from the new target, or too fast to stop before it, the profile first brings
+it to rest and then moves back.
+
+Timed moves ("arrive at X in N seconds") use the same profile shape, slowed down until it takes exactly the requested
+time, and are sampled into a SetpointTable for the whole move when the command arrives so the control loop only has to
+index into it.
+'''
+
+import bisect
+import math
+from typing import TypedDict, NamedTuple
+import numpy as np
+
+
+class MotionLimits(TypedDict):
+    velocity: float # in/s
+    acceleration: float # in/s^2
+    jerk: float # in/s^3
+
+
+class Setpoint(NamedTuple):
+    position: float
+    velocity: float
+    acceleration: float
+
+
+def acceleration_phase(velocity: float, limits: MotionLimits) -> tuple[float, float, float]:
+    '''
+    Timing of a jerk limited ramp from rest to a velocity.
+
+    :return: (jerk time, constant acceleration time, distance covered)
+    '''
+    if velocity <= 0:
+        return 0.0, 0.0, 0.0
+    jerk = limits['jerk']
+    peak = min(limits['acceleration'], math.sqrt(velocity * jerk))
+    t_jerk = peak / jerk
+    t_const = max(velocity / peak - t_jerk, 0)
+    distance = velocity * (2 * t_jerk + t_const) / 2
+    return t_jerk, t_const, distance
+
+
+def velocity_change(start: float, end: float, limits: MotionLimits) -> tuple[float, float, float]:
+    '''
+    Timing of a jerk limited ramp between two speeds in the same direction.
+
+    :return: (jerk time, constant acceleration time, distance covered)
+    '''
+    t_jerk, t_const, distance = acceleration_phase(abs(end - start), limits)
+    return t_jerk, t_const, distance + min(start, end) * (2 * t_jerk + t_const)
+
+
+def approach(distance: float, speed: float, limits: MotionLimits) -> tuple[float, list[tuple[float, float]]]:
+    '''
+    Segments that cover distance starting at speed and end at rest, for a speed that can stop within the distance.
+
+    :return: (peak speed, [(duration, jerk), ...]) with positive speeds and jerks towards the end
+    '''
+    def travel(peak: float) -> float:
+        return velocity_change(speed, peak, limits)[2] + velocity_change(peak, 0, limits)[2]
+
+    peak = limits['velocity']
+    if travel(peak) > distance:
+        # Too short to reach full speed, find the peak velocity that covers exactly the distance
+        fits, too_far = speed, peak
+        for _ in range(50):
+            mid = (fits + too_far) / 2
+            if travel(mid) > distance:
+                too_far = mid
+            else:
+                fits = mid
+        peak = fits
+
+    up_jerk, up_const, up = velocity_change(speed, peak, limits)
+    down_jerk, down_const, down = velocity_change(peak, 0, limits)
+    t_cruise = max(distance - up - down, 0) / peak if peak > 0 else 0
+    jerk = limits['jerk'] if peak >= speed else -limits['jerk']
+    return peak, [
+        (up_jerk, jerk), (up_const, 0), (up_jerk, -jerk),
+        (t_cruise, 0),
+        (down_jerk, -limits['jerk']), (down_const, 0), (down_jerk, limits['jerk']),
+    ]
+
+
+class Profile:
+    '''
+    S-curve from start, moving at velocity, to rest at end. sample(t) gives the setpoint t seconds into the move.
+    '''
+    def __init__(self, start: float, end: float, limits: MotionLimits, velocity: float = 0.0):
+        self.start = start
+        self.end = end
+        self.start_velocity = velocity
+        self.limits = limits
+        direction = 1 if end >= start else -1
+        speed = velocity * direction # Towards the end
+        segments = []
+        origin = start
+        if speed < 0 or acceleration_phase(abs(speed), limits)[2] > abs(end - start):
+            # Moving away from the end, or too fast to stop before it: come to rest first, then move back
+            heading = 1 if velocity > 0 else -1
+            t_jerk, t_const, distance = acceleration_phase(abs(velocity), limits)
+            jerk = limits['jerk'] * heading
+            segments += [(t_jerk, -jerk), (t_const, 0), (t_jerk, jerk)]
+            origin = start + distance * heading
+            direction = 1 if end >= origin else -1
+            speed = 0.0
+        peak, approach_segments = approach(abs(end - origin), speed, limits)
+        segments += [(duration, jerk * direction) for duration, jerk in approach_segments]
+        self.peak_velocity = peak * direction
+
+        # Integrate each segment once so sample() only has to evaluate one cubic
+        self.times = []
+        self.states = []
+        self.jerks = []
+        t, p, v, a = 0.0, start, velocity, 0.0
+        for duration, j in segments:
+            if duration <= 0:
+                continue
+            self.times.append(t)
+            self.states.append((p, v, a))
+            self.jerks.append(j)
+            p += v * duration + a * duration ** 2 / 2 + j * duration ** 3 / 6
+            v += a * duration + j * duration ** 2 / 2
+            a += j * duration
+            t += duration
+        self.duration = t
+
+    def sample(self, t: float) -> Setpoint:
+        if t >= self.duration or not self.times:
+            return Setpoint(self.end, 0.0, 0.0)
+        if t <= 0:
+            return Setpoint(self.start, self.start_velocity, 0.0)
+        i = bisect.bisect_right(self.times, t) - 1
+        p, v, a = self.states[i]
+        j = self.jerks[i]
+        dt = t - self.times[i]
+        return Setpoint(
+            p + v * dt + a * dt ** 2 / 2 + j * dt ** 3 / 6,
+            v + a * dt + j * dt ** 2 / 2,
+            a + j * dt,
+        )
+
+    @classmethod
+    def timed(cls, start: float, end: float, duration: float, limits: MotionLimits, velocity: float = 0.0) -> 'Profile':
+        '''
+        Profile from start, moving at velocity, to rest at end that takes exactly duration seconds.
+
+        :raises ValueError: if the move cannot be made that fast within the limits.
+        '''
+        if duration <= 0:
+            raise ValueError(f'Move duration must be positive, got {duration}s')
+        fastest = cls(start, end, limits, velocity)
+        if fastest.duration > duration:
+            raise ValueError(
+                f'Cannot move {abs(end - start):.2f}in in {duration:.2f}s, it takes at least {fastest.duration:.2f}s '
+                f'at {limits["velocity"]:.2f}in/s'
+            )
+        if fastest.duration == 0:
+            return fastest
+
+        # Duration only gets longer as the cruise velocity drops, so bisect for the velocity that takes exactly as long
+        low, high = 0.0, limits['velocity']
+        for _ in range(60):
+            mid = (low + high) / 2
+            if cls(start, end, MotionLimits(limits, velocity=mid), velocity).duration > duration:
+                low = mid
+            else:
+                high = mid
+        return cls(start, end, MotionLimits(limits, velocity=high), velocity)
+
+    def table(self, dt: float) -> 'SetpointTable':
+        return SetpointTable(self, dt)
+
+
+class SetpointTable:
+    '''
+    A profile sampled every dt seconds up front, so following it is one index per tick.
+    '''
+    def __init__(self, profile: Profile, dt: float):
+        self.start = profile.start
+        self.end = profile.end
+        self.duration = profile.duration
+        self.peak_velocity = profile.peak_velocity
+        self.dt = dt
+
+        t = np.minimum(np.arange(int(math.ceil(profile.duration / dt)) + 1) * dt, profile.duration)
+        if profile.times:
+            times = np.array(profile.times)
+            states = np.array(profile.states)
+            jerks = np.array(profile.jerks)
+            i = np.searchsorted(times, t, side='right') - 1
+            np.clip(i, 0, len(times) - 1, out=i)
+            offset = t - times[i]
+            p, v, a, j = states[i, 0], states[i, 1], states[i, 2], jerks[i]
+            self.positions = p + v * offset + a * offset ** 2 / 2 + j * offset ** 3 / 6
+            self.velocities = v + a * offset + j * offset ** 2 / 2
+            self.accelerations = a + j * offset
+        else:
+            self.positions = np.full(len(t), profile.end)
+            self.velocities = np.zeros(len(t))
+            self.accelerations = np.zeros(len(t))
+        # The last entry is the end of the move, exactly
+        self.positions[-1] = profile.end
+        self.velocities[-1] = 0.0
+        self.accelerations[-1] = 0.0
+        # Plain lists index faster than arrays from the control loop
+        self.rows = list(zip(self.positions.tolist(), self.velocities.tolist(), self.accelerations.tolist()))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def sample(self, t: float) -> Setpoint:
+        i = int(t / self.dt + 0.5)
+        if i < 0:
+            i = 0
+        elif i >= len(self.rows):
+            i = len(self.rows) - 1
+        return Setpoint(*self.rows[i])
@@ -1,10 +1,4 @@
-import pigpio
-
-# Initialize pigpio
-pi = pigpio.pi()
-
-if not pi.connected:
-    raise RuntimeError("pigpio daemon not running or connection failed!")
+import hardware
 
 # Set up a GPIO pin for PWM
 # PWM_PIN = 18  # Use GPIO 18 (hardware PWM-capable)
@@ -15,18 +9,21 @@ class PWM:
     def __init__(self, pin: int, frequency: int):
         self.pin = pin
         self.frequency = frequency
-        pi.set_PWM_frequency(self.pin, self.frequency)
-        pi.set_PWM_dutycycle(self.pin, 0)
+        self.backend = hardware.get_backend()
+        self.backend.setup_output(self.pin)
+        self.pwm = self.backend.pwm(self.pin, self.frequency)
+        self.pwm.start(0)
 
+    # Duty cycles are 0-255 like pigpio, the backend works in percent
     def ChangeDutyCycle(self, duty_cycle: int):
         print(f"Setting duty cycle to {duty_cycle}/255")
-        pi.set_PWM_dutycycle(self.pin, duty_cycle)
+        self.pwm.ChangeDutyCycle(duty_cycle / 255 * 100)
 
     def stop(self):
-        pi.set_PWM_dutycycle(self.pin, 0)
+        self.pwm.ChangeDutyCycle(0)
 
     def start(self, duty_cycle: int):
-        pi.set_PWM_dutycycle(self.pin, duty_cycle)
+        self.pwm.ChangeDutyCycle(duty_cycle / 255 * 100)
 
 # # Set PWM frequency
 # pi.set_PWM_frequency(PWM_PIN, FREQUENCY)
@@ -0,0 +1,287 @@
+'''
+fileoverview: Flight recorder. Every control tick appends one record (positions, switches, speeds, PID terms, states)
+to a ring of memory-mapped NumPy segment files, so after a move goes wrong in a show the last half hour can be looked
+at tick by tick. The segments are preallocated and mapped when the recorder opens, so an append is a single
+structured array store into the page cache, with no allocation and no system call of its own. The kernel writes the
+pages back in its own time, and a store can now and then stall behind that writeback: appends take a few us, but the
+worst seen on the simulator was about 1ms. A finished segment is flushed on a worker thread and the ring moves on to
+the next one.
+
+Dump the last minutes over the TCP control channel, /dump_recording/<minutes>, and read the file with numpy:
+    data = numpy.load('flight-20261017-201500.123.npz') # In RECORDER_DIR, ~/.local/share/lectern/recordings by default
+    records = data['records'] # RECORD, oldest first
+    up = records['switches'] & data['switch_masks'][list(data['switch_names']).index('main_up')] != 0
+Enum codes are the enum values, see telemetry_decoder.ENUMS. The segments of the previous run are kept as
+previous-segment-*.npy until the next start.
+
+Run this file to benchmark appends, rotation and dumps on the simulator:
+    python3 recorder.py
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import time
+import numpy as np
+import clock
+from router import CommandError, number
+
+# A data directory outside the checkout, see main.py for the one the lectern runs with
+RECORDER_DIR = os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'lectern', 'recordings')
+RECORDER_MINUTES = 30 # Kept on disk, in SEGMENT_SECONDS segments
+SEGMENT_SECONDS = 60
+DUMP_MINUTES = 5 # Dumped when the command does not say
+
+RECORD = np.dtype([
+    ('seq', '<u8'), # 1 for the first record of a run, 0 is an empty slot
+    ('timestamp', '<f8'), # clock.now()
+    ('wall_time', '<f8'), # time.time(), to line records up with show logs
+    ('dt', '<f4'), # s the tick took
+    ('position_raw', '<f4'), # in, latest TOF sample
+    ('position', '<f4'), # in, filtered TOF position
+    ('estimate', '<f4'), # in, Kalman position
+    ('velocity', '<f4'), # in/s, Kalman velocity
+    ('setpoint', '<f4'), # in, position the profile wants now, NaN when not tracking one
+    ('switches', '<u8'), # Debounced GPIO levels, one bit per pin (see switch_masks in a dump)
+    ('target_speed', '<f4'),
+    ('motor_speed', '<f4'),
+    ('speed_multiplier', '<f4'),
+    ('p', '<f4'), # PID terms of the last correction
+    ('i', '<f4'),
+    ('d', '<f4'),
+    ('state', 'u1'), # Enum values
+    ('motor_state', 'u1'),
+    ('global_state', 'u1'),
+    ('calibration_state', 'u1'),
+])
+
+
+def dump_minutes(value) -> float:
+    value = number(value)
+    if value <= 0:
+        raise CommandError(f'Minutes to dump have to be more than 0, got {value}')
+    return value
+
+
+class FlightRecorder:
+    def __init__(self, directory: str = RECORDER_DIR, tick_speed: float = 15, minutes: float = RECORDER_MINUTES):
+        '''
+        :param tick_speed: ms per control tick, to size the segments
+        :param minutes: How much to keep
+        '''
+        self.directory = directory
+        self.segment_size = math.ceil(SEGMENT_SECONDS * 1000 / tick_speed)
+        self.segment_count = max(2, math.ceil(minutes * 60 / SEGMENT_SECONDS))
+        self.segments: list[np.memmap] = []
+        self.segment: np.memmap = None # Being written
+        self.index = 0 # Of the segment being written
+        self.offset = 0 # Next record in it
+        self.seq = 0
+        self.enabled = False
+        self.worker: ThreadPoolExecutor = None # Flushes and dumps, one at a time, off the event loop
+        self.switch_masks: dict[str, int] = {}
+        self.rotations = 0
+        self.dumps = 0
+
+    def path(self, index: int, prefix: str = '') -> str:
+        return os.path.join(self.directory, f'{prefix}segment-{index:03}.npy')
+
+    def open(self):
+        '''
+        Map the segments, keeping the previous run's as previous-segment-*.npy. The recorder stays off if the files
+        cannot be created: it must never keep the lectern from running.
+        '''
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for index in range(self.segment_count):
+                if os.path.exists(self.path(index)):
+                    os.replace(self.path(index), self.path(index, 'previous-'))
+                segment = np.lib.format.open_memmap(self.path(index), mode='w+', dtype=RECORD, shape=(self.segment_size,))
+                # Touch every page now so appends never fault in a new one, and mark every slot empty
+                segment[:] = np.zeros(1, RECORD)
+                self.segments.append(segment)
+        except OSError as e:
+            print(f"Flight recorder disabled, cannot create its segments in {self.directory}: {e}")
+            self.segments = []
+            return
+        self.segment = self.segments[0]
+        self.index = 0
+        self.offset = 0
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recorder')
+        self.worker.submit(lambda: None).result() # Start its thread now rather than on the first rotation
+        self.enabled = True
+        size = self.segment_count * self.segment_size * RECORD.itemsize / 1e6
+        print(f"Flight recorder in {self.directory}: {self.segment_count} segments of {SEGMENT_SECONDS}s, {size:.1f}MB")
+
+    def append(self, lectern):
+        '''
+        Record the tick that just ran. Called at the end of every tick of Lectern.event_loop.
+        '''
+        if not self.enabled:
+            return
+        frame = lectern.bus.latest
+        motor = lectern.motor
+        estimate = lectern.estimate
+        tracking = lectern.profile is not None
+        p, i, d = lectern.pid.terms if tracking else (0.0, 0.0, 0.0)
+        self.seq += 1
+        self.segment[self.offset] = (
+            self.seq, clock.now(), time.time(), lectern.dt,
+            frame.position_raw, frame.position, estimate['position'], estimate['velocity'],
+            lectern.setpoint.position if tracking else math.nan,
+            frame.switches.bits,
+            lectern.target_motor_speed, motor.speed, lectern.speed_multiplier,
+            p, i, d,
+            lectern.state.value, motor.state.value, lectern.global_state.value, lectern.calibration_state.value,
+        )
+        if not self.switch_masks:
+            self.switch_masks = frame.switches.masks
+        self.offset += 1
+        if self.offset == self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        '''
+        Move on to the next segment. The finished one is flushed to disk on a worker thread.
+        '''
+        finished = self.segment
+        self.index = (self.index + 1) % self.segment_count
+        self.segment = self.segments[self.index]
+        self.offset = 0
+        self.rotations += 1
+        self.worker.submit(finished.flush)
+
+    def snapshot(self, since: float, last: int) -> np.ndarray:
+        '''
+        Copy the records from since on, oldest first. Runs on the recorder thread while appends go on, so only records
+        up to last are kept: later ones may be half written.
+
+        :param since: clock.now() of the oldest record wanted
+        :param last: seq of the newest record wanted
+        '''
+        index = self.index
+        parts = []
+        for step in range(self.segment_count):
+            segment = self.segments[(index - step) % self.segment_count]
+            records = np.array(segment) # Copy before filtering, the ring keeps moving
+            parts.append(records[(records['seq'] > 0) & (records['seq'] <= last) & (records['timestamp'] >= since)])
+            if step > 0 and (records['seq'][0] == 0 or records['timestamp'][0] < since):
+                break # Nothing older in the ring that is still wanted
+        records = np.concatenate(parts[::-1])
+        return records[np.argsort(records['seq'], kind='stable')]
+
+    async def dump(self, minutes: float = DUMP_MINUTES) -> str:
+        '''
+        Write the last minutes to an .npz file in the recorder's directory.
+
+        :return: Its path, None if the recorder is off
+        '''
+        if not self.enabled:
+            print("Flight recorder is off, nothing to dump")
+            return None
+        since = clock.now() - minutes * 60
+        stamp = time.time()
+        name = time.strftime('flight-%Y%m%d-%H%M%S', time.localtime(stamp)) + f'.{int(stamp * 1000) % 1000:03}'
+        records, path = await asyncio.get_running_loop().run_in_executor(self.worker, self.write_dump, since, self.seq, name)
+        self.dumps += 1
+        print(f"Dumped {len(records)} ticks ({minutes:g} minutes) of flight recording to {path}")
+        return path
+
+    def write_dump(self, since: float, last: int, name: str) -> tuple[np.ndarray, str]:
+        '''
+        :param name: Of the file, without the extension. A dump never overwrites another one: if the name is taken a
+        number is added to it.
+
+        :return: (the records, the path they were written to)
+        '''
+        records = self.snapshot(since, last)
+        names = list(self.switch_masks)
+        file, path = self.create(name)
+        with file:
+            np.savez(
+                file,
+                records=records,
+                switch_names=np.array(names),
+                switch_masks=np.array([self.switch_masks[name] for name in names], dtype='<u8'),
+            )
+        return records, path
+
+    def create(self, name: str):
+        '''
+        :return: (the new file open for writing, its path)
+        '''
+        path = os.path.join(self.directory, f'{name}.npz')
+        number = 1
+        while True:
+            try:
+                return open(path, 'xb'), path
+            except FileExistsError:
+                number += 1
+                path = os.path.join(self.directory, f'{name}-{number}.npz')
+
+    def close(self):
+        self.enabled = False
+        if self.worker is not None:
+            self.worker.shutdown()
+            self.worker = None
+        for segment in self.segments:
+            segment.flush()
+        self.segments = []
+        self.segment = None
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import simulate
+
+    TICKS = 20_000 # Appends timed, about 5 minutes of ticks
+    DUMPS = (1, 5) # minutes
+
+    async def bench(directory: str) -> dict:
+        lectern, backend = simulate.make_lectern()
+        recorder = FlightRecorder(directory, lectern.tick_speed, minutes=10)
+        recorder.open()
+        await lectern.start()
+        await asyncio.sleep(3) # start_up jog
+
+        # Time the appends the event loop makes, with the lectern moving back and forth
+        timings = []
+        append = recorder.append
+        def timed(lectern):
+            start = time.perf_counter()
+            append(lectern)
+            timings.append(time.perf_counter() - start)
+        lectern.recorder = recorder
+        recorder.append = timed
+        while len(timings) < TICKS:
+            if lectern.profile is None:
+                lectern.go_to(18 if lectern.estimate['position'] < 12 else 7)
+            await asyncio.sleep(0.5)
+        recorder.append = append
+        lectern.recorder = None
+
+        dumps = {}
+        for minutes in DUMPS:
+            start = time.perf_counter()
+            path = await recorder.dump(minutes)
+            dumps[minutes] = (time.perf_counter() - start, os.path.getsize(path), len(np.load(path)['records']))
+        data = np.load(path)
+        records = data['records']
+        assert np.all(np.diff(records['seq']) == 1), 'Ticks missing or out of order'
+        await lectern.cleanup()
+        recorder.close()
+        return timings, recorder.rotations, dumps
+
+    directory = tempfile.mkdtemp()
+    try:
+        timings, rotations, dumps = clock.run(bench(directory), virtual=True)
+    finally:
+        shutil.rmtree(directory)
+    timings.sort()
+    print()
+    print(f'Append ({len(timings)} ticks, {rotations} rotations): median {timings[len(timings) // 2] * 1e6:.1f}us, '
+          f'99th percentile {timings[len(timings) * 99 // 100] * 1e6:.1f}us, max {timings[-1] * 1e6:.1f}us')
+    for minutes, (elapsed, size, count) in dumps.items():
+        print(f'Dump of {minutes} minutes: {count} ticks, {size / 1e6:.2f}MB in {elapsed * 1000:.1f}ms (on the recorder thread)')
@@ -0,0 +1,250 @@
+'''
+fileoverview: Table driven command routing. Every command a channel accepts is declared once as a Route keyed by
+(target, verb), with a schema for its arguments. Incoming paths are parsed against the table at ingress (in the OSC
+thread or the TCP handler), so a command is looked up, split and converted exactly once and anything unknown or
+malformed is rejected before it reaches a queue. Dispatch is then a single call through the route the command
+already carries.
+
+    /lectern/move/0.5           target lectern, verb move, args (0.5,)
+    /lectern/go_to/12/in/5      target lectern, verb go_to, args (12.0, 5.0)
+    /system_reboot              no target prefix, so target all
+
+The (target, verb, route) lookup of a path is cached, so the fixed addresses a show controller sends over and over
+are only ever split once.
+
+Run this file to benchmark parse and dispatch:
+    python3 router.py
+'''
+
+import asyncio
+import math
+from typing import Any, Callable
+from Q import System_Command
+
+TARGETS = ('lectern', 'teleprompter')
+ANY_VERB = None # Register a route under this verb to catch every verb of a target
+PATH_CACHE_SIZE = 1024 # Paths whose lookup is kept, the cache starts over when it is full
+
+
+class CommandError(ValueError):
+    pass
+
+
+def number(value) -> float:
+    '''
+    A finite float, from a path segment or a typed OSC argument.
+    '''
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise CommandError(f'{value!r} is not a number')
+    if not math.isfinite(value):
+        raise CommandError(f'{value!r} is not a finite number')
+    return value
+
+
+class Route:
+    '''
+    :param schema: One entry per argument: a converter (str or typed value in, value out, CommandError if invalid),
+    or a literal string the argument has to match, which is checked and then left out of the parsed args.
+    :param required: How many schema entries must be present, all of them by default.
+    :param priority: Safety command, skips the queues (see Q.SystemQueue).
+    :param coalesce: Setpoint command, a newer one replaces a queued one (see Q.SystemQueue).
+    :param source: The handler gets the sender's address (System_Command.source) as its first argument.
+    :param motion: Drives the lectern, so a safety command cancels it in flight and drops it from the queues (see
+    System.preempt).
+    '''
+    __slots__ = ('target', 'verb', 'handler', 'schema', 'required', 'priority', 'coalesce', 'source', 'motion', 'is_async', 'arity', 'converters', 'literals')
+
+    def __init__(self, target: str, verb: str, handler: Callable, schema: tuple = (), required: int = None, priority: bool = False, coalesce: bool = False, source: bool = False, motion: bool = False):
+        self.target = target
+        self.verb = verb
+        self.handler = handler
+        self.schema = schema
+        if required is None:
+            required = len(schema) if schema is not None else 0
+        self.required = required
+        self.priority = priority
+        self.coalesce = coalesce
+        self.source = source
+        self.motion = motion
+        self.is_async = asyncio.iscoroutinefunction(handler)
+        # The schema split up front, so parse() does not have to look at every entry of it every time
+        self.arity = len(schema) if schema is not None else None
+        self.converters = tuple((index, spec) for index, spec in enumerate(schema or ()) if not isinstance(spec, str))
+        self.literals = tuple((index, spec) for index, spec in enumerate(schema or ()) if isinstance(spec, str))
+
+    def parse(self, raw: tuple) -> tuple:
+        count = len(raw)
+        if count < self.required:
+            raise CommandError(f'{self.target}/{self.verb} needs at least {self.required} arguments, got {count}')
+        if self.arity is None:
+            return tuple(raw) # Passed through as is
+        if count == 0:
+            return ()
+        if count > self.arity:
+            raise CommandError(f'{self.target}/{self.verb} takes at most {self.arity} arguments, got {count}')
+        for index, literal in self.literals:
+            if index < count and raw[index] != literal:
+                raise CommandError(f'expected {literal!r}, got {raw[index]!r}')
+        args = []
+        for index, convert in self.converters:
+            if index < count:
+                args.append(convert(raw[index]))
+        return tuple(args)
+
+
+class Router:
+    def __init__(self):
+        self.routes: dict[tuple[str, str], Route] = {}
+        self.paths: dict[str, tuple[str, str, Route, tuple]] = {} # Lookups of the paths seen so far, see find()
+
+    def add(self, target: str, verb: str, handler: Callable, schema: tuple = (), **options) -> Route:
+        '''
+        Register a route. schema=None passes the arguments through unparsed, as strings. A route registered under
+        ANY_VERB gets the verb as its first argument.
+        '''
+        route = Route(target, verb, handler, schema, **options)
+        self.routes[(target, verb)] = route
+        self.paths.clear()
+        return route
+
+    def find(self, path: str) -> tuple[str, str, Route, tuple]:
+        '''
+        Split a command path and find its route.
+
+        :return: (target, verb, route, the path segments that are arguments)
+        :raises CommandError: if there is no route for the path.
+        '''
+        parts = path.strip(' \t\r\n/').split('/')
+        target = parts[0]
+        start = 1 # Of the verb
+        if target not in TARGETS:
+            target = 'all'
+            start = 0
+        if len(parts) <= start or not parts[start]:
+            raise CommandError(f'No command in {path!r}')
+        verb = parts[start]
+        route = self.routes.get((target, verb))
+        if route is None:
+            route = self.routes.get((target, ANY_VERB))
+            if route is None:
+                raise CommandError(f'Unknown command {target}/{verb}')
+            return target, verb, route, tuple(parts[start:])
+        return target, verb, route, tuple(parts[start + 1:])
+
+    def parse(self, path: str, args: tuple = ()) -> System_Command:
+        '''
+        Parse a command path, plus any typed arguments sent with it (OSC), against the routing table.
+
+        :raises CommandError: if the command is unknown or its arguments do not match the route's schema.
+        '''
+        found = self.paths.get(path)
+        if found is None:
+            found = self.find(path)
+            if len(self.paths) >= PATH_CACHE_SIZE:
+                self.paths.clear() # The paths that are still sent often come straight back
+            self.paths[path] = found
+        target, verb, route, raw = found
+        if args:
+            raw += tuple(args)
+        return System_Command(path, target, verb, route.parse(raw), route)
+
+    async def dispatch(self, command: System_Command) -> Any:
+        route = command.route
+        args = (command.source, *command.args) if route.source else command.args
+        if route.is_async:
+            return await route.handler(*args)
+        return route.handler(*args)
+
+
+if __name__ == '__main__':
+    import time
+
+    COMMANDS = 200_000
+    PATHS = ['/lectern/move/0.5', '/lectern/go_to/12.5/in/4', '/lectern/bump/-1', '/lectern/move/-0.25', '/teleprompter/next']
+
+    # The previous pipeline: a command object that split its path in the constructor, then an awaited if-chain
+    # with float() and NaN checks per handler
+    class LegacyCommand:
+        def __init__(self, command: str):
+            self.command = command
+            self.args = command.split('/')[1:]
+            self.who = 'all'
+            if self.args[0] == 'lectern':
+                self.who = 'lectern'
+                self.args = self.args[1:]
+            elif self.args[0] == 'teleprompter':
+                self.who = 'teleprompter'
+                self.args = self.args[1:]
+
+    async def legacy_dispatch(command: LegacyCommand):
+        args = command.args
+        if command.who == 'lectern':
+            if args[0] == 'move':
+                speed = float(args[1])
+                if speed != speed:
+                    return
+                return sink(speed)
+            if args[0] == 'calibrate':
+                return sink()
+            if args[0] == 'go_to':
+                position = float(args[1])
+                if position != position:
+                    return
+                if len(args) < 3:
+                    return sink(position)
+                if args[2] == 'in':
+                    duration = float(args[3])
+                    if duration != duration:
+                        return
+                    return sink(position, duration)
+                return sink(position)
+            if args[0] == 'bump':
+                distance = float(args[1])
+                if distance != distance:
+                    return
+                return sink(distance)
+        elif command.who == 'teleprompter':
+            return sink(*args)
+
+    def sink(*args):
+        return args
+
+    router = Router()
+    router.add('lectern', 'move', sink, (number,), coalesce=True)
+    router.add('lectern', 'go_to', sink, (number, 'in', number), required=1, coalesce=True)
+    router.add('lectern', 'bump', sink, (number,))
+    router.add('lectern', 'calibrate', sink)
+    router.add('lectern', 'stop', sink, priority=True)
+    router.add('teleprompter', ANY_VERB, sink, None, required=0)
+
+    def bench(parse, dispatch, paths: list[str]) -> tuple[float, float]:
+        '''
+        :return: (s spent parsing at ingress, s spent dispatching on the event loop)
+        '''
+        start = time.perf_counter()
+        commands = [parse(path) for path in paths]
+        ingress = time.perf_counter() - start
+
+        async def run():
+            start = time.perf_counter()
+            for command in commands:
+                await dispatch(command)
+            return time.perf_counter() - start
+        return ingress, asyncio.run(run())
+
+    repeated = [PATHS[i % len(PATHS)] for i in range(COMMANDS)]
+    # Every path different, so none of them is in the lookup cache
+    unique = [f'/lectern/move/{i / COMMANDS}' if i % 2 else f'/lectern/go_to/{i / COMMANDS}/in/4' for i in range(COMMANDS)]
+    results = {
+        'Split + if-chain': bench(LegacyCommand, legacy_dispatch, repeated),
+        'Routing table + schemas': bench(router.parse, router.dispatch, repeated),
+        'Split + if-chain, new paths': bench(LegacyCommand, legacy_dispatch, unique),
+        'Routing table, new paths': bench(router.parse, router.dispatch, unique),
+    }
+
+    # Ingress runs on the OSC thread or in the TCP handler, dispatch on the event loop next to the control loop
+    print(f'{"":28} {"ingress":>10} {"event loop":>12} {"total":>10}')
+    for name, (ingress, loop) in results.items():
+        print(f'{name:28} {ingress / COMMANDS * 1e6:8.2f}us {loop / COMMANDS * 1e6:10.2f}us {(ingress + loop) / COMMANDS * 1e6:8.2f}us per command')
@@ -0,0 +1,95 @@
+import asyncio
+import clock
+from enum import Enum, auto
+from typing import TypedDict
+
+
+class TickPolicy(Enum):
+    CATCH_UP = auto() # Run missed ticks back to back until we are on the grid again
+    SKIP = auto() # Drop missed ticks and realign to the next deadline
+
+    def to_dict(self):
+        return self.name
+
+
+class TickStats(TypedDict):
+    ticks: int
+    missed: int
+    skipped: int
+    last_dt: float
+    jitter: float
+    max_jitter: float
+
+
+# Exponential smoothing factor used for the jitter average
+JITTER_SMOOTHING = 0.05
+
+
+class TickScheduler:
+    '''
+    Runs a loop against absolute monotonic deadlines instead of sleeping a fixed
+    amount after each tick. The time it takes to run a tick is absorbed by the
+    schedule, so the loop does not drift.
+    '''
+    def __init__(self, tick_speed: float, policy: TickPolicy = TickPolicy.SKIP, max_catch_up: int = 5):
+        self.period = tick_speed / 1000
+        self.policy = policy
+        self.max_catch_up = max_catch_up # Deadlines we are allowed to chase before realigning anyway
+
+        self.deadline = None
+        self.last_tick = None
+        self.dt = self.period
+
+        self.ticks = 0
+        self.missed = 0
+        self.skipped = 0
+        self.jitter = 0.0
+        self.max_jitter = 0.0
+
+    def reset(self):
+        self.deadline = None
+        self.last_tick = None
+        self.dt = self.period
+
+    async def wait(self) -> float:
+        '''
+        Wait for the next deadline and return the measured time since the previous tick in seconds.
+        The first call returns immediately and starts the grid.
+        '''
+        now = clock.now()
+        if self.deadline is None:
+            self.deadline = now
+        else:
+            self.deadline += self.period
+            if now > self.deadline:
+                # We overran the deadline, the tick took longer than a period
+                self.missed += 1
+                behind = int((now - self.deadline) / self.period)
+                if self.policy == TickPolicy.SKIP or behind > self.max_catch_up:
+                    self.skipped += behind
+                    self.deadline += behind * self.period
+                # Still yield, or a loop whose ticks keep overrunning would starve every other task
+                await asyncio.sleep(0)
+                now = clock.now()
+            else:
+                await asyncio.sleep(self.deadline - now)
+                now = clock.now()
+
+        lateness = max(now - self.deadline, 0)
+        self.jitter += (lateness - self.jitter) * JITTER_SMOOTHING
+        self.max_jitter = max(self.max_jitter, lateness)
+
+        self.dt = (now - self.last_tick) if self.last_tick is not None else self.period
+        self.last_tick = now
+        self.ticks += 1
+        return self.dt
+
+    def to_dict(self) -> TickStats:
+        return TickStats(
+            ticks=self.ticks,
+            missed=self.missed,
+            skipped=self.skipped,
+            last_dt=self.dt,
+            jitter=self.jitter,
+            max_jitter=self.max_jitter,
+        )
@@ -1,47 +1,153 @@
-from RPi import GPIO
-from gpiozero import MCP3008
 from typing import TypedDict
 import threading
 import time
 import utils
-import numpy as np
-import busio
-import adafruit_vl53l0x
-import board
+import hardware
+import clock
+from filters import ZScoreFilter
+
+TOF_BUFFER_SIZE = 64
+TOF_POLL_INTERVAL = 0.002 # s, how often to check data ready when there is no data ready pin
+TOF_READY_TIMEOUT = 0.1 # s
+
+class RingBuffer:
+    '''
+    Fixed size buffer of timestamped samples with a single writer. The writer fills a slot before it bumps count,
+    and bumping an int is atomic under the GIL, so readers never need a lock.
+    '''
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.timestamps = [0.0] * capacity
+        self.values = [0.0] * capacity
+        self.filtered = [0.0] * capacity
+        self.count = 0 # Total number of samples ever written
+
+    def push(self, timestamp: float, value: float, filtered: float):
+        i = self.count % self.capacity
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+        self.filtered[i] = filtered
+        self.count += 1
+
+    def latest(self):
+        '''
+        Read everything about the newest sample from one count, so the values always belong to the same sample even
+        while the writer moves on.
+
+        :return: (seq, timestamp, value, filtered) of the newest sample, seq being its count, or None if there are no
+        samples.
+        '''
+        count = self.count
+        if count == 0:
+            return None
+        i = (count - 1) % self.capacity
+        return count, self.timestamps[i], self.values[i], self.filtered[i]
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
 
 class TOF:
-    def __init__(self):
-        self.i2c = busio.I2C(board.SCL, board.SDA)
-        self.sensor = adafruit_vl53l0x.VL53L0X(self.i2c)
-        self.points = []
-        time.sleep(0.2)
+    '''
+    VL53L0X in continuous ranging mode. Measurements are taken on a dedicated acquisition thread (woken by the
+    sensor's data ready pin when one is wired) and stored in a ring buffer, so read() never touches the I2C bus.
+    When the backend is not realtime (virtual time simulation) there is no thread and read() polls instead.
+    '''
+    def __init__(self, data_ready_pin: int = None, threaded: bool = None):
+        self.backend = hardware.get_backend()
+        self.sensor = self.backend.tof()
+        self.filter = ZScoreFilter(5, 3)
+        self.samples = RingBuffer(TOF_BUFFER_SIZE)
+        self.data_ready_pin = data_ready_pin
+        self.ready = threading.Event()
+        self.running = True
+        self.threaded = self.backend.realtime if threaded is None else threaded
 
-    def read(self):
+        self.sensor.start_continuous()
+        self.backend.sleep(0.2)
+        self.acquire() # Make sure there is always a sample to read
+
+        if self.data_ready_pin is not None:
+            self.backend.setup_input(self.data_ready_pin)
+            # GPIO1 on the VL53L0X is active low
+            self.ready_callback = self.backend.callback(self.data_ready_pin, hardware.FALLING_EDGE, self.on_data_ready)
+        if self.threaded:
+            self.thread = threading.Thread(target=self.acquisition_loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def on_data_ready(self, pin: int, level: int, tick: int):
+        self.ready.set()
+
+    def acquisition_loop(self):
+        while self.running:
+            try:
+                if self.data_ready_pin is not None:
+                    if not self.ready.wait(TOF_READY_TIMEOUT):
+                        continue
+                    self.ready.clear()
+                elif not self.sensor.data_ready:
+                    time.sleep(TOF_POLL_INTERVAL)
+                    continue
+                self.acquire()
+            except Exception as e:
+                print(f"Error reading TOF: {e}")
+                time.sleep(TOF_READY_TIMEOUT)
+
+    def acquire(self):
         value = self.sensor.range #* 15.5 / 27
-        self.points.append(value)
-        if len(self.points) > 5:
-            self.points.pop(0)
-        if len(self.points) < 3:
-            return utils.cm_to_in(value / 10)
-        data = utils.remove_outliers_zscore(self.points, 3)
-        avg = np.average(data)
-        # return round(utils.cm_to_in(avg / 10) / 0.25) * 0.25 if not np.isnan(avg) else 0
-        return utils.cm_to_in(avg / 10) if not np.isnan(avg) else 0
+        timestamp = clock.now()
+        avg = self.filter.update(value)
+        if len(self.filter) < 3:
+            filtered = utils.cm_to_in(value / 10)
+        else:
+            # filtered = round(utils.cm_to_in(avg / 10) / 0.25) * 0.25
+            filtered = utils.cm_to_in(avg / 10)
+        self.samples.push(timestamp, value, filtered)
+
+    def poll(self):
+        if self.sensor.data_ready:
+            self.acquire()
+
+    def read(self) -> float:
+        '''
+        :return: The latest filtered position in inches.
+        '''
+        return self.sample()[3]
+
+    def sample(self):
+        '''
+        :return: (seq, timestamp, raw mm, filtered position in inches) of the latest sample, see RingBuffer.latest.
+        '''
+        if not self.threaded:
+            self.poll()
+        return self.samples.latest()
+
+    def age(self) -> float:
+        '''
+        :return: Seconds since the latest sample was measured.
+        '''
+        return clock.now() - self.samples.latest()[1]
 
     def cleanup(self):
         print('Cleaning up TOF')
+        self.running = False
+        if self.threaded:
+            self.thread.join(timeout=1)
+        if self.data_ready_pin is not None:
+            self.ready_callback.cancel()
+        self.sensor.stop_continuous()
 
 
 class Switch:
     def __init__(self, pin: int, flip: bool):
-        if not GPIO.getmode():
-            GPIO.setmode(GPIO.BCM)
+        self.backend = hardware.get_backend()
         self.pin = pin
         self.flip = flip
-        GPIO.setup(pin, GPIO.IN)
+        self.backend.setup_input(pin)
 
     def read(self):
-        input = GPIO.input(self.pin)
+        input = self.backend.read(self.pin)
         if self.flip:
             if input == 0:
                 return True
@@ -61,6 +167,7 @@ class Switch:
 
 class Potentiometer:
     def __init__(self, channel: int):
+        from gpiozero import MCP3008
         self.channel = channel
         self.potentiometer = MCP3008(channel=channel)
         
@@ -82,11 +189,10 @@ class Ultrasonic:
         self.tick_speed = config["tick_speed"]
         self.running = True
         self.offset = config['offset']
-        self.points = [] # limit the number of points to 5, and use moving average
-        if not GPIO.getmode():
-            GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.trig, GPIO.OUT)
-        GPIO.setup(self.echo, GPIO.IN)
+        self.filter = ZScoreFilter(12, 3)
+        self.backend = hardware.get_backend()
+        self.backend.setup_output(self.trig)
+        self.backend.setup_input(self.echo)
 
         if config['threading']:
             self.thread = threading.Thread(target=self.event_loop)
@@ -99,25 +205,24 @@ class Ultrasonic:
         # ticks_per_seconds = 1000 / self.tick_speed
         # ticks_per_level = seconds_per_level * ticks_per_seconds
         # tick = 0
-        length = 12
         while self.running:
-            GPIO.output(self.trig, True)
+            self.backend.write(self.trig, True)
             time.sleep(0.00001)
-            GPIO.output(self.trig, False)
+            self.backend.write(self.trig, False)
             start_time = 0
             end_time = 0
 
             stop = False
 
             start = time.time()
-            while GPIO.input(self.echo) == 0:
+            while self.backend.read(self.echo) == 0:
                 start_time = time.time()
                 if (start_time - start) > timeout:
                     stop = True
                     break
 
             end = time.time()
-            while GPIO.input(self.echo) == 1:
+            while self.backend.read(self.echo) == 1:
                 end_time = time.time()
                 if (end_time - end) > timeout:
                     stop = True
@@ -133,17 +238,14 @@ class Ultrasonic:
             if not stop:
                 duration = end_time - start_time
                 distance = (duration * 34300) / 2
-                self.points.append(utils.cm_to_in(distance))
-                if len(self.points) > length:
-                    self.points.pop(0)
+                self.filter.update(utils.cm_to_in(distance))
             time.sleep(self.tick_speed / 1000)
 
     def read(self):
-        data = utils.remove_outliers_zscore(self.points, 3)
-        # data = utils.remove_outliers_iqr(self.points)
-        # data = utils.remove_outliers_trim(self.points, 10)
-        avg = np.average(data)
-        return avg if not np.isnan(avg) else 0 + self.offset
+        # The filter is updated as samples arrive, see filters.MedianFilter/TrimmedMeanFilter for alternatives
+        if len(self.filter) == 0:
+            return 0 + self.offset
+        return self.filter.value
         # threshold = 20 # percent
         # data = np.array(self.points)
         # data_min = np.min(data)
@@ -154,4 +256,4 @@ class Ultrasonic:
     
     def cleanup(self):
         self.running = False
-        GPIO.cleanup([self.trig, self.echo])
\ No newline at end of file
+        self.backend.cleanup([self.trig, self.echo])
\ No newline at end of file
@@ -0,0 +1,157 @@
+'''
+fileoverview: Runs motion scenarios headless against the simulated backend on virtual time.
+
+    python3 simulate.py                      # calibrate, then run a few preset moves
+    python3 simulate.py --sweep 200          # calibrate, then run 200 random moves
+    python3 simulate.py --rate 1             # same, but at real time speed
+
+Each scenario builds a fresh Lectern on a fresh SimBackend, so scenarios are independent and reproducible.
+'''
+
+import argparse
+import asyncio
+import random
+import time
+from typing import TypedDict
+import clock
+import hardware
+from simulator import SimBackend, SimConfig
+from motor import Motor, MotorConfig
+from lectern import Lectern, LecternConfig, CalibrationState, POS_TOLERANCE
+from PID import Gains
+
+TICK_SPEED = 15
+MOVE_TIMEOUT = 30 # s
+SETTLE_TIME = 0.5 # s watched after a move reports done
+
+
+class MoveResult(TypedDict):
+    target: float
+    reached: bool
+    duration: float
+    error: float
+    overshoot: float # Furthest past the target in the direction of travel (in)
+    settle_time: float # Until the position entered the tolerance band for good (s)
+
+
+class ScenarioResult(TypedDict):
+    calibration: dict
+    moves: list[MoveResult]
+    virtual_time: float
+
+
+def make_lectern(sim_config: SimConfig = None) -> tuple[Lectern, SimBackend]:
+    backend = SimBackend(sim_config)
+    hardware.set_backend(backend)
+    motor = Motor(MotorConfig(
+        pin=backend.config['motor_pin'],
+        max=backend.config['max'],
+        min=backend.config['min'],
+        zero=backend.config['zero'],
+        invert=backend.config['invert'],
+        tick_speed=TICK_SPEED,
+        acceleration=5.33 # speed units/s, 0.08 per 15ms tick
+    ))
+    lectern = Lectern(motor, LecternConfig(
+        position_pin=0,
+        tick_speed=TICK_SPEED,
+        max_limit_pin=backend.config['max_limit_pin'],
+        min_limit_pin=backend.config['min_limit_pin'],
+        power_pin=18,
+        main_up_pin=5,
+        main_down_pin=6,
+        log_state=False,
+        secondary_up_pin=24,
+        secondary_down_pin=23,
+        status_led_pin=16,
+        osc_led_pin=12,
+    ))
+    return lectern, backend
+
+
+async def run_move(lectern: Lectern, backend: SimBackend, target: float) -> MoveResult:
+    start = clock.now()
+    direction = 1 if target >= backend.position else -1
+    overshoot = 0.0
+    settled = None
+    period = lectern.tick_speed / 1000
+
+    def track():
+        nonlocal overshoot, settled
+        offset = (backend.position - target) * direction
+        overshoot = max(overshoot, offset)
+        if abs(offset) > POS_TOLERANCE:
+            settled = None
+        elif settled is None:
+            settled = clock.now()
+
+    lectern.go_to(target)
+    while lectern.target_pos != -1 and clock.now() - start < MOVE_TIMEOUT:
+        await asyncio.sleep(period)
+        track()
+    duration = clock.now() - start
+    # Let the lectern settle before measuring where it actually stopped
+    end = clock.now() + SETTLE_TIME
+    while clock.now() < end:
+        await asyncio.sleep(period)
+        track()
+    error = backend.position - target
+    return MoveResult(
+        target=target,
+        reached=abs(error) <= POS_TOLERANCE * 2,
+        duration=duration,
+        error=error,
+        overshoot=overshoot,
+        settle_time=(settled if settled is not None else clock.now()) - start,
+    )
+
+
+async def run_scenario(targets: list[float], sim_config: SimConfig = None, gains: Gains = None) -> ScenarioResult:
+    lectern, backend = make_lectern(sim_config)
+    if gains is not None:
+        lectern.pid.set_gains(gains)
+    start = clock.now()
+    await lectern.start()
+    await asyncio.sleep(3) # start_up jog
+    lectern.calibrate()
+    await lectern.calibration_task
+    moves = []
+    if lectern.calibration_state == CalibrationState.DONE:
+        for target in targets:
+            moves.append(await run_move(lectern, backend, target))
+    result = ScenarioResult(
+        calibration=dict(lectern.calibration.__dict__),
+        moves=moves,
+        virtual_time=clock.now() - start,
+    )
+    await lectern.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep", type=int, default=0, help="Number of random moves to run")
+    parser.add_argument("--rate", type=float, default=None, help="Multiple of real time to run at (default: as fast as possible)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.sweep:
+        targets = [rng.uniform(7, 18.5) for _ in range(args.sweep)]
+    else:
+        targets = [15, 8, 12.5, 18, 10]
+
+    wall = time.perf_counter()
+    result = clock.run(run_scenario(targets, SimConfig(seed=args.seed)), virtual=True, rate=args.rate)
+    wall = time.perf_counter() - wall
+
+    for move in result['moves']:
+        print(f"go_to {move['target']:6.2f}: {'ok  ' if move['reached'] else 'FAIL'} {move['duration']:6.2f}s error {move['error']:+.3f} in, overshoot {move['overshoot']:.3f} in, settled in {move['settle_time']:.2f}s")
+    reached = sum(1 for m in result['moves'] if m['reached'])
+    print(f"Calibration: {result['calibration']}")
+    print(f"{reached}/{len(result['moves'])} moves reached")
+    print(f"Simulated {result['virtual_time']:.1f}s in {wall:.2f}s ({result['virtual_time'] / wall:.0f}x real time)")
+
+
+if __name__ == '__main__':
+    main()
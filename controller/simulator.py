@@ -0,0 +1,330 @@
+'''
+fileoverview: Simulated hardware backend. Models the lectern actuator (velocity versus servo pulse width, with a
+deadband and a first order response), the VL53L0X time of flight sensor (noise, measurement latency and timing
+budget) and the normally closed limit switches at the ends of travel. Buttons and other inputs can be driven from
+a scenario with set_input/press/release.
+
+Run the controller against it with:
+    LECTERN_BACKEND=sim python3 main.py
+'''
+
+import bisect
+import math
+import random
+import threading
+import clock
+from typing import TypedDict
+from hardware import Backend, RISING_EDGE, FALLING_EDGE
+
+
+class SimConfig(TypedDict, total=False):
+    motor_pin: int
+    max_limit_pin: int
+    min_limit_pin: int
+    zero: float # Neutral pulse width (us)
+    max: float # Full speed up pulse width (us)
+    min: float # Full speed down pulse width (us)
+    invert: bool
+    deadband: float # Pulse width around neutral that does not move the actuator (us)
+    max_velocity: float # in/s at full pulse width
+    down_scale: float # Down is assisted by gravity, so it is a bit faster
+    time_constant: float # Actuator response time constant (s)
+    top: float # Position of the max limit switch (in)
+    bottom: float # Position of the min limit switch (in)
+    overtravel: float # Distance past a limit switch before the hard stop (in)
+    start_position: float # in
+    tof_noise: float # Standard deviation of the TOF reading (mm)
+    tof_latency: float # Age of the position a TOF measurement reports (s)
+    tof_period: float # Timing budget of a TOF measurement (s)
+    seed: int
+
+
+DEFAULT_SIM_CONFIG = SimConfig(
+    motor_pin=17,
+    max_limit_pin=26,
+    min_limit_pin=19,
+    zero=1500,
+    max=2000,
+    min=1000,
+    invert=False,
+    deadband=15,
+    max_velocity=2.7,
+    down_scale=1.1,
+    time_constant=0.08,
+    top=19.2,
+    bottom=6.3,
+    overtravel=0.25,
+    start_position=12,
+    tof_noise=2.5,
+    tof_latency=0.03,
+    tof_period=0.033,
+    seed=0,
+)
+
+HISTORY_LENGTH = 256
+
+
+class LecternPhysics:
+    def __init__(self, config: SimConfig, now: float):
+        self.config = config
+        self.position = config['start_position']
+        self.velocity = 0.0
+        self.pulse_width = 0
+        self.last_update = now
+        self.history_t = [now]
+        self.history_p = [self.position]
+
+    def target_velocity(self) -> float:
+        config = self.config
+        width = self.pulse_width
+        if width == 0:
+            return 0.0 # Servo output disabled, the actuator holds
+        offset = width - config['zero']
+        if abs(offset) <= config['deadband']:
+            return 0.0
+        if offset > 0:
+            speed = (offset - config['deadband']) / (config['max'] - config['zero'] - config['deadband'])
+        else:
+            speed = (offset + config['deadband']) / (config['zero'] - config['min'] - config['deadband'])
+            speed *= config['down_scale']
+        if config['invert']:
+            speed = -speed
+        return max(min(speed, 1.5), -1.5) * config['max_velocity']
+
+    def step(self, now: float) -> bool:
+        '''
+        Advance the model to now.
+
+        :return: True if the model moved.
+        '''
+        dt = now - self.last_update
+        if dt <= 0:
+            return False
+        self.last_update = now
+        target = self.target_velocity()
+        tau = self.config['time_constant']
+        decay = math.exp(-dt / tau)
+        # Exact integration of a first order velocity response over dt
+        self.position += target * dt + (self.velocity - target) * tau * (1 - decay)
+        self.velocity = target + (self.velocity - target) * decay
+
+        upper = self.config['top'] + self.config['overtravel']
+        lower = self.config['bottom'] - self.config['overtravel']
+        if self.position >= upper:
+            self.position = upper
+            self.velocity = min(self.velocity, 0)
+        elif self.position <= lower:
+            self.position = lower
+            self.velocity = max(self.velocity, 0)
+
+        self.history_t.append(now)
+        self.history_p.append(self.position)
+        if len(self.history_t) > HISTORY_LENGTH:
+            del self.history_t[0]
+            del self.history_p[0]
+        return True
+
+    def position_at(self, t: float) -> float:
+        i = bisect.bisect_right(self.history_t, t)
+        if i == 0:
+            return self.history_p[0]
+        if i >= len(self.history_t):
+            return self.history_p[-1]
+        t0, t1 = self.history_t[i - 1], self.history_t[i]
+        p0, p1 = self.history_p[i - 1], self.history_p[i]
+        return p0 + (p1 - p0) * (t - t0) / (t1 - t0)
+
+
+class SimTOF:
+    def __init__(self, backend: 'SimBackend'):
+        self.backend = backend
+        self.continuous = False
+        self.last_measurement = backend.now()
+
+    @property
+    def range(self) -> int:
+        backend = self.backend
+        config = backend.config
+        now = backend.now()
+        backend.step()
+        self.last_measurement = now
+        with backend.lock:
+            position = backend.physics.position_at(now - config['tof_latency'])
+        return int(position * 25.4 + backend.random.gauss(0, config['tof_noise']))
+
+    @property
+    def data_ready(self) -> bool:
+        return self.backend.now() - self.last_measurement >= self.backend.config['tof_period']
+
+    def start_continuous(self):
+        self.continuous = True
+
+    def stop_continuous(self):
+        self.continuous = False
+
+
+class SimCallback:
+    def __init__(self, backend: 'SimBackend', pin: int, edge: int, func):
+        self.backend = backend
+        self.pin = pin
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        callbacks = self.backend.callbacks.get(self.pin, [])
+        if self in callbacks:
+            callbacks.remove(self)
+
+
+class SimPWM:
+    def __init__(self, pin: int, frequency: int):
+        self.pin = pin
+        self.frequency = frequency
+        self.duty_cycle = 0
+
+    def start(self, duty_cycle: float):
+        self.duty_cycle = duty_cycle
+
+    def ChangeDutyCycle(self, duty_cycle: float):
+        self.duty_cycle = duty_cycle
+
+    def stop(self):
+        self.duty_cycle = 0
+
+
+class SimBackend(Backend):
+    def __init__(self, config: SimConfig = None):
+        self.config = SimConfig({**DEFAULT_SIM_CONFIG, **(config or {})})
+        self.random = random.Random(self.config['seed'])
+        self.physics = LecternPhysics(self.config, self.now())
+        self.inputs: dict[int, int] = {}
+        self.outputs: dict[int, int] = {}
+        self.pwms: dict[int, SimPWM] = {}
+        self.callbacks: dict[int, list[SimCallback]] = {}
+        # The TOF acquisition thread and the event loop both advance the physics in realtime mode
+        self.lock = threading.Lock()
+        self.limit_levels = self.read_limits()
+
+    def read_limits(self) -> tuple[int, int]:
+        position = self.physics.position
+        # Limit switches are normally closed, the input drops to 0 when the switch is hit
+        max_level = 0 if position >= self.config['top'] else 1
+        min_level = 0 if position <= self.config['bottom'] else 1
+        return max_level, min_level
+
+    def step(self):
+        '''
+        Advance the physics and fire edge callbacks for limit switches that changed.
+        '''
+        with self.lock:
+            if not self.physics.step(self.now()):
+                return
+        self.update_limits()
+
+    def update_limits(self):
+        with self.lock:
+            levels = self.read_limits()
+            if levels == self.limit_levels:
+                return
+            previous, self.limit_levels = self.limit_levels, levels
+        # Outside the lock: the callbacks cut the motor, which takes the output stage lock set_servo_pulsewidth runs in
+        if levels[0] != previous[0]:
+            self.fire(self.config['max_limit_pin'], levels[0])
+        if levels[1] != previous[1]:
+            self.fire(self.config['min_limit_pin'], levels[1])
+
+    @property
+    def realtime(self) -> bool:
+        return not clock.is_virtual()
+
+    def now(self) -> float:
+        return clock.now()
+
+    def setup_input(self, pin: int):
+        self.inputs.setdefault(pin, 0)
+
+    def setup_output(self, pin: int):
+        self.outputs.setdefault(pin, 0)
+
+    def read(self, pin: int) -> int:
+        config = self.config
+        if pin == config['max_limit_pin']:
+            self.step()
+            return self.limit_levels[0]
+        if pin == config['min_limit_pin']:
+            self.step()
+            return self.limit_levels[1]
+        return self.inputs.get(pin, 0)
+
+    def read_bank(self) -> int:
+        self.step()
+        bits = 0
+        for pin, level in self.inputs.items():
+            if level:
+                bits |= 1 << pin
+        max_level, min_level = self.limit_levels
+        max_mask = 1 << self.config['max_limit_pin']
+        min_mask = 1 << self.config['min_limit_pin']
+        bits = (bits & ~max_mask) | (max_mask if max_level else 0)
+        bits = (bits & ~min_mask) | (min_mask if min_level else 0)
+        return bits
+
+    def write(self, pin: int, level: int):
+        self.outputs[pin] = level
+
+    def set_servo_pulsewidth(self, pin: int, width: float):
+        if pin != self.config['motor_pin']:
+            return
+        with self.lock:
+            self.physics.step(self.now())
+            self.physics.pulse_width = width
+        # Limit edges after the new width is in place, so a callback that cuts the motor has the last word
+        self.update_limits()
+
+    def callback(self, pin: int, edge: int, func):
+        callback = SimCallback(self, pin, edge, func)
+        self.callbacks.setdefault(pin, []).append(callback)
+        return callback
+
+    def tick(self) -> int:
+        # Stepping here means limit switch edges are seen at least once per control tick
+        self.step()
+        return int(self.now() * 1_000_000) & 0xFFFFFFFF
+
+    def fire(self, pin: int, level: int):
+        tick = int(self.now() * 1_000_000) & 0xFFFFFFFF
+        for callback in list(self.callbacks.get(pin, [])):
+            if callback.edge == RISING_EDGE and level != 1:
+                continue
+            if callback.edge == FALLING_EDGE and level != 0:
+                continue
+            callback.func(pin, level, tick)
+
+    def pwm(self, pin: int, frequency: int):
+        pwm = SimPWM(pin, frequency)
+        self.pwms[pin] = pwm
+        return pwm
+
+    def tof(self):
+        return SimTOF(self)
+
+    def sleep(self, seconds: float):
+        pass
+
+    # Scenario helpers
+    def set_input(self, pin: int, level: int):
+        changed = self.inputs.get(pin, 0) != level
+        self.inputs[pin] = level
+        if changed:
+            self.fire(pin, level)
+
+    def press(self, pin: int):
+        self.set_input(pin, 1)
+
+    def release(self, pin: int):
+        self.set_input(pin, 0)
+
+    @property
+    def position(self) -> float:
+        self.step()
+        return self.physics.position
@@ -0,0 +1,90 @@
+'''
+fileoverview: Per-tick sensor snapshots. The lectern event loop reads the hardware once per tick and publishes the
+result as an immutable, timestamped SensorFrame. Everything else (the emitter, commands, calibration) reads the latest
+frame or awaits the next one instead of triggering its own I2C/GPIO reads.
+'''
+
+import asyncio
+from typing import Callable
+import clock
+from inputs import SwitchSnapshot
+
+POSITION_FIELDS = ('position', 'position_age', 'position_raw', 'position_seq')
+
+
+class SensorFrame:
+    '''
+    Fields can be read as attributes or, like the SensorState dict this replaces, by key: frame['position'],
+    frame['max_limit']. Switches are decoded from the SwitchSnapshot bitfield on access.
+    '''
+    __slots__ = ('seq', 'timestamp', 'position', 'position_age', 'position_raw', 'position_seq', 'switches')
+
+    def __init__(self, seq: int, timestamp: float, position: float, position_age: float, position_raw: float, position_seq: int, switches: SwitchSnapshot):
+        init = object.__setattr__
+        init(self, 'seq', seq)
+        init(self, 'timestamp', timestamp)
+        init(self, 'position', position)
+        init(self, 'position_age', position_age)
+        init(self, 'position_raw', position_raw)
+        init(self, 'position_seq', position_seq)
+        init(self, 'switches', switches)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('SensorFrame is immutable')
+
+    def __getitem__(self, key: str):
+        switches = self.switches
+        mask = switches.masks.get(key)
+        if mask is not None:
+            return (switches.bits & mask) != 0
+        if key in POSITION_FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def age(self) -> float:
+        return clock.now() - self.timestamp
+
+    def to_dict(self) -> dict:
+        state = {key: getattr(self, key) for key in POSITION_FIELDS}
+        state.update(self.switches.to_dict())
+        return state
+
+    def __repr__(self):
+        return f'SensorFrame(seq={self.seq}, timestamp={self.timestamp}, {self.to_dict()})'
+
+
+class SnapshotBus:
+    def __init__(self):
+        self.latest: SensorFrame = None
+        self.seq = 0
+        self.waiters: list[asyncio.Future] = []
+
+    def publish(self, position: float, position_age: float, position_raw: float, position_seq: int, switches: SwitchSnapshot) -> SensorFrame:
+        self.seq += 1
+        frame = SensorFrame(self.seq, clock.now(), position, position_age, position_raw, position_seq, switches)
+        self.latest = frame
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(frame)
+        return frame
+
+    async def next_frame(self) -> SensorFrame:
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        return await waiter
+
+    async def wait_for(self, predicate: Callable[[SensorFrame], bool]) -> SensorFrame:
+        '''
+        Wait until a published frame matches the predicate and return it.
+        '''
+        while True:
+            frame = await self.next_frame()
+            if predicate(frame):
+                return frame
@@ -0,0 +1,566 @@
+'''
+fileoverview: Telemetry subscriptions. A display asks for the state on the TCP control channel and gets it by UDP on
+its own IP, at its own rate, format and set of fields:
+    /subscribe/<udp port>/<Hz>/<format>/<fields>   /subscribe/41235/10/json/sensors,state,eta
+    /subscribe/41235                               the default rate, format and fields
+    /unsubscribe/41235                             /unsubscribe for all of the client's subscriptions
+Frames only ever go to the IP the command came from, so the controller cannot be pointed at a third party.
+
+Subscribers that ask for the same rate, format and fields share a stream: each frame is encoded once and sent to all
+of them with one sendmmsg call on Linux (one sendto each elsewhere). Every stream keeps its own schedule, and the
+emitter sleeps until the next stream is due.
+
+The rate a subscriber asks for is its rate while the lectern is active (moving or calibrating). While it is idle every
+stream slows down to the heartbeat rate, and any state transition sends a frame on every stream straight away.
+
+A subscription lasts while the TCP connection it came from is open, and SUBSCRIPTION_TTL after that unless it is
+renewed by subscribing again. A connected client that has not subscribed gets the default feed on the state port,
+like before subscriptions existed, and the state port on localhost always gets it.
+
+Run this file to compare sendto and sendmmsg, and fixed and adaptive rates on the simulator:
+    python3 subscribers.py
+'''
+
+import asyncio
+import ctypes
+import errno
+import math
+import socket
+import sys
+import clock
+from router import CommandError, number
+from telemetry import TelemetryEncoder, TelemetryFormat, FIELD_GROUPS
+
+SUBSCRIPTION_TTL = 30 # s a subscription outlives its TCP connection
+MAX_RATE = 60 # Hz, about the control tick rate, frames cannot change faster than that
+MIN_RATE = 0.1 # Hz
+MAX_WAIT = 1.0 # s the emitter sleeps at most, so subscriptions expire on time
+SCHEDULE_SLACK = 0.001 # s, a stream due this soon is sent now instead of sleeping for less than a timer can
+
+
+def udp_port(value) -> int:
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        raise CommandError(f'{value!r} is not a port')
+    if not 0 < port < 65536:
+        raise CommandError(f'{port} is not a port')
+    return port
+
+
+def rate(value) -> float:
+    value = number(value)
+    if not MIN_RATE <= value <= MAX_RATE:
+        raise CommandError(f'Rate has to be between {MIN_RATE} and {MAX_RATE}Hz, got {value}')
+    return value
+
+
+def telemetry_format(value) -> TelemetryFormat:
+    try:
+        return TelemetryFormat[str(value).upper()]
+    except KeyError:
+        raise CommandError(f'Unknown telemetry format {value!r}, expected one of {", ".join(f.name.lower() for f in TelemetryFormat)}')
+
+
+def field_set(value) -> frozenset:
+    '''
+    Comma separated keys of telemetry.FIELD_GROUPS, "all" for the whole state (None).
+    '''
+    if value in ('all', '*'):
+        return None
+    fields = frozenset(name.strip() for name in str(value).split(',') if name.strip())
+    if not fields:
+        raise CommandError('No fields')
+    unknown = fields - FIELD_GROUPS
+    if unknown:
+        raise CommandError(f'Unknown fields {", ".join(sorted(unknown))}')
+    return fields
+
+
+# Linux structures for sendmmsg
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16), # Network byte order
+        ('sin_addr', ctypes.c_ubyte * 4),
+        ('sin_zero', ctypes.c_ubyte * 8),
+    ]
+
+
+def load_sendmmsg():
+    '''
+    :return: libc's sendmmsg, None where there is none
+    '''
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = (ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int)
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+SENDMMSG = load_sendmmsg()
+
+
+def to_sockaddr(address: tuple[str, int]) -> sockaddr_in:
+    '''
+    :return: The address for sendmmsg, None if it is not an IPv4 address (sent with sendto instead)
+    '''
+    host, port = address
+    try:
+        packed = socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        return None
+    return sockaddr_in(socket.AF_INET, socket.htons(port), (ctypes.c_ubyte * 4)(*packed))
+
+
+class Subscriber:
+    __slots__ = ('address', 'owner', 'owners', 'implicit', 'permanent', 'expires', 'stream', 'sockaddr', 'sent', 'errors')
+
+    def __init__(self, address: tuple[str, int], owner: tuple[str, int] = None, implicit: bool = False, permanent: bool = False):
+        '''
+        :param address: (IP, UDP port) the frames go to
+        :param owner: Address of the TCP connection that subscribed, the subscription lasts as long as it is open
+        :param implicit: The default feed of the connected clients that have not subscribed, see owners
+        :param permanent: Never expires
+        '''
+        self.address = address
+        self.owner = owner
+        self.owners: set[tuple[str, int]] = set() # TCP connections relying on the default feed at this address
+        self.implicit = implicit
+        self.permanent = permanent
+        self.expires = math.inf
+        self.stream: Stream = None
+        self.sockaddr = to_sockaddr(address)
+        self.sent = 0
+        self.errors = 0
+
+
+class Stream:
+    '''
+    Frames at one rate, format and set of fields, and the subscribers that get them.
+    '''
+    __slots__ = ('format', 'interval', 'fields', 'encoder', 'subscribers', 'batch', 'next_due', 'frames')
+
+    def __init__(self, format: TelemetryFormat, interval: float, fields: frozenset, keyframe_interval: int):
+        self.format = format
+        self.interval = interval
+        self.fields = fields
+        # Binary deltas are against this stream's previous frame, so every stream has its own encoder
+        self.encoder = TelemetryEncoder(keyframe_interval, fields) if format == TelemetryFormat.BINARY else None
+        self.subscribers: list[Subscriber] = []
+        self.batch: Batch = None # Built on the first send after the subscribers change
+        self.next_due = 0.0
+        self.frames = 0
+
+    def select(self, state: dict) -> dict:
+        '''
+        :return: The keys of the state this stream carries
+        '''
+        if self.fields is None:
+            return state
+        return {key: state[key] for key in self.fields}
+
+
+class Batch:
+    '''
+    A stream's sendmmsg message headers, built when its subscribers change so sending a frame is one call.
+    '''
+    __slots__ = ('iov', 'messages', 'subscribers', 'others')
+
+    def __init__(self, subscribers: list[Subscriber]):
+        self.iov = iovec() # One payload for all of them
+        self.subscribers = [subscriber for subscriber in subscribers if subscriber.sockaddr is not None]
+        self.others = [subscriber for subscriber in subscribers if subscriber.sockaddr is None] # Sent with sendto
+        self.messages = (mmsghdr * len(self.subscribers))()
+        for message, subscriber in zip(self.messages, self.subscribers):
+            message.msg_hdr.msg_name = ctypes.addressof(subscriber.sockaddr)
+            message.msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+            message.msg_hdr.msg_iov = ctypes.pointer(self.iov)
+            message.msg_hdr.msg_iovlen = 1
+
+
+class BatchSender:
+    '''
+    Sends a stream's payload to all of its subscribers, with a single sendmmsg call where there is one. The socket is
+    non-blocking: a subscriber the socket cannot keep up with loses frames instead of holding up the event loop.
+    '''
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+        self.socket.setblocking(False)
+        self.sendmmsg = SENDMMSG
+        self.calls = 0 # System calls
+        self.datagrams = 0
+        self.errors = 0
+
+    def send(self, payload, stream: 'Stream'):
+        remaining = stream.subscribers
+        if self.sendmmsg is not None and len(remaining) > 1:
+            if stream.batch is None:
+                stream.batch = Batch(stream.subscribers)
+            remaining = self.send_batch(payload, stream.batch)
+        for subscriber in remaining:
+            self.calls += 1
+            try:
+                self.socket.sendto(payload, subscriber.address)
+            except OSError as e:
+                self.error(subscriber, e)
+                continue
+            subscriber.sent += 1
+            self.datagrams += 1
+
+    def send_batch(self, payload, batch: Batch) -> list[Subscriber]:
+        '''
+        :return: The subscribers left for sendto: the ones sendmmsg could not take, and any without an IPv4 address
+        '''
+        size = len(payload)
+        if isinstance(payload, bytes):
+            buffer = (ctypes.c_char * size).from_buffer_copy(payload) # Read only, so it cannot be shared
+        else:
+            buffer = (ctypes.c_char * size).from_buffer(payload) # The encoder's buffer, no copy
+        batch.iov.iov_base = ctypes.addressof(buffer)
+        batch.iov.iov_len = size
+        subscribers = batch.subscribers
+        self.calls += 1
+        sent = self.sendmmsg(self.socket.fileno(), batch.messages, len(subscribers), 0)
+        del buffer # Release the encoder's buffer
+        if sent < 0:
+            if ctypes.get_errno() == errno.ENOSYS:
+                print("sendmmsg is not supported, sending datagrams one at a time")
+                self.sendmmsg = None
+            sent = 0
+        if sent == len(subscribers):
+            for subscriber in subscribers:
+                subscriber.sent += 1
+            self.datagrams += sent
+            return batch.others
+        for subscriber in subscribers[:sent]:
+            subscriber.sent += 1
+        self.datagrams += sent
+        # sendmmsg stops at the first datagram that fails, sendto tries each of the rest and reports its error
+        return subscribers[sent:] + batch.others
+
+    def error(self, subscriber: Subscriber, e: OSError):
+        self.errors += 1
+        subscriber.errors += 1
+        if subscriber.errors == 1:
+            print(f"Error sending UDP state to {subscriber.address[0]}:{subscriber.address[1]}: {e}")
+
+
+class SubscriberRegistry:
+    def __init__(self, sock: socket.socket, port: int, rate: float, heartbeat: float, format: TelemetryFormat, keyframe_interval: int):
+        '''
+        :param port: UDP port of the default feed
+        :param rate: Hz of the default feed, and of subscriptions that do not pick one, while active
+        :param heartbeat: Hz every stream drops to (if it is faster) while idle
+        :param format: Of the default feed, and of subscriptions that do not pick one
+        '''
+        self.port = port
+        self.rate = rate
+        self.idle_interval = 1 / heartbeat
+        self.active = True
+        self.bursts = 0
+        self.format = format
+        self.keyframe_interval = keyframe_interval
+        self.sender = BatchSender(sock)
+        self.subscribers: dict[tuple[str, int], Subscriber] = {}
+        self.streams: dict[tuple, Stream] = {}
+        self.changed = asyncio.Event() # Wakes the emitter when the schedule changes
+        self.expired = 0
+
+    def add(self, address: tuple[str, int], rate: float = None, format: TelemetryFormat = None, fields: frozenset = None, owner: tuple[str, int] = None, implicit: bool = False, permanent: bool = False) -> Subscriber:
+        '''
+        Subscribe an address, replacing its subscription if it has one. A default feed does not replace anything, and
+        nothing but another permanent subscription replaces a permanent one.
+
+        :raises CommandError: if the address has a permanent subscription
+        '''
+        existing = self.subscribers.get(address)
+        owners = set()
+        if existing is not None:
+            if implicit:
+                return existing
+            if existing.permanent and not permanent:
+                # Whoever listens on the default feed (the web app on localhost) relies on its format and rate
+                raise CommandError(f'{address[0]}:{address[1]} is the default feed, subscribe on another port')
+            self.remove(existing)
+            owners = existing.owners # Still on this address, they get the default feed back when this one goes
+        subscriber = Subscriber(address, owner, implicit, permanent)
+        subscriber.owners = owners
+        interval = 1 / (rate or self.rate)
+        format = format or self.format
+        key = (format, interval, fields)
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = Stream(format, interval, fields, self.keyframe_interval)
+            stream.next_due = clock.now()
+        if stream.encoder is not None:
+            stream.encoder.request_keyframe() # Don't make the newcomer wait for the next one
+        stream.subscribers.append(subscriber)
+        stream.batch = None
+        subscriber.stream = stream
+        self.subscribers[address] = subscriber
+        self.changed.set()
+        return subscriber
+
+    def remove(self, subscriber: Subscriber):
+        del self.subscribers[subscriber.address]
+        stream = subscriber.stream
+        stream.subscribers.remove(subscriber)
+        stream.batch = None
+        if not stream.subscribers:
+            del self.streams[(stream.format, stream.interval, stream.fields)]
+
+    def drop(self, subscriber: Subscriber):
+        '''
+        Remove a subscription, going back to the default feed for the connections that still rely on its address.
+        '''
+        self.remove(subscriber)
+        if subscriber.owners:
+            self.add(subscriber.address, implicit=True).owners = subscriber.owners
+
+    def subscribe(self, source: tuple[str, int], port: int, rate: float = None, format: TelemetryFormat = None, fields: frozenset = None):
+        '''
+        /subscribe from a TCP client at source.
+        '''
+        for subscriber in list(self.subscribers.values()):
+            subscriber.owners.discard(source)
+            if subscriber.implicit and not subscriber.owners:
+                self.remove(subscriber)
+        subscriber = self.add((source[0], port), rate, format, fields, owner=source)
+        stream = subscriber.stream
+        print(f"Subscribed {source[0]}:{port} at {1 / stream.interval:g}Hz, {stream.format.to_dict()}, {','.join(sorted(stream.fields)) if stream.fields else 'all fields'}")
+
+    def unsubscribe(self, source: tuple[str, int], port: int = None):
+        '''
+        /unsubscribe from a TCP client at source, from every port of its IP if no port is given.
+        '''
+        for subscriber in list(self.subscribers.values()):
+            host, subscribed_port = subscriber.address
+            if host != source[0] or port not in (None, subscribed_port):
+                continue
+            if subscriber.permanent:
+                print(f"{host}:{subscribed_port} is the default feed, not unsubscribing")
+                continue
+            subscriber.owners.discard(source)
+            if subscriber.implicit and subscriber.owners:
+                continue # Another client on this IP still relies on it
+            self.drop(subscriber)
+            print(f"Unsubscribed {host}:{subscribed_port}")
+
+    def request_keyframe(self, source: tuple[str, int]):
+        '''
+        /telemetry_keyframe: a full frame on the next frame of every binary stream the client's IP gets.
+        '''
+        for subscriber in self.subscribers.values():
+            if subscriber.address[0] == source[0] and subscriber.stream.encoder is not None:
+                subscriber.stream.encoder.request_keyframe()
+
+    def connected(self, owner: tuple[str, int]):
+        '''
+        A TCP client gets the default feed on its IP until it subscribes. Clients on the same IP share it, so it is
+        kept until the last of them is gone.
+        '''
+        self.add((owner[0], self.port), implicit=True).owners.add(owner)
+
+    def disconnected(self, owner: tuple[str, int]):
+        expires = clock.now() + SUBSCRIPTION_TTL
+        for subscriber in list(self.subscribers.values()):
+            subscriber.owners.discard(owner)
+            if subscriber.implicit:
+                if not subscriber.owners:
+                    self.remove(subscriber)
+            elif subscriber.owner == owner and not subscriber.permanent:
+                subscriber.owner = None
+                subscriber.expires = expires
+
+    def expire(self, now: float):
+        for subscriber in list(self.subscribers.values()):
+            if subscriber.expires <= now:
+                self.drop(subscriber)
+                self.expired += 1
+                print(f"Subscription of {subscriber.address[0]}:{subscriber.address[1]} expired")
+
+    def set_active(self, active: bool):
+        '''
+        :param active: The lectern is moving or calibrating, streams run at their own rate instead of the heartbeat
+        '''
+        self.active = active
+
+    def burst(self, now: float):
+        '''
+        Make every stream due now, for a state transition.
+        '''
+        self.bursts += 1
+        for stream in self.streams.values():
+            stream.next_due = now
+
+    def due(self, now: float) -> list[Stream]:
+        '''
+        :return: The streams due a frame, their next frame scheduled
+        '''
+        due = []
+        idle_interval = None if self.active else self.idle_interval
+        for stream in self.streams.values():
+            if stream.next_due <= now + SCHEDULE_SLACK:
+                due.append(stream)
+                stream.frames += 1
+                interval = stream.interval if idle_interval is None else max(stream.interval, idle_interval)
+                stream.next_due += interval
+                if stream.next_due <= now:
+                    stream.next_due = now + interval # Fell behind, skip rather than burst
+        return due
+
+    def send(self, stream: Stream, payload):
+        self.sender.send(payload, stream)
+
+    async def wait(self, transition: asyncio.Event):
+        '''
+        Sleep until the next stream is due, the subscriptions change or there is a state transition.
+        '''
+        next_due = min((stream.next_due for stream in self.streams.values()), default=math.inf)
+        timeout = min(MAX_WAIT, max(0.0, next_due - clock.now()))
+        if transition.is_set() or timeout <= SCHEDULE_SLACK:
+            return
+        self.changed.clear()
+        waiters = [asyncio.ensure_future(self.changed.wait()), asyncio.ensure_future(transition.wait())]
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+
+if __name__ == '__main__':
+    import time
+    import simulate
+    from lectern import SYSTEM_STATE
+    from system import System, SystemConfig
+
+    SUBSCRIBERS = (1, 8, 48)
+    FRAMES = 2000
+    PAYLOAD = bytearray(104) # A moving binary delta frame
+
+    def bench(stream: Stream, sender: BatchSender) -> float:
+        '''
+        :return: s per frame sent to every subscriber
+        '''
+        view = memoryview(PAYLOAD)
+        start = time.perf_counter()
+        for _ in range(FRAMES):
+            sender.send(view, stream)
+        return (time.perf_counter() - start) / FRAMES
+
+    receivers = []
+    for _ in range(max(SUBSCRIBERS)):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receivers.append(receiver)
+
+    print(f'sendmmsg {"available" if SENDMMSG is not None else "not available, both rows are sendto"}')
+    print(f'{"subscribers":>11} {"sendto":>10} {"sendmmsg":>10}   per frame sent to every subscriber')
+    for count in SUBSCRIBERS:
+        stream = Stream(TelemetryFormat.BINARY, 0.1, None, 1)
+        stream.subscribers = [Subscriber(receiver.getsockname()) for receiver in receivers[:count]]
+        results = []
+        for batched in (False, True):
+            sender = BatchSender(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+            if not batched:
+                sender.sendmmsg = None
+            elapsed = bench(stream, sender)
+            # Receivers are not read, so the kernel drops what does not fit; the send side is what is measured
+            for receiver in receivers:
+                receiver.setblocking(False)
+                try:
+                    while receiver.recv(2048):
+                        pass
+                except BlockingIOError:
+                    pass
+            results.append(elapsed)
+            sender.socket.close()
+        sendto, sendmmsg = results
+        print(f'{count:11} {sendto * 1e6:8.1f}us {sendmmsg * 1e6:8.1f}us')
+
+    EMIT_TICK_SPEED = 30 # ms while active
+    PHASE = 20 # s parked, then moving, then parked again
+
+    async def scenario(adaptive: bool) -> dict:
+        '''
+        :return: Default feed frames per second in each phase, and how long frames took to follow transitions
+        '''
+        lectern, backend = simulate.make_lectern()
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        system = System(SystemConfig(lectern=lectern, ip='127.0.0.1', osc_port=0, udp_port=receiver.getsockname()[1], tcp_port=0, emit_tick_speed=EMIT_TICK_SPEED))
+        subscribers = system.subscribers
+        if not adaptive:
+            # Always at the full rate, and transitions wait for the next frame
+            subscribers.set_active = lambda active: None
+            subscribers.burst = lambda now: None
+        stream, = subscribers.streams.values()
+        await lectern.start()
+        emitter = asyncio.create_task(system.start_emitter())
+        await asyncio.sleep(3) # start_up jog
+
+        # Time from each transition to the frame that follows it
+        delays = []
+        transitions = []
+        signal = lectern.state_changed.set
+        def set():
+            transitions.append(clock.now())
+            signal()
+        lectern.state_changed.set = set
+        send = subscribers.send
+        def timed_send(stream: Stream, payload):
+            if transitions:
+                delays.append(clock.now() - transitions[0])
+                transitions.clear()
+            send(stream, payload)
+        subscribers.send = timed_send
+
+        rates = {}
+        for phase in ('parked', 'moving', 'parked again'):
+            frames = stream.frames
+            end = clock.now() + PHASE
+            while clock.now() < end:
+                if phase == 'moving' and lectern.profile is None:
+                    lectern.go_to(18 if lectern.estimate['position'] < 12 else 7)
+                await asyncio.sleep(0.1)
+            rates[phase] = (stream.frames - frames) / PHASE
+            while lectern.profile is not None or lectern.state != SYSTEM_STATE.STAND_BY:
+                await asyncio.sleep(0.1) # Let the last move finish outside the phase
+        emitter.cancel()
+        await lectern.cleanup()
+        receiver.close()
+        return rates, delays
+
+    print()
+    print(f'Default feed, {EMIT_TICK_SPEED}ms while active, heartbeat otherwise, {PHASE}s per phase on the simulator')
+    for adaptive in (False, True):
+        rates, delays = clock.run(scenario(adaptive), virtual=True)
+        frames = ', '.join(f'{phase} {rate:4.1f}' for phase, rate in rates.items())
+        print(f'{"adaptive" if adaptive else "fixed":9} frames/s: {frames}; {len(delays)} transitions, the frame after one came {sum(delays) / len(delays) * 1000:.1f}ms later on average, {max(delays) * 1000:.1f}ms at most')
+
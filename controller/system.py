@@ -7,149 +7,215 @@ import subprocess
 import tcp
 import socket
 import json
+import clock
+from estop import EStop, E_STOP_PORT
+from recorder import FlightRecorder, RECORDER_DIR, RECORDER_MINUTES, dump_minutes
+from router import Router, ANY_VERB, number
+from subscribers import SubscriberRegistry, Stream, udp_port, rate, telemetry_format, field_set
+from telemetry import TelemetryFormat, KEYFRAME_INTERVAL
 # import queue
 
+IDLE_EMIT_TICK_SPEED = 250 # ms, well inside the 1s the web app waits before it considers the state lost
+
 class SystemConfig(TypedDict):
     lectern=lectern.Lectern
     ip=str
     osc_port=int
     udp_port=int
     tcp_port=int
-    emit_tick_speed=int
+    emit_tick_speed=int # ms between frames of the default feed while the lectern is moving or calibrating
+    idle_emit_tick_speed=int # ms between heartbeat frames of every feed while it is idle, IDLE_EMIT_TICK_SPEED by default
+    e_stop_port=int # UDP port of the out of band e-stop listener, estop.E_STOP_PORT by default
+    e_stop_pin=int # Optional hardware e-stop input
+    telemetry_format=TelemetryFormat # Of the default UDP state feed, TelemetryFormat.BINARY by default
+    keyframe_interval=int # Binary telemetry sends a full frame every this many frames, telemetry.KEYFRAME_INTERVAL by default
+    recorder_dir=str # Where the flight recorder keeps its segments and dumps, recorder.RECORDER_DIR by default
+    recorder_minutes=float # Of ticks the flight recorder keeps, recorder.RECORDER_MINUTES by default
 
 class System:
     def __init__(self, config: SystemConfig):
-        self.osc_queue = Q.SystemQueue()
-        self.tcp_queue = Q.SystemQueue()
+        self.osc_queue = Q.SystemQueue(self.handle_priority_command)
+        self.tcp_queue = Q.SystemQueue(self.handle_priority_command)
         self.lectern: lectern.Lectern = config['lectern']
         self.tasks: list[asyncio.Task] = []
+        self.in_flight: dict[str, tuple[Q.System_Command, asyncio.Task]] = {} # Command currently running from each queue
         self.emit_tick_speed = config['emit_tick_speed']
         self.udp_port = config['udp_port']
+        self.telemetry_format = config.get('telemetry_format', TelemetryFormat.BINARY)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.subscribers = SubscriberRegistry(
+            self.socket,
+            port=self.udp_port,
+            rate=1000 / self.emit_tick_speed,
+            heartbeat=1000 / config.get('idle_emit_tick_speed', IDLE_EMIT_TICK_SPEED),
+            format=self.telemetry_format,
+            keyframe_interval=config.get('keyframe_interval', KEYFRAME_INTERVAL),
+        )
+        # The state port on this machine always gets the default feed
+        self.subscribers.add((socket.gethostbyname('localhost'), self.udp_port), permanent=True)
+        self.e_stop = EStop(
+            self.lectern.motor,
+            host=config['ip'],
+            port=config.get('e_stop_port', E_STOP_PORT),
+            pin=config.get('e_stop_pin'),
+            on_trip=self.handle_e_stop_trip,
+        )
+        self.recorder = FlightRecorder(
+            config.get('recorder_dir', RECORDER_DIR),
+            self.lectern.tick_speed,
+            config.get('recorder_minutes', RECORDER_MINUTES),
+        )
+        self.lectern.recorder = self.recorder
+        self.osc_router = self.build_osc_router()
+        self.tcp_router = self.build_tcp_router()
         self.osc = osc.OSC_Server(
             osc.OSC_Config(
                 ip=config['ip'],
                 port=config['osc_port'],
                 queue=self.osc_queue,
-                threading=True
+                router=self.osc_router,
             )
         )
         self.tcp = tcp.TCPServer(
             host=config['ip'],
             port=config['tcp_port'],
-            queue=self.tcp_queue
+            queue=self.tcp_queue,
+            router=self.tcp_router,
+            on_connect=self.subscribers.connected,
+            on_disconnect=self.subscribers.disconnected,
         )
 
-    async def handle_lectern_osc_command(self, command: Q.System_Command):
-        print(f"Running lectern command: {command.args}")
-        # wait for lectern to be ready
-        while not self.lectern.command_ready:
-            await asyncio.sleep(self.lectern.tick_speed / 1000)
-        if command.args[0] == "move":
-            speed = float(command.args[1])
-            if speed != speed:
-                print("Speed is NaN, ignoring command")
-                return
-            print(f"Moving lectern at speed: {speed}")
-            self.lectern.set_speed(speed)
-            return
-        if command.args[0] == "stop":
-            self.lectern.stop()
+    def add_safety_routes(self, router: Router):
+        '''
+        Safety commands, accepted on every channel. Priority routes are handed to handle_priority_command with the
+        time they were queued.
+        '''
+        router.add('lectern', 'stop', self.lectern.stop, priority=True)
+        router.add('lectern', 'e_stop', self.lectern_e_stop, priority=True)
+        router.add('lectern', 'lock', self.lectern.lock, priority=True)
+        router.add('all', 'stop', self.lectern.stop, priority=True)
+        router.add('teleprompter', ANY_VERB, self.handle_teleprompter_command, None, required=0)
+
+    def build_osc_router(self) -> Router:
+        router = Router()
+        self.add_safety_routes(router)
+        router.add('lectern', 'move', self.lectern_move, (number,), coalesce=True, motion=True)
+        router.add('lectern', 'go_to', self.lectern_go_to, (number, 'in', number), required=1, coalesce=True, motion=True)
+        router.add('lectern', 'bump', self.lectern_bump, (number,), motion=True)
+        router.add('lectern', 'calibrate', self.lectern_calibrate, motion=True)
+        router.add('lectern', 'unlock', self.lectern_unlock)
+        # No clear_fault: a latched e-stop is only cleared over TCP, through stop_for_maintenance
+        return router
+
+    def build_tcp_router(self) -> Router:
+        router = Router()
+        self.add_safety_routes(router)
+        router.add('lectern', 'unlock', self.lectern_unlock) # A lock set over TCP can be released over TCP
+        router.add('lectern', 'clear_fault', self.lectern_clear_fault)
+        router.add('lectern', 'reboot', self.lectern_reboot)
+        router.add('lectern', 'home', self.lectern_home, motion=True)
+        router.add('all', 'system_reboot', self.reboot)
+        router.add('all', 'system_shutdown', self.shutdown)
+        router.add('all', 'reboot_tcp', lambda: print("Rebooting Lectern TCP..."))
+        router.add('all', 'reboot_osc', lambda: print("Rebooting OSC...")) # self.osc.restart()
+        router.add('all', 'subscribe', self.subscribers.subscribe, (udp_port, rate, telemetry_format, field_set), required=1, source=True)
+        router.add('all', 'unsubscribe', self.subscribers.unsubscribe, (udp_port,), required=0, source=True)
+        router.add('all', 'telemetry_keyframe', self.subscribers.request_keyframe, source=True)
+        router.add('all', 'dump_recording', self.recorder.dump, (dump_minutes,), required=0)
+        return router
+
+    def lectern_accepts(self) -> bool:
+        if self.e_stop.fault:
+            print("E-stop fault is latched, ignoring command")
+            return False
+        if self.lectern.remote_locked:
+            print("Lectern is locked, ignoring command")
+            return False
+        return True
+
+    async def lectern_ready(self) -> bool:
+        '''
+        Gate for discrete commands: wait for the lectern to be ready for the next one. Setpoints (move, go_to) replace
+        whatever the lectern is doing and only go through lectern_accepts.
+        '''
+        if not self.lectern_accepts():
+            return False
+        if not self.lectern.command_ready:
+            await self.lectern.bus.wait_for(lambda frame: self.lectern.command_ready)
+        return True
+
+    def lectern_move(self, speed: float):
+        if not self.lectern_accepts():
             return
-        if command.args[0] == "calibrate":
-            self.lectern.run_calibration()
+        print(f"Moving lectern at speed: {speed}")
+        self.lectern.set_speed(speed)
+
+    def lectern_go_to(self, position: float, duration: float = None):
+        if not self.lectern_accepts():
             return
-        if command.args[0] == "go_to":
-            position = float(command.args[1])
-            if position != position:
-                print("Position is NaN, ignoring command")
-                return
-            if len(command.args) < 3:
-                self.lectern.go_to(position)
-                return
-            if command.args[2] == "in":
-                time = float(command.args[3])
-                if time != time:
-                    print("Time is NaN, ignoring command")
-                    return
-                self.lectern.go_to_in(position, time)
-            else:
-                self.lectern.go_to(position)
+        if duration is None:
+            self.lectern.go_to(position)
             return
-        if command.args[0] == "bump":
-            distance = float(command.args[1])
-            if distance != distance:
-                print("Distance is NaN, ignoring command")
-                return
+        try:
+            self.lectern.go_to_in(position, duration)
+        except ValueError as e:
+            print(f"Timed move rejected: {e}")
+
+    async def lectern_bump(self, distance: float):
+        if await self.lectern_ready():
             self.lectern.bump(distance)
 
-    def handle_teleprompter_osc_command(self, command: Q.System_Command):
-        print(f"Running teleprompter command: {command.args}")
-    
-    async def handle_osc_command(self, command: Q.System_Command):
-        print(f"Running OSC command: {command.args} for {command.who}")
-        if command.who == "lectern":
-            await self.handle_lectern_osc_command(command)
-        elif command.who == "teleprompter":
-            await self.handle_teleprompter_osc_command(command)
-        else:
-           asyncio.create_task(self.handle_teleprompter_osc_command(command))
-           asyncio.create_task(self.handle_lectern_tcp_command(command))
-
-    async def handle_lectern_tcp_command(self, command: Q.System_Command):
+    async def lectern_calibrate(self):
+        if await self.lectern_ready():
+            self.lectern.calibrate()
+
+    def lectern_unlock(self):
+        if self.e_stop.fault:
+            print("E-stop fault is latched, ignoring command")
+            return
+        self.lectern.unlock()
+
+    def lectern_e_stop(self, requested_at: float = None):
+        self.tasks.append(asyncio.create_task(self.lectern.e_stop(requested_at)))
+
+    async def stop_for_maintenance(self):
+        '''
+        TCP lectern commands are maintenance: bring the lectern to a stop and drop the queued OSC commands that would
+        move it first.
+        '''
         self.lectern.stop()
-        self.osc_queue.clear_lectern()
+        self.osc_queue.clear_motion()
         await asyncio.sleep(0.5) # wait for the motor to stop
-        if command.args[0] == "stop":
-            # No action needed, already stopped
-            return
-        if command.args[0] == "reboot":
-            asyncio.create_task(self.lectern.reboot())
-            return
-        if command.args[0] == "home":
-            asyncio.create_task(self.lectern.home())
-            return
 
-    async def handle_teleprompter_tcp_command(self, command: Q.System_Command):
-        print(f"Running teleprompter TCP command: {command.args} for {command.who}")
+    async def lectern_clear_fault(self):
+        await self.stop_for_maintenance()
+        self.e_stop.clear()
 
-    async def handle_tcp_command(self, command: Q.System_Command):
-        print(f"Running TCP command: {command.args} for {command.who}")
-        if command.who == "lectern":
-            await self.handle_lectern_tcp_command(command)
-            return
-        if command.who == "teleprompter":
-            await self.handle_teleprompter_tcp_command(command)
-            return
-        if command.args[0] == "system_reboot":
-            print("Rebooting system...")
-            self.reboot()
-            return
-        if command.args[0] == "system_shutdown":
-            print("Shutting down system...")
-            self.shutdown()
-            return
-        if command.args[0] == "reboot_tcp":
-            print("Rebooting Lectern TCP...")
-            return
-        if command.args[0] == "reboot_osc":
-            print("Rebooting OSC...")
-            # self.osc.restart()
+    async def lectern_reboot(self):
+        await self.stop_for_maintenance()
+        # Runs the lectern again from the top, so it outlives this command
+        self.tasks.append(asyncio.create_task(self.lectern.reboot()))
+
+    async def lectern_home(self):
+        if not self.lectern_accepts():
             return
-        
-        asyncio.create_task(self.handle_teleprompter_tcp_command(command))
-        asyncio.create_task(self.handle_lectern_tcp_command(command))
-        
+        await self.stop_for_maintenance()
+        self.lectern.home()
+
+    def handle_teleprompter_command(self, verb: str, *args):
+        print(f"Running teleprompter command: {verb} {args}")
 
     def kill_processes(self):
         self.lectern.shutdown()
         self.osc.stop()
 
     def reboot(self):
+        print("Rebooting system...")
         self.kill_processes()
         self.run_bash_command("sudo reboot 0")
 
     def shutdown(self):
+        print("Shutting down system...")
         self.kill_processes()
         self.run_bash_command("sudo shutdown 0")
                               
@@ -158,8 +224,10 @@ class System:
         subprocess.run(command.split(' '))
         
     async def start(self):
+        self.recorder.open()
         self.tasks.append(asyncio.create_task(self.lectern.start()))
-        self.osc.start()
+        self.e_stop.start()
+        await self.osc.start()
         self.tasks.append(asyncio.create_task(self.tcp.start()))
         self.tasks.append(asyncio.create_task(self.start_emitter()))
         self.tasks.append(asyncio.create_task(self.handle_osc_queue()))
@@ -168,83 +236,139 @@ class System:
     async def handle_osc_queue(self):
         print("Starting OSC queue handler")
         while True:
-            command = self.osc_queue.get(
-            )
-            if command is None:
-                await asyncio.sleep(0.1)
-                continue
-            try:
-                await self.handle_osc_command(command)
-            except Exception as e:
-                print(f"Error handling OSC command: {e}")
-            await asyncio.sleep(0.1)  # Prevent busy-waiting
+            command = await self.osc_queue.get()
+            await self.run_command("OSC", self.osc_router, command)
 
     async def handle_tcp_queue(self):
         print("Starting TCP queue handler")
         while True:
-            command = self.tcp_queue.get(
-            )
-            if command is None:
-                await asyncio.sleep(0.1)
-                continue
-            try:
-                await self.handle_tcp_command(command)
-            except Exception as e:
-                print(f"Error handling TCP command: {e}")
-            await asyncio.sleep(0.1)
+            command = await self.tcp_queue.get()
+            await self.run_command("TCP", self.tcp_router, command)
+
+    async def run_command(self, lane: str, router: Router, command: Q.System_Command):
+        '''
+        Run a command as its own task so a safety command can cancel it without taking the queue handler down.
+        '''
+        task = asyncio.create_task(router.dispatch(command))
+        self.in_flight[lane] = (command, task)
+        try:
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            self.in_flight.pop(lane, None)
+        if task.cancelled():
+            print(f"{lane} command preempted: {command.command}")
+        elif task.exception() is not None:
+            print(f"Error handling {lane} command: {task.exception()}")
+
+    def preempt(self):
+        '''
+        Cancel the commands in flight and drop the queued commands that drive the lectern. Everything else (dumps,
+        subscriptions, clearing a fault, a reboot waiting for the lectern to stop) is left to finish.
+        '''
+        for command, task in self.in_flight.values():
+            if command.route.motion:
+                task.cancel()
+        self.osc_queue.clear_motion()
+        self.tcp_queue.clear_motion()
+
+    def handle_e_stop_trip(self, source: str):
+        '''
+        Runs on the event loop after the e-stop listener has already cut the motor, to bring the rest of the system
+        in line.
+        '''
+        print(f"E-stop fault latched ({source}), send clear_fault over TCP to resume")
+        self.preempt()
+        self.lectern.stop()
+
+    def handle_priority_command(self, command: Q.System_Command):
+        '''
+        Safety commands (stop, e_stop, lock) from either queue. They run as soon as they reach the event loop, ahead
+        of anything queued, and cancel the lectern command in flight.
+        '''
+        print(f"Running priority command: {command.verb} for {command.who}")
+        self.preempt()
+        command.route.handler(command.queued_at)
+
+    def state(self) -> lectern.UDPSystemState:
+        S = self.lectern.bus.latest
+        return lectern.UDPSystemState(
+            sensors=S.to_dict(),
+            motor_speed=round(self.lectern.motor.speed / lectern.MAX_SPEED, lectern.SIG_FIGS),
+            state=self.lectern.state.to_dict(),
+            command_ready=self.lectern.command_ready,
+            gpio_moving=self.lectern.gpio_moving,
+            target_speed=round(self.lectern.target_motor_speed, lectern.SIG_FIGS),
+            gpio_target_motor_speed=round(self.lectern.gpio_target_motor_speed, lectern.SIG_FIGS),
+            backlog = [command.command for command in self.osc_queue.queue],
+            current_command = None,
+            target_pos=round(self.lectern.target_pos, lectern.SIG_FIGS),
+            start_pos=round(self.lectern.start_pos, lectern.SIG_FIGS),
+            velocity=round(self.lectern.velocity, lectern.SIG_FIGS),
+            motor_state=self.lectern.motor.state.to_dict(),
+            global_state=self.lectern.global_state.to_dict(),
+            proximity_up=round(self.lectern.calibration.top - S['position'], lectern.SIG_FIGS), #if self.calibration_state == CalibrationState.DONE and abs(self.calibration.top - S['position']) <= LIMIT_SLOW_DOWN_DISTANCE else 9999,
+            proximity_down=round(S['position'] - self.lectern.calibration.bottom, lectern.SIG_FIGS), #if self.calibration_state == CalibrationState.DONE and abs(S['position'] - self.calibration.bottom) <= LIMIT_SLOW_DOWN_DISTANCE else -9999,
+            calibration=self.lectern.calibration.__dict__,
+            speed_multiplier=round(self.lectern.speed_multiplier, lectern.SIG_FIGS),
+            scheduler=self.lectern.scheduler.to_dict(),
+            estimate={k: round(v, 3) for k, v in self.lectern.estimate.items()},
+            motor_output=self.lectern.motor.output.to_dict(),
+            setpoint={k: round(v, 3) for k, v in self.lectern.setpoint._asdict().items()} if self.lectern.profile else None,
+            eta=round(self.lectern.eta(), lectern.SIG_FIGS),
+            tracking_error=round(self.lectern.tracking_error, 3),
+            queues={'osc': self.osc_queue.stats(), 'tcp': self.tcp_queue.stats()},
+            stop_latency=self.lectern.stop_latency,
+            remote_locked=self.lectern.remote_locked,
+            e_stop=self.e_stop.to_dict(),
+            osc=self.osc.to_dict(),
+        )
+
+    def encode_state(self, stream: Stream, state: lectern.UDPSystemState = None):
+        '''
+        :param state: self.state(), if it was already built for another stream
+        :return: The stream's next payload
+        '''
+        if stream.format == TelemetryFormat.JSON:
+            return json.dumps(stream.select(state or self.state())).encode('utf-8')
+        return stream.encoder.encode(self)
 
     async def start_emitter(self):
-        print(f"Starting UDP emitter on port {self.udp_port}")
+        print(f"Starting UDP emitter on port {self.udp_port} ({self.telemetry_format.to_dict()})")
+        subscribers = self.subscribers
         while True:
-            S = self.lectern.sensors.read()
-            try:
-                state = lectern.UDPSystemState(
-                    sensors=S,
-                    motor_speed=round(self.lectern.motor.speed / lectern.MAX_SPEED, lectern.SIG_FIGS),
-                    state=self.lectern.state.to_dict(),
-                    command_ready=self.lectern.command_ready,
-                    gpio_moving=self.lectern.gpio_moving,
-                    target_speed=round(self.lectern.target_motor_speed, lectern.SIG_FIGS),
-                    gpio_target_motor_speed=round(self.lectern.gpio_target_motor_speed, lectern.SIG_FIGS),
-                    # backlog = self.osc_queue.queue,
-                    backlog = [],
-                    current_command = None,
-                    target_pos=round(self.lectern.target_pos, lectern.SIG_FIGS),
-                    start_pos=round(self.lectern.start_pos, lectern.SIG_FIGS),
-                    velocity=round(self.lectern.velocity, lectern.SIG_FIGS),
-                    motor_state=self.lectern.motor.state.to_dict(),
-                    global_state=self.lectern.global_state.to_dict(),
-                    proximity_up=round(self.lectern.calibration.top - S['position'], lectern.SIG_FIGS), #if self.calibration_state == CalibrationState.DONE and abs(self.calibration.top - S['position']) <= LIMIT_SLOW_DOWN_DISTANCE else 9999,
-                    proximity_down=round(S['position'] - self.lectern.calibration.bottom, lectern.SIG_FIGS), #if self.calibration_state == CalibrationState.DONE and abs(S['position'] - self.calibration.bottom) <= LIMIT_SLOW_DOWN_DISTANCE else -9999,
-                    calibration=self.lectern.calibration.__dict__,
-                    speed_multiplier=round(self.lectern.speed_multiplier, lectern.SIG_FIGS)
-                )
-                payload = json.dumps(state).encode('utf-8')
-
-                self.socket.sendto(
-                    payload,
-                    ('localhost', self.udp_port)
-                )
-                for client in self.tcp.clients:
-                    # print(f"Sending UDP state to {client.address}")
-                    self.socket.sendto(
-                        payload,
-                        # client.address
-                        (client.address[0], self.udp_port)
-                    )
-            except Exception as e:
-                print(f"Error creating UDP state: {e}")
-
-            await asyncio.sleep(self.emit_tick_speed / 1000)
+            if self.lectern.bus.latest is None:
+                await self.lectern.bus.next_frame()
+                continue
+            now = clock.now()
+            if self.lectern.state_changed.is_set():
+                # A limit hit, lock, calibration step or move starting or ending: tell everyone now
+                self.lectern.state_changed.clear()
+                subscribers.set_active(self.lectern.active())
+                subscribers.burst(now)
+            subscribers.expire(now)
+            state = None
+            for stream in subscribers.due(now):
+                try:
+                    if stream.format == TelemetryFormat.JSON and state is None:
+                        state = self.state() # Once for all the JSON streams due
+                    subscribers.send(stream, self.encode_state(stream, state))
+                except Exception as e:
+                    print(f"Error creating UDP state: {e}")
+            await subscribers.wait(self.lectern.state_changed)
 
     async def stop(self):
         # clear queues
         self.osc_queue.clear()
         self.tcp_queue.clear()
+        self.e_stop.stop()
         await self.lectern.e_stop()
         for task in self.tasks:
             task.cancel()
         await asyncio.gather(*self.tasks, return_exceptions=True)
         await self.lectern.cleanup()
         self.tasks.clear()
-        self.osc.stop()
\ No newline at end of file
+        self.osc.stop()
+        self.recorder.close()
\ No newline at end of file
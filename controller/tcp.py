@@ -1,5 +1,7 @@
 import asyncio
+from typing import Callable
 import Q
+from router import Router, CommandError
 
 class TCPClient:
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -35,11 +37,18 @@ class TCPClient:
 
 
 class TCPServer:
-    def __init__(self, host: str, port: int, queue: Q.SystemQueue):
+    def __init__(self, host: str, port: int, queue: Q.SystemQueue, router: Router, on_connect: Callable[[tuple], None] = None, on_disconnect: Callable[[tuple], None] = None):
+        '''
+        :param on_connect: Called with a client's address when it connects
+        :param on_disconnect: Called with a client's address when it is gone
+        '''
         print(f"Initializing TCP Server on {host}:{port}")
         self.host = host
         self.port = port
         self.queue = queue
+        self.router = router
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
         self.clients: set[TCPClient] = set()
         self.running = False
         self._server = None
@@ -66,6 +75,8 @@ class TCPServer:
         client = TCPClient(reader, writer)
         self.clients.add(client)
         print(f"New client connected: {client.address}")
+        if self.on_connect is not None:
+            self.on_connect(client.address)
 
         try:
             while self.running:
@@ -73,13 +84,21 @@ class TCPServer:
                 if not data:
                     break
                 print(f"Received from {client.address}: {data}")
-                self.queue.put(Q.System_Command(command=data))
+                try:
+                    command = self.router.parse(data)
+                except CommandError as e:
+                    await client.send(f"Error: {e}")
+                    continue
+                command.source = client.address
+                self.queue.put(command)
                 await client.send(f"Echo: {data}")
         except asyncio.CancelledError:
             pass
         finally:
             client.close()
-            self.clients.remove(client)
+            self.clients.discard(client)
+            if self.on_disconnect is not None:
+                self.on_disconnect(client.address)
             print(f"Client disconnected: {client.address}")
 
     async def stop(self):
@@ -0,0 +1,305 @@
+'''
+fileoverview: Binary telemetry for the UDP state stream. The state is packed into a frame buffer that is allocated
+once, using the versioned layout in telemetry_decoder.py: enum codes instead of names, the switches and booleans as
+bitfields, and only the command backlog and e-stop source as strings. Most of the state (calibration, enums, switches,
+queue stats) sits still for minutes, so frames are deltas that only carry the fields that changed since the previous
+frame, with a full keyframe every keyframe_interval frames or when one is requested. Changes are found by comparing
+the fields as they are packed (floats as float32), so a value that moves less than a float32 can show is not a change.
+
+JSON is still available (TelemetryFormat.JSON) for clients that have not moved to the decoder yet, like the web app.
+
+A subscriber can ask for a subset of the state by its top level keys (FIELD_GROUPS, see subscribers.py). JSON frames
+then only have those keys. Binary deltas only carry the fields behind them, but keyframes stay complete, so the
+decoder always has a whole state to apply deltas to.
+
+Run this file to compare both formats on the simulator:
+    python3 telemetry.py
+'''
+
+from enum import Enum, auto
+from itertools import islice
+import struct
+import clock
+from inputs import SwitchSnapshot
+from lectern import MAX_SPEED
+from telemetry_decoder import (
+    HEADER, BODY, MAGIC, VERSION, FULL_FRAME, DELTA_FRAME, FIELDS, TRAILER_BIT, MASK_BYTES, SWITCHES,
+    MAX_STRING, MAX_BACKLOG, MAX_FRAME_SIZE
+)
+
+KEYFRAME_INTERVAL = 20 # frames, 0.6s at the 30ms emit rate of main.py
+MAX_LAYOUTS = 256 # Sets of changed fields whose delta layout is cached, the same few fields change frame after frame
+
+# Every field in a 4 byte slot, packed the way the frame packs it (floats as float32, the smaller ints widened), and
+# read back as the integers the slots hold: two fields compare equal exactly when their packed bytes do
+SLOTS = struct.Struct('<' + ''.join('f' if code == 'f' else 'I' for _, code in FIELDS))
+SLOT_BITS = struct.Struct(f'<{len(FIELDS)}I')
+
+# Top level keys of the state (UDPSystemState) a subscriber can select
+FIELD_GROUPS = frozenset((
+    'sensors', 'motor_speed', 'state', 'command_ready', 'gpio_moving', 'target_speed', 'gpio_target_motor_speed',
+    'backlog', 'current_command', 'target_pos', 'start_pos', 'velocity', 'motor_state', 'global_state',
+    'proximity_up', 'proximity_down', 'calibration', 'speed_multiplier', 'scheduler', 'estimate', 'motor_output',
+    'setpoint', 'eta', 'tracking_error', 'queues', 'stop_latency', 'remote_locked', 'e_stop', 'osc',
+))
+# Keys the decoder derives from other fields
+DERIVED_GROUPS = {
+    'proximity_up': ('sensors', 'calibration'),
+    'proximity_down': ('sensors', 'calibration'),
+}
+# Keys that are (also) in the trailer
+TRAILER_GROUPS = frozenset(('backlog', 'e_stop'))
+
+
+class TelemetryFormat(Enum):
+    BINARY = auto() # telemetry_decoder.py
+    JSON = auto() # UDPSystemState as JSON
+
+    def to_dict(self):
+        return self.name
+
+
+def select(fields: frozenset) -> tuple[tuple[int, ...], bool]:
+    '''
+    :param fields: Keys of FIELD_GROUPS, None for all of them
+    :return: The indices of the FIELDS that carry them (the flags byte always), and whether the trailer does
+    '''
+    if fields is None:
+        return tuple(range(len(FIELDS))), True
+    groups = set(fields)
+    for key in fields:
+        groups.update(DERIVED_GROUPS.get(key, ()))
+    indices = []
+    for i, (name, _) in enumerate(FIELDS):
+        group = name.split('.', 1)[0]
+        if group == 'switches':
+            group = 'sensors'
+        if group == 'flags' or group in groups:
+            indices.append(i)
+    return tuple(indices), bool(groups & TRAILER_GROUPS)
+
+
+class TelemetryEncoder:
+    '''
+    encode() returns a view of the encoder's buffer, valid until the next call: send it before encoding again.
+    '''
+    def __init__(self, keyframe_interval: int = KEYFRAME_INTERVAL, fields: frozenset = None):
+        '''
+        :param keyframe_interval: A full frame every this many frames, 1 to only send full frames
+        :param fields: Keys of FIELD_GROUPS whose changes deltas carry, None for all of them
+        '''
+        self.buffer = bytearray(MAX_FRAME_SIZE)
+        self.view = memoryview(self.buffer)
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.slots = bytearray(SLOTS.size)
+        self.previous: tuple = None # SLOT_BITS of the last frame
+        self.previous_trailer: tuple = None
+        self.since_keyframe = 0
+        self.keyframe_requested = True
+        self.selected, self.send_trailer = select(fields)
+        self.layouts: dict[tuple[int, ...], tuple[struct.Struct, int]] = {} # Changed fields to (struct, mask)
+        self.masks: dict[str, int] = None # Switch masks the translation below was built for
+        self.switch_bits: list[tuple[int, int]] = [] # (GPIO mask in the snapshot, bit in the switches field)
+
+    def switches(self, snapshot: SwitchSnapshot) -> int:
+        '''
+        Snapshots have one bit per GPIO, the frame has one bit per switch in SWITCHES order.
+        '''
+        if snapshot.masks is not self.masks:
+            self.masks = snapshot.masks
+            self.switch_bits = [(snapshot.masks[name], 1 << i) for i, name in enumerate(SWITCHES) if name in snapshot.masks]
+        bits = 0
+        levels = snapshot.bits
+        for mask, bit in self.switch_bits:
+            if levels & mask:
+                bits |= bit
+        return bits
+
+    def write_string(self, offset: int, value: str) -> int:
+        data = value.encode()[:MAX_STRING]
+        end = offset + 1 + len(data)
+        self.buffer[offset] = len(data)
+        self.buffer[offset + 1:end] = data
+        return end
+
+    def write_trailer(self, offset: int, trailer: tuple[str, tuple[str, ...]]) -> int:
+        source, backlog = trailer
+        offset = self.write_string(offset, source)
+        self.buffer[offset] = len(backlog)
+        offset += 1
+        for command in backlog:
+            offset = self.write_string(offset, command)
+        return offset
+
+    def request_keyframe(self):
+        '''
+        Make the next frame a full frame, for a client that just joined or lost track of the stream.
+        '''
+        self.keyframe_requested = True
+
+    def encode(self, system) -> memoryview:
+        '''
+        :param system: The system.System to report on
+        :return: The frame
+        '''
+        values = self.values(system)
+        SLOTS.pack_into(self.slots, 0, *values)
+        bits = SLOT_BITS.unpack_from(self.slots)
+        trailer = (system.e_stop.source or '', tuple(command.command for command in islice(system.osc_queue.queue, MAX_BACKLOG)))
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        buffer = self.buffer
+        previous = self.previous
+        if self.keyframe_requested or previous is None or self.since_keyframe + 1 >= self.keyframe_interval:
+            HEADER.pack_into(buffer, 0, MAGIC, VERSION, FULL_FRAME, self.seq, clock.now())
+            BODY.pack_into(buffer, HEADER.size, *values)
+            offset = self.write_trailer(HEADER.size + BODY.size, trailer)
+            self.since_keyframe = 0
+            self.keyframe_requested = False
+        else:
+            HEADER.pack_into(buffer, 0, MAGIC, VERSION, DELTA_FRAME, self.seq, clock.now())
+            changed = tuple([i for i in self.selected if bits[i] != previous[i]])
+            packed, mask = self.layout(changed)
+            offset = HEADER.size + MASK_BYTES
+            packed.pack_into(buffer, offset, *[values[i] for i in changed])
+            offset += packed.size
+            if self.send_trailer and trailer != self.previous_trailer:
+                mask |= TRAILER_BIT
+                offset = self.write_trailer(offset, trailer)
+            buffer[HEADER.size:HEADER.size + MASK_BYTES] = mask.to_bytes(MASK_BYTES, 'little')
+            self.since_keyframe += 1
+        self.previous = bits
+        self.previous_trailer = trailer
+        return self.view[:offset]
+
+    def layout(self, changed: tuple[int, ...]) -> tuple[struct.Struct, int]:
+        '''
+        :return: The struct that packs the changed fields, and the mask with their bits set
+        '''
+        layout = self.layouts.get(changed)
+        if layout is None:
+            layout = (struct.Struct('<' + ''.join(FIELDS[i][1] for i in changed)), sum(1 << i for i in changed))
+            if len(self.layouts) < MAX_LAYOUTS:
+                self.layouts[changed] = layout
+        return layout
+
+    def values(self, system) -> tuple:
+        '''
+        :return: The value of every field, in FIELDS order
+        '''
+        lectern = system.lectern
+        frame = lectern.bus.latest
+        motor = lectern.motor
+        calibration = lectern.calibration
+        estimate = lectern.estimate
+        setpoint = lectern.setpoint
+        scheduler = lectern.scheduler
+        output = motor.output.to_dict()
+        stop_latency = lectern.stop_latency
+        osc_queue = system.osc_queue
+        tcp_queue = system.tcp_queue
+        e_stop = system.e_stop
+        osc = system.osc
+        # In FLAGS order
+        flags = (
+            lectern.command_ready
+            | lectern.gpio_moving << 1
+            | lectern.remote_locked << 2
+            | e_stop.fault << 3
+            | (lectern.profile is not None) << 4
+        )
+        return (
+            frame.position, frame.position_age, frame.position_raw, frame.position_seq,
+            self.switches(frame.switches), flags,
+            lectern.state.value, motor.state.value, lectern.global_state.value,
+            motor.speed / MAX_SPEED, lectern.target_motor_speed, lectern.gpio_target_motor_speed, lectern.speed_multiplier,
+            lectern.target_pos, lectern.start_pos, lectern.velocity,
+            calibration.top, calibration.bottom, calibration.velocity, calibration.acceleration, calibration.jerk,
+            estimate['position'], estimate['velocity'], estimate['position_std'], estimate['velocity_std'],
+            setpoint.position, setpoint.velocity, setpoint.acceleration,
+            lectern.eta(), lectern.tracking_error,
+            scheduler.ticks, scheduler.missed, scheduler.skipped, scheduler.dt, scheduler.jitter, scheduler.max_jitter,
+            output['writes'], output['elided'], output['writes_per_second'], output['latency'], output['max_latency'],
+            stop_latency['count'], stop_latency['last'], stop_latency['average'], stop_latency['max'], stop_latency['late'],
+            len(osc_queue.queue), osc_queue.max_depth, osc_queue.commands, osc_queue.coalesced, osc_queue.wait, osc_queue.max_wait,
+            len(tcp_queue.queue), tcp_queue.max_depth, tcp_queue.commands, tcp_queue.coalesced, tcp_queue.wait, tcp_queue.max_wait,
+            e_stop.trips, e_stop.latency, e_stop.max_latency,
+            osc.commands, osc.rejected, osc.malformed,
+        )
+
+
+if __name__ == '__main__':
+    import asyncio
+    import json
+    import time
+    import simulate
+    import telemetry_decoder
+    from subscribers import Stream
+    from system import System, SystemConfig
+    from telemetry import TelemetryFormat # The one System compares against, not this module's __main__ copy
+
+    FRAMES = 400 # 30s of telemetry at 75ms
+    EMIT_TICK_SPEED = 75 # ms
+    SUBSET = frozenset(('sensors', 'state', 'eta')) # What a position display subscribes to
+
+    async def stream(system: System, stream: Stream, moving: bool) -> tuple[float, float, list[bytes]]:
+        '''
+        Emit FRAMES frames at the emit rate, the way the emitter does.
+
+        :param moving: Keep the lectern moving back and forth across its range
+
+        :return: (s encoding per frame, bytes per frame, the frames)
+        '''
+        frames = []
+        elapsed = 0.0
+        lectern = system.lectern
+        for _ in range(FRAMES):
+            if moving and lectern.profile is None:
+                lectern.go_to(18 if lectern.estimate['position'] < 12 else 7)
+            start = time.perf_counter()
+            payload = system.encode_state(stream)
+            elapsed += time.perf_counter() - start
+            frames.append(bytes(payload))
+            await asyncio.sleep(EMIT_TICK_SPEED / 1000)
+        return elapsed / FRAMES, sum(len(frame) for frame in frames) / FRAMES, frames
+
+    async def bench() -> list:
+        lectern, backend = simulate.make_lectern()
+        system = System(SystemConfig(lectern=lectern, ip='127.0.0.1', osc_port=0, udp_port=0, tcp_port=0, emit_tick_speed=EMIT_TICK_SPEED))
+        await lectern.start()
+        await asyncio.sleep(3) # start_up jog
+
+        interval = EMIT_TICK_SPEED / 1000
+        results = []
+        for activity in ('moving', 'idle'):
+            for format, keyframe_interval, fields, name in (
+                (TelemetryFormat.JSON, 1, None, 'JSON'),
+                (TelemetryFormat.JSON, 1, SUBSET, 'JSON, ' + ','.join(sorted(SUBSET))),
+                (TelemetryFormat.BINARY, 1, None, 'binary, full frames'),
+                (TelemetryFormat.BINARY, KEYFRAME_INTERVAL, None, f'binary, deltas + keyframe every {KEYFRAME_INTERVAL}'),
+                (TelemetryFormat.BINARY, KEYFRAME_INTERVAL, SUBSET, 'binary, deltas of ' + ','.join(sorted(SUBSET))),
+            ):
+                encode, size, frames = await stream(system, Stream(format, interval, fields, keyframe_interval), activity == 'moving')
+                if format == TelemetryFormat.BINARY and keyframe_interval > 1 and fields is None:
+                    delta_frames = frames
+                results.append((activity, name, encode, size))
+
+        # Following the delta stream gives the same state as decoding full frames, and a lost frame is caught
+        decoder = telemetry_decoder.TelemetryDecoder()
+        states = [decoder.decode(frame) for frame in delta_frames]
+        assert all(state is not None for state in states)
+        full = telemetry_decoder.decode(bytes(system.encode_state(Stream(TelemetryFormat.BINARY, interval, None, 1))))
+        deltas = Stream(TelemetryFormat.BINARY, interval, None, KEYFRAME_INTERVAL)
+        follower = telemetry_decoder.TelemetryDecoder()
+        follower.decode(bytes(system.encode_state(deltas))) # Keyframe, the first frame of a stream
+        system.encode_state(deltas) # Lost
+        lost = follower.decode(bytes(system.encode_state(deltas)))
+        print(f'Full frame state: {json.dumps({k: full[k] for k in ("state", "motor_state", "global_state", "calibration")})}')
+        print(f'Decoder after a lost frame: {lost}, needs a keyframe: {follower.need_keyframe}')
+        await lectern.cleanup()
+        return results
+
+    results = clock.run(bench(), virtual=True)
+    print(f'{"":8} {"":42} {"encode":>9} {"bytes/frame":>12}')
+    for activity, name, encode, size in results:
+        print(f'{activity:8} {name:42} {encode * 1e6:7.1f}us {size:12.0f}')
@@ -0,0 +1,280 @@
+'''
+fileoverview: Decoder for the binary telemetry frames the lectern sends on its UDP state port (see telemetry.py for
+the encoder). This module only needs the standard library so a display or test client can copy it as is, and it is
+also where the wire layout is defined, so the encoder and decoder cannot drift apart.
+
+A frame is little endian:
+    header   magic "LT", format version, frame type, sequence number (uint32), timestamp (float64, s)
+    body     FIELDS, in order, one struct for the whole body
+    trailer  e-stop fault source, then the command backlog, as length prefixed UTF-8 strings
+
+Most frames are deltas against the frame before them (seq - 1). After the header they have a bitmask of MASK_BYTES,
+bit i set when FIELDS[i] changed and the last bit when the trailer changed, followed by only those fields and the
+trailer if it changed. A full frame (keyframe) is sent every few frames and whenever a client asks for one, so a
+client that joins late or loses a datagram is only out of step until the next keyframe.
+
+TelemetryDecoder follows the stream and returns the same shape as the JSON state (UDPSystemState), so a client can
+swap json.loads for it. decode() decodes a single full frame.
+'''
+
+import struct
+
+MAGIC = b'LT'
+VERSION = 1
+
+# Frame types
+FULL_FRAME = 0
+DELTA_FRAME = 1
+
+HEADER = struct.Struct('<2sBBId')
+
+# (name, struct code). Dotted names are nested in the decoded state: sensors.position -> state['sensors']['position']
+FIELDS = (
+    ('sensors.position', 'f'),
+    ('sensors.position_age', 'f'),
+    ('sensors.position_raw', 'f'),
+    ('sensors.position_seq', 'I'),
+    ('switches', 'H'), # Bitfield, see SWITCHES
+    ('flags', 'B'), # Bitfield, see FLAGS
+    ('state', 'B'), # Enum code, see ENUMS
+    ('motor_state', 'B'),
+    ('global_state', 'B'),
+    ('motor_speed', 'f'),
+    ('target_speed', 'f'),
+    ('gpio_target_motor_speed', 'f'),
+    ('speed_multiplier', 'f'),
+    ('target_pos', 'f'),
+    ('start_pos', 'f'),
+    ('velocity', 'f'),
+    ('calibration.top', 'f'),
+    ('calibration.bottom', 'f'),
+    ('calibration.velocity', 'f'),
+    ('calibration.acceleration', 'f'),
+    ('calibration.jerk', 'f'),
+    ('estimate.position', 'f'),
+    ('estimate.velocity', 'f'),
+    ('estimate.position_std', 'f'),
+    ('estimate.velocity_std', 'f'),
+    ('setpoint.position', 'f'),
+    ('setpoint.velocity', 'f'),
+    ('setpoint.acceleration', 'f'),
+    ('eta', 'f'),
+    ('tracking_error', 'f'),
+    ('scheduler.ticks', 'I'),
+    ('scheduler.missed', 'I'),
+    ('scheduler.skipped', 'I'),
+    ('scheduler.last_dt', 'f'),
+    ('scheduler.jitter', 'f'),
+    ('scheduler.max_jitter', 'f'),
+    ('motor_output.writes', 'I'),
+    ('motor_output.elided', 'I'),
+    ('motor_output.writes_per_second', 'f'),
+    ('motor_output.latency', 'f'),
+    ('motor_output.max_latency', 'f'),
+    ('stop_latency.count', 'I'),
+    ('stop_latency.last', 'f'),
+    ('stop_latency.average', 'f'),
+    ('stop_latency.max', 'f'),
+    ('stop_latency.late', 'I'),
+    ('queues.osc.depth', 'I'),
+    ('queues.osc.max_depth', 'I'),
+    ('queues.osc.commands', 'I'),
+    ('queues.osc.coalesced', 'I'),
+    ('queues.osc.wait', 'f'),
+    ('queues.osc.max_wait', 'f'),
+    ('queues.tcp.depth', 'I'),
+    ('queues.tcp.max_depth', 'I'),
+    ('queues.tcp.commands', 'I'),
+    ('queues.tcp.coalesced', 'I'),
+    ('queues.tcp.wait', 'f'),
+    ('queues.tcp.max_wait', 'f'),
+    ('e_stop.trips', 'I'),
+    ('e_stop.latency', 'f'),
+    ('e_stop.max_latency', 'f'),
+    ('osc.commands', 'I'),
+    ('osc.rejected', 'I'),
+    ('osc.malformed', 'I'),
+)
+BODY = struct.Struct('<' + ''.join(code for _, code in FIELDS))
+FIELD_NAMES = tuple(name for name, _ in FIELDS)
+FIELD_STRUCTS = tuple(struct.Struct('<' + code) for _, code in FIELDS)
+TRAILER_BIT = 1 << len(FIELDS)
+MASK_BYTES = (len(FIELDS) + 1 + 7) // 8
+
+# Bit order of the switches field
+SWITCHES = ('min_limit', 'max_limit', 'power', 'main_up', 'main_down', 'secondary_up', 'secondary_down')
+# Bit order of the flags field
+FLAGS = ('command_ready', 'gpio_moving', 'remote_locked', 'e_stop.fault', 'tracking')
+TRACKING = 1 << FLAGS.index('tracking') # A planned move is being tracked, the setpoint fields are valid
+
+# Enum fields, code n is names[n - 1] (the enum values on the lectern), 0 is unknown
+ENUMS = {
+    'state': ('STAND_BY', 'MOVING', 'ACCELERATING', 'CALIBRATING', 'LOCK'),
+    'motor_state': ('STAND_BY', 'RUNNING', 'STOPPING', 'STOPPED', 'CALIBRATING', 'TESTING'),
+    'global_state': ('SHUTDOWN', 'STARTUP', 'RUNNING', 'CALIBRATING'),
+}
+
+MAX_STRING = 255 # bytes, longer strings in the trailer are cut
+MAX_BACKLOG = 16 # Commands listed in the trailer, the queue depth is in the body
+MAX_FRAME_SIZE = HEADER.size + MASK_BYTES + BODY.size + 1 + MAX_STRING + 1 + MAX_BACKLOG * (1 + MAX_STRING)
+
+
+class TelemetryError(ValueError):
+    pass
+
+
+def read_string(data, offset: int) -> tuple[str, int]:
+    if offset >= len(data):
+        raise TelemetryError('Frame is truncated')
+    size = data[offset]
+    offset += 1
+    if offset + size > len(data):
+        raise TelemetryError('Frame is truncated')
+    return bytes(data[offset:offset + size]).decode('utf-8', 'replace'), offset + size
+
+
+def decode_header(data) -> tuple[int, int, float]:
+    '''
+    :return: (frame type, sequence number, timestamp)
+    :raises TelemetryError: if data is not a telemetry frame of this version
+    '''
+    if len(data) < HEADER.size:
+        raise TelemetryError('Frame is truncated')
+    magic, version, frame_type, seq, timestamp = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise TelemetryError('Not a telemetry frame')
+    if version != VERSION:
+        raise TelemetryError(f'Unsupported telemetry version {version}, expected {VERSION}')
+    return frame_type, seq, timestamp
+
+
+def read_trailer(data, offset: int) -> tuple[str, list[str], int]:
+    '''
+    :return: (e-stop source, backlog, offset after the trailer)
+    '''
+    source, offset = read_string(data, offset)
+    if offset >= len(data):
+        raise TelemetryError('Frame is truncated')
+    count = data[offset]
+    offset += 1
+    backlog = []
+    for _ in range(count):
+        command, offset = read_string(data, offset)
+        backlog.append(command)
+    return source, backlog, offset
+
+
+def nest(values: dict) -> dict:
+    '''
+    Expand dotted field names into nested dicts.
+    '''
+    state = {}
+    for name, value in values.items():
+        node = state
+        *path, key = name.split('.')
+        for part in path:
+            node = node.setdefault(part, {})
+        node[key] = value
+    return state
+
+
+def to_state(values: list, source: str, backlog: list[str], seq: int, timestamp: float) -> dict:
+    '''
+    The JSON state shape from raw field values in FIELDS order and the trailer, plus the frame's seq and timestamp.
+    '''
+    values = dict(zip(FIELD_NAMES, values))
+    switches = values.pop('switches')
+    flags = values.pop('flags')
+    for i, name in enumerate(SWITCHES):
+        values[f'sensors.{name}'] = bool(switches & (1 << i))
+    for i, name in enumerate(FLAGS):
+        values[name] = bool(flags & (1 << i))
+    for name, names in ENUMS.items():
+        code = values[name]
+        values[name] = names[code - 1] if 0 < code <= len(names) else 'UNKNOWN'
+    values['e_stop.source'] = source or None
+    state = nest(values)
+
+    if not state.pop('tracking'):
+        state['setpoint'] = None
+    sensors = state['sensors']
+    calibration = state['calibration']
+    state['proximity_up'] = calibration['top'] - sensors['position']
+    state['proximity_down'] = sensors['position'] - calibration['bottom']
+    state['backlog'] = backlog
+    state['current_command'] = None
+    state['seq'] = seq
+    state['timestamp'] = timestamp
+    return state
+
+
+def decode(data) -> dict:
+    '''
+    Decode a single full frame.
+
+    :raises TelemetryError: if it is not a valid full frame
+    '''
+    frame_type, seq, timestamp = decode_header(data)
+    if frame_type != FULL_FRAME:
+        raise TelemetryError(f'Frame type {frame_type} is not a full frame, decode the stream with TelemetryDecoder')
+    if len(data) < HEADER.size + BODY.size:
+        raise TelemetryError('Frame is truncated')
+    values = BODY.unpack_from(data, HEADER.size)
+    source, backlog, _ = read_trailer(data, HEADER.size + BODY.size)
+    return to_state(values, source, backlog, seq, timestamp)
+
+
+class TelemetryDecoder:
+    '''
+    Follows a telemetry stream. Deltas are applied to the state of the previous frame, so after a lost or reordered
+    datagram decode() returns None until the next keyframe; need_keyframe tells the client to ask for one
+    ("/telemetry_keyframe" on the TCP control port) instead of waiting.
+    '''
+    def __init__(self):
+        self.values: list = None # Raw field values of the last frame, in FIELDS order
+        self.source = ''
+        self.backlog: list[str] = []
+        self.seq: int = None
+        self.need_keyframe = True
+        self.frames = 0
+        self.dropped = 0 # Deltas that could not be applied
+
+    def decode(self, data) -> dict:
+        '''
+        :return: The state after this frame, None if it cannot be known until the next keyframe
+        :raises TelemetryError: if it is not a valid frame
+        '''
+        frame_type, seq, timestamp = decode_header(data)
+        offset = HEADER.size
+        if frame_type == FULL_FRAME:
+            if len(data) < offset + BODY.size:
+                raise TelemetryError('Frame is truncated')
+            values = list(BODY.unpack_from(data, offset))
+            self.source, self.backlog, _ = read_trailer(data, offset + BODY.size)
+        elif frame_type == DELTA_FRAME:
+            if self.values is None or self.seq is None or seq != (self.seq + 1) & 0xFFFFFFFF:
+                self.need_keyframe = True
+                self.seq = None
+                self.dropped += 1
+                return None
+            if len(data) < offset + MASK_BYTES:
+                raise TelemetryError('Frame is truncated')
+            mask = int.from_bytes(data[offset:offset + MASK_BYTES], 'little')
+            offset += MASK_BYTES
+            values = list(self.values) # A frame that turns out to be truncated leaves the state as it was
+            try:
+                for i, field in enumerate(FIELD_STRUCTS):
+                    if mask >> i & 1:
+                        values[i] = field.unpack_from(data, offset)[0]
+                        offset += field.size
+            except struct.error:
+                raise TelemetryError('Frame is truncated')
+            if mask & TRAILER_BIT:
+                self.source, self.backlog, _ = read_trailer(data, offset)
+        else:
+            raise TelemetryError(f'Unknown frame type {frame_type}')
+        self.values = values
+        self.seq = seq
+        self.need_keyframe = False
+        self.frames += 1
+        return to_state(values, self.source, list(self.backlog), seq, timestamp)
@@ -0,0 +1,24 @@
+'''
+fileoverview: The controller modules import each other by bare name (they run from controller/), so put that
+directory on the path for the tests. Run them from controller/:
+    python3 -m pytest tests
+'''
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clock
+
+
+@pytest.fixture
+def virtual_clock():
+    '''
+    A VirtualClock installed for the test, advanced by hand.
+    '''
+    installed = clock.VirtualClock()
+    clock.install(installed)
+    yield installed
+    clock.uninstall()
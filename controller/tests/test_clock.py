@@ -0,0 +1,65 @@
+import asyncio
+import time
+import clock
+import hardware
+import simulate
+
+
+def test_now_follows_the_installed_clock(virtual_clock):
+    assert clock.is_virtual()
+    virtual_clock.advance(2.5)
+    assert clock.now() == 2.5
+    virtual_clock.advance(-1) # Time never goes backwards
+    assert clock.now() == 2.5
+
+
+def test_uninstall_goes_back_to_monotonic():
+    clock.install(clock.VirtualClock(start=-1000))
+    clock.uninstall()
+    assert not clock.is_virtual()
+    assert abs(clock.now() - time.monotonic()) < 1
+
+
+def test_sleeps_cost_no_wall_time():
+    async def main():
+        await asyncio.sleep(3600)
+        return clock.now()
+
+    start = time.monotonic()
+    assert clock.run(main(), virtual=True) == 3600
+    assert time.monotonic() - start < 1
+    assert not clock.is_virtual()
+
+
+def test_timers_fire_in_order():
+    async def main():
+        order = []
+
+        async def wake(delay: float):
+            await asyncio.sleep(delay)
+            order.append((delay, clock.now()))
+
+        await asyncio.gather(wake(3), wake(1), wake(2))
+        return order
+
+    assert clock.run(main(), virtual=True) == [(1, 1), (2, 2), (3, 3)]
+
+
+def test_rate_runs_at_a_multiple_of_real_time():
+    async def main():
+        await asyncio.sleep(1)
+
+    start = time.monotonic()
+    clock.run(main(), virtual=True, rate=10)
+    assert 0.09 < time.monotonic() - start < 0.5
+
+
+def test_simulated_move_runs_on_virtual_time():
+    start = time.monotonic()
+    try:
+        result = clock.run(simulate.run_scenario([16.0]), virtual=True)
+    finally:
+        hardware.set_backend(None)
+    assert len(result['moves']) == 1 # Calibrated, then moved
+    assert result['virtual_time'] > 10 # Start up jog, calibration and the move
+    assert time.monotonic() - start < result['virtual_time']
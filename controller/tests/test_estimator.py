@@ -0,0 +1,60 @@
+import pytest
+from estimator import KalmanEstimator, MAX_REJECTED, MEASUREMENT_NOISE
+
+DT = 0.015
+
+
+def test_first_sample_initializes():
+    estimator = KalmanEstimator()
+    assert estimator.step(DT, 0)['position'] == 0
+    assert not estimator.initialized
+    estimate = estimator.step(DT, 0, 12.0)
+    assert estimate['position'] == 12.0
+    assert estimate['velocity'] == 0
+    assert estimate['position_std'] == pytest.approx(MEASUREMENT_NOISE ** 0.5)
+
+
+def test_update_moves_part_way_and_shrinks_the_uncertainty():
+    estimator = KalmanEstimator()
+    estimator.reset(10.0)
+    estimator.predict(DT, 0)
+    before = estimator.p00
+    assert estimator.update(10.2)
+    assert 10.0 < estimator.position < 10.2
+    assert estimator.p00 < before
+
+
+def test_outliers_are_rejected_until_they_persist():
+    estimator = KalmanEstimator()
+    estimator.reset(10.0)
+    for _ in range(MAX_REJECTED - 1):
+        estimator.predict(DT, 0)
+        assert not estimator.update(20.0)
+        assert estimator.position == pytest.approx(10.0)
+    estimator.predict(DT, 0)
+    assert not estimator.update(20.0)
+    assert estimator.position == 20.0 # Gave up and reset to the measurement
+    assert estimator.rejected == 0
+
+
+def test_tracks_a_constant_velocity_from_late_samples():
+    estimator = KalmanEstimator()
+    velocity = 2.0
+    estimator.step(DT, velocity, 0.0)
+    t = 0.0
+    for _ in range(200):
+        t += DT
+        # A sample reports where the lectern was latency seconds ago
+        estimate = estimator.step(DT, velocity, velocity * (t - estimator.latency))
+    assert estimate['position'] == pytest.approx(velocity * t, abs=0.01)
+    assert estimate['velocity'] == pytest.approx(velocity, abs=0.01)
+
+
+def test_predicts_between_samples_with_the_actuator_lag():
+    estimator = KalmanEstimator()
+    estimator.reset(0.0)
+    for _ in range(100):
+        estimator.predict(DT, 1.0)
+    # After many time constants the velocity has reached the command, and the lag cost about tau of travel
+    assert estimator.velocity == pytest.approx(1.0, abs=1e-4)
+    assert estimator.position == pytest.approx(100 * DT - estimator.time_constant, abs=1e-3)
@@ -0,0 +1,45 @@
+import random
+import warnings
+import numpy as np
+import pytest
+import utils
+from filters import ZScoreFilter, MedianFilter, TrimmedMeanFilter
+
+
+def samples(count: int, seed: int = 0) -> list[float]:
+    rng = random.Random(seed)
+    return [300 + rng.gauss(0, 3) + (80 if rng.random() < 0.05 else 0) for _ in range(count)]
+
+
+@pytest.mark.parametrize('capacity', [5, 12, 20])
+def test_zscore_matches_numpy(capacity):
+    zscore = ZScoreFilter(capacity, 3)
+    window = []
+    for sample in samples(5000):
+        window = (window + [sample])[-capacity:]
+        value = zscore.update(sample)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            expected = float(np.average(utils.remove_outliers_zscore(window, 3)))
+        if not np.isnan(expected): # NaN for a window with no spread
+            assert value == pytest.approx(expected, abs=1e-9)
+
+
+def test_zscore_rejects_a_spike():
+    zscore = ZScoreFilter(12, 3)
+    for _ in range(11):
+        zscore.update(300)
+    zscore.update(300.5)
+    assert zscore.update(400) < 301
+
+
+def test_median_and_trimmed_mean():
+    median = MedianFilter(5)
+    trimmed = TrimmedMeanFilter(10, 10)
+    for sample in samples(200, 1):
+        median.update(sample)
+        trimmed.update(sample)
+    window = samples(200, 1)
+    assert median.value == pytest.approx(np.median(window[-5:]))
+    last = sorted(window[-10:])
+    assert trimmed.value == pytest.approx(np.mean(last[1:-1]))
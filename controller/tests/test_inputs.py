@@ -0,0 +1,151 @@
+from inputs import InputBank, TICK_WRAP
+import hardware
+
+PIN = 5
+DEBOUNCE = 1000 # us
+
+
+class Callback:
+    def __init__(self, func):
+        self.func = func
+
+    def cancel(self):
+        self.func = None
+
+
+class EdgeBackend(hardware.Backend):
+    '''
+    GPIO levels and the microsecond tick are set by the test. edge() changes a level and fires its callbacks like
+    pigpio does, set() changes it without a callback.
+    '''
+    def __init__(self):
+        self.levels: dict[int, int] = {}
+        self.now = 0
+        self.bank_reads = 0
+        self.callbacks: dict[int, list[Callback]] = {}
+
+    def setup_input(self, pin: int):
+        self.levels.setdefault(pin, 0)
+
+    def glitch_filter(self, pin: int, steady_us: int):
+        pass
+
+    def read(self, pin: int) -> int:
+        return self.levels[pin]
+
+    def read_bank(self) -> int:
+        self.bank_reads += 1
+        return sum(level << pin for pin, level in self.levels.items())
+
+    def tick(self) -> int:
+        return self.now & TICK_WRAP
+
+    def callback(self, pin: int, edge: int, func):
+        callback = Callback(func)
+        self.callbacks.setdefault(pin, []).append(callback)
+        return callback
+
+    def set(self, pin: int, level: int, at: int):
+        self.now = at
+        self.levels[pin] = level
+
+    def edge(self, pin: int, level: int, at: int):
+        if level in (0, 1):
+            self.set(pin, level, at)
+        for callback in self.callbacks.get(pin, []):
+            if callback.func is not None:
+                callback.func(pin, level, at & TICK_WRAP)
+
+    def sample(self, bank: InputBank, at: int) -> bool:
+        self.now = at
+        return bank.sample()['button']
+
+
+def make_bank(flip: bool = False, start: int = 0):
+    backend = EdgeBackend()
+    backend.now = start
+    changes = []
+    bank = InputBank(backend)
+    bank.add('button', PIN, flip, DEBOUNCE, changes.append)
+    return backend, bank, changes
+
+
+def test_first_edge_is_accepted_immediately():
+    backend, bank, changes = make_bank()
+    backend.edge(PIN, 1, 10)
+    assert changes == [True]
+    assert backend.sample(bank, 20)
+
+
+def test_bounces_are_ignored():
+    backend, bank, changes = make_bank()
+    for i, level in enumerate((1, 0, 1, 0, 1)):
+        backend.edge(PIN, level, 10 + i * 50)
+    assert changes == [True]
+    assert backend.sample(bank, 10 + DEBOUNCE)
+
+
+def test_a_bounce_that_settles_differently_is_picked_up_by_sample():
+    backend, bank, changes = make_bank()
+    backend.edge(PIN, 1, 10)
+    backend.edge(PIN, 0, 60) # Ignored, still bouncing
+    assert backend.sample(bank, 100) # Not stable for long enough yet
+    assert changes == [True]
+    assert not backend.sample(bank, 60 + DEBOUNCE)
+    assert changes == [True, False]
+
+
+def test_press_shorter_than_a_tick_is_latched():
+    backend, bank, changes = make_bank()
+    backend.edge(PIN, 1, 10)
+    backend.edge(PIN, 0, 10 + DEBOUNCE)
+    assert changes == [True, False]
+    assert backend.sample(bank, 20 + DEBOUNCE) # Seen once
+    assert not backend.sample(bank, 30 + DEBOUNCE)
+
+
+def test_flipped_input_is_active_low():
+    backend = EdgeBackend()
+    backend.levels[PIN] = 1
+    bank = InputBank(backend)
+    bank.add('button', PIN, True, DEBOUNCE)
+    assert not backend.sample(bank, 0)
+    backend.edge(PIN, 0, 10)
+    assert backend.sample(bank, 20)
+
+
+def test_debounce_across_tick_wrap():
+    start = TICK_WRAP - 100
+    backend, bank, changes = make_bank(start=start)
+    backend.edge(PIN, 1, start + 10)
+    backend.edge(PIN, 0, start + 200) # 90 us after the wrap, still bouncing
+    assert changes == [True]
+    backend.edge(PIN, 1, start + 300)
+    backend.edge(PIN, 0, start + 10 + DEBOUNCE) # Stable long enough, across the wrap
+    assert changes == [True, False]
+
+
+def test_watchdog_timeouts_are_not_edges():
+    backend, bank, changes = make_bank()
+    backend.edge(PIN, 2, 10)
+    assert changes == []
+
+
+def test_missed_edge_is_caught_by_the_bank_read():
+    backend, bank, changes = make_bank()
+    backend.set(PIN, 1, 10) # No callback
+    assert backend.sample(bank, 10 + DEBOUNCE)
+    assert changes == [True]
+
+
+def test_one_bank_read_per_sample():
+    backend = EdgeBackend()
+    bank = InputBank(backend)
+    for pin in range(8):
+        bank.add(f'input{pin}', pin, False, DEBOUNCE)
+    backend.edge(3, 1, 10)
+    snapshot = bank.sample()
+    assert backend.bank_reads == 1
+    assert snapshot['input3'] and not snapshot['input4']
+    assert 'input7' in snapshot
+    assert snapshot.to_dict() == {f'input{pin}': pin == 3 for pin in range(8)}
@@ -0,0 +1,248 @@
+import asyncio
+import threading
+import pytest
+import clock
+import hardware
+import motor as motor_module
+import simulate
+from hardware import PigpioPWM
+from motor import Motor, MotorConfig, MotorState, OutputStage, Ramp
+from simulator import SimBackend
+
+PIN = 17
+NEUTRAL = 1500
+
+
+class RecordingBackend(hardware.Backend):
+    def __init__(self):
+        self.widths = []
+
+    def set_servo_pulsewidth(self, pin: int, width: float):
+        self.widths.append(width)
+
+
+class FakePi:
+    def __init__(self):
+        self.duty_cycles = []
+
+    def set_PWM_frequency(self, pin: int, frequency: int):
+        pass
+
+    def set_PWM_range(self, pin: int, range: int):
+        pass
+
+    def set_PWM_dutycycle(self, pin: int, duty_cycle: int):
+        self.duty_cycles.append(duty_cycle)
+
+
+def test_unchanged_writes_are_elided():
+    backend = RecordingBackend()
+    output = OutputStage(backend, PIN)
+    assert output.write(1500)
+    assert not output.write(1500)
+    assert output.write(0)
+    assert backend.widths == [1500, 0]
+    stats = output.to_dict()
+    assert stats['writes'] == 2 and stats['elided'] == 1
+
+
+def test_widths_are_quantized_to_the_resolution():
+    backend = RecordingBackend()
+    output = OutputStage(backend, PIN, resolution=5)
+    output.write(1502)
+    assert not output.write(1498) # Same output
+    output.write(1503)
+    assert backend.widths == [1500, 1505]
+
+
+def test_invalidate_forces_the_next_write():
+    backend = RecordingBackend()
+    output = OutputStage(backend, PIN)
+    output.write(1500)
+    output.invalidate()
+    assert output.write(1500)
+    assert backend.widths == [1500, 1500]
+
+
+def test_writes_per_second(virtual_clock):
+    output = OutputStage(RecordingBackend(), PIN)
+    for width in range(1500, 1510):
+        output.write(width)
+    assert output.to_dict()['writes_per_second'] == 0 # Not a second yet
+    virtual_clock.advance(2)
+    assert output.to_dict()['writes_per_second'] == 5
+
+
+def test_led_pwm_skips_unchanged_duty_cycles():
+    pi = FakePi()
+    pwm = PigpioPWM(pi, 12, 100)
+    pwm.start(50)
+    pwm.ChangeDutyCycle(50.2)
+    pwm.ChangeDutyCycle(80)
+    pwm.stop()
+    pwm.stop()
+    assert pi.duty_cycles == [50, 80, 0]
+
+
+def test_idle_lectern_does_not_write_the_motor():
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        await lectern.start()
+        await asyncio.sleep(5) # After the start up jog
+        writes = lectern.motor.output.writes
+        await asyncio.sleep(60)
+        idle_writes = lectern.motor.output.writes - writes
+        await lectern.cleanup()
+        return writes, idle_writes
+
+    try:
+        writes, idle_writes = clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+    assert writes > 0
+    assert idle_writes == 0
+
+
+def run_motor(body, tick_speed: int = 15):
+    '''
+    Run body(motor) on a motor driving the simulated backend without a control loop, on virtual time.
+    '''
+    async def main():
+        backend = SimBackend()
+        hardware.set_backend(backend)
+        motor = Motor(MotorConfig(pin=backend.config['motor_pin'], max=2000, min=1000, zero=NEUTRAL, invert=False, tick_speed=tick_speed, acceleration=5))
+        try:
+            return await body(motor)
+        finally:
+            motor.cancel_ramp()
+    try:
+        return clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+
+
+def test_ramp_speed_is_a_function_of_time():
+    async def body(motor):
+        return Ramp(0.5, -0.5, 2, started=10)
+
+    ramp = run_motor(body)
+    assert ramp.duration == 0.5
+    assert ramp.speed_at(10) == 0.5
+    assert ramp.speed_at(10.25) == pytest.approx(0)
+    assert ramp.speed_at(11) == -0.5
+
+
+def test_ramp_resolves_when_the_target_is_reached():
+    async def body(motor):
+        start = clock.now()
+        speed = await motor.ramp_to(0.5, 2)
+        return speed, motor.speed, clock.now() - start
+
+    speed, motor_speed, elapsed = run_motor(body)
+    assert speed == motor_speed == 0.5
+    assert 0.25 <= elapsed < 0.25 + 0.015 * 2
+
+
+@pytest.mark.parametrize('tick_speed', [5, 50])
+def test_ramp_is_the_same_at_any_tick_speed(tick_speed):
+    async def body(motor):
+        motor.ramp_to(1, 1)
+        await asyncio.sleep(0.5)
+        motor.step()
+        return motor.speed
+
+    assert run_motor(body, tick_speed) == pytest.approx(0.5)
+
+
+def test_replacing_a_ramp_cancels_its_future():
+    async def body(motor):
+        first = motor.ramp_to(1, 1)
+        await asyncio.sleep(0.1)
+        second = motor.ramp_to(-1, 10)
+        await asyncio.sleep(0)
+        return first, await second
+
+    first, speed = run_motor(body)
+    assert first.cancelled()
+    assert speed == -1
+
+
+def test_set_speed_cancels_the_ramp():
+    async def body(motor):
+        ramp = motor.ramp_to(1, 1)
+        await asyncio.sleep(0.1)
+        motor.set_speed(0.2)
+        await asyncio.sleep(1)
+        return ramp, motor.speed
+
+    ramp, speed = run_motor(body)
+    assert ramp.cancelled()
+    assert speed == 0.2
+
+
+def test_accelerate_over_no_time_is_immediate():
+    async def body(motor):
+        done = motor.accelerate_to(0.7, 0)
+        return done.done() and done.result(), motor.speed
+
+    assert run_motor(body) == (0.7, 0.7)
+
+
+@pytest.fixture
+def backend():
+    backend = SimBackend()
+    hardware.set_backend(backend)
+    yield backend
+    hardware.set_backend(None)
+
+
+@pytest.fixture
+def motor(backend) -> Motor:
+    return Motor(MotorConfig(pin=backend.config['motor_pin'], max=2000, min=1000, zero=NEUTRAL, invert=False, tick_speed=15, acceleration=5))
+
+
+def test_trip_cuts_to_neutral_and_latches(motor, backend):
+    motor.apply(0.5)
+    assert backend.physics.pulse_width == 1750
+    motor.trip()
+    assert backend.physics.pulse_width == NEUTRAL
+    assert motor.speed == 0 and motor.state == MotorState.STOPPED
+    motor.apply(0.5)
+    assert backend.physics.pulse_width == NEUTRAL
+    motor.clear_fault()
+    motor.apply(0.5)
+    assert backend.physics.pulse_width == 1750
+
+
+def test_block_cuts_only_the_blocked_direction(motor, backend):
+    motor.apply(-0.5)
+    motor.block(True, True)
+    assert backend.physics.pulse_width == 1250
+    motor.block(False, True)
+    assert backend.physics.pulse_width == NEUTRAL
+    motor.apply(-0.5)
+    assert motor.speed == 0
+    motor.block(False, False)
+    motor.apply(-0.5)
+    assert backend.physics.pulse_width == 1250
+
+
+def test_trip_from_another_thread_is_not_overwritten(motor, backend, monkeypatch):
+    '''
+    An e-stop that lands while apply is between its fault check and its write must still leave the motor cut.
+    '''
+    make_pulse_width = motor_module.make_pulse_width
+    e_stop = threading.Thread(target=motor.trip)
+
+    def tripping(speed, config):
+        monkeypatch.setattr(motor_module, 'make_pulse_width', make_pulse_width)
+        e_stop.start()
+        e_stop.join(0.1) # Blocks on the output lock, so apply finishes first
+        return make_pulse_width(speed, config)
+
+    monkeypatch.setattr(motor_module, 'make_pulse_width', tripping)
+    motor.apply(0.5)
+    e_stop.join(1)
+    assert motor.fault
+    assert backend.physics.pulse_width == NEUTRAL
+    assert motor.speed == 0
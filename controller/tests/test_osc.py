@@ -0,0 +1,97 @@
+import struct
+import pytest
+import osc
+from osc import BUNDLE, MAX_LAYOUTS, OSC_Config, OSC_Server, OSCDecodeError, decode_packet, encode_message, encode_string
+from router import Router, number
+
+
+def bundle(*elements: bytes) -> bytes:
+    data = BUNDLE + bytes(8) # Time tag, ignored
+    for element in elements:
+        data += struct.pack('>i', len(element)) + element
+    return data
+
+
+@pytest.mark.parametrize('args', [
+    (),
+    (0.25,),
+    (12.5, 'in', 4.0),
+    (1, -2, 0.5),
+    ('a', 'four', 'fives'), # Strings padded to 4, 8 and 8 bytes
+    (True, False, None, 3),
+])
+def test_round_trip(args):
+    assert decode_packet(encode_message('/lectern/go_to', *args)) == [('/lectern/go_to', args)]
+
+
+def test_message_without_type_tags():
+    assert decode_packet(encode_string('/lectern/calibrate')) == [('/lectern/calibrate', ())]
+
+
+def test_blob_stays_a_view_into_the_datagram():
+    data = encode_string('/blob') + encode_string(',b') + struct.pack('>i', 5) + b'hello\0\0\0'
+    [(address, (blob,))] = decode_packet(data)
+    assert isinstance(blob, memoryview)
+    assert bytes(blob) == b'hello'
+
+
+def test_bundles_are_flattened_in_order():
+    data = bundle(
+        encode_message('/lectern/move', 0.5),
+        bundle(encode_message('/teleprompter/next'), encode_message('/lectern/bump', 1.0)),
+        encode_message('/lectern/stop'),
+    )
+    assert decode_packet(data) == [
+        ('/lectern/move', (0.5,)), ('/teleprompter/next', ()), ('/lectern/bump', (1.0,)), ('/lectern/stop', ())]
+    assert decode_packet(bundle()) == []
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'lectern/move\0\0\0\0',
+    b'/lectern/move', # No terminator
+    encode_message('/lectern/move', 0.5)[:-2],
+    encode_message('/lectern/go_to', 12.5, 'in', 4.0)[:-4],
+    encode_message('/lectern/go_to', 'in')[:-4],
+    encode_string('/blob') + encode_string(',b') + struct.pack('>i', -1),
+    encode_string('/x') + encode_string(',q') + bytes(4),
+    bundle(encode_message('/lectern/stop'))[:-4],
+    BUNDLE + bytes(8) + struct.pack('>i', -4),
+])
+def test_malformed_packets_are_rejected(data):
+    with pytest.raises(OSCDecodeError):
+        decode_packet(data)
+
+
+def test_layout_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(osc, 'layouts', {})
+    for i in range(MAX_LAYOUTS + 10):
+        tags = ''.join('if'[int(bit)] for bit in format(i, '010b'))
+        assert osc.layout(tags).size == 40
+    assert len(osc.layouts) == MAX_LAYOUTS
+    # Past the limit messages still decode, their layout is just not kept
+    message = encode_message('/x', *([1] * 11))
+    assert decode_packet(message) == [('/x', (1,) * 11)]
+    assert len(osc.layouts) == MAX_LAYOUTS
+
+
+class Sink:
+    def __init__(self):
+        self.commands = []
+
+    def put(self, command):
+        self.commands.append(command)
+
+
+def test_server_counts_what_it_receives():
+    router = Router()
+    router.add('lectern', 'move', print, (number,))
+    sink = Sink()
+    server = OSC_Server(OSC_Config(ip='127.0.0.1', port=0, queue=sink, router=router))
+    sender = ('10.0.0.1', 1000)
+    server.datagram_received(encode_message('/lectern/move', 0.5), sender) # Not started
+    server.running = True
+    server.datagram_received(bundle(encode_message('/lectern/move', 0.5), encode_message('/lectern/fly')), sender)
+    server.datagram_received(b'garbage', sender)
+    assert [command.args for command in sink.commands] == [(0.5,)]
+    assert server.to_dict() == {'commands': 1, 'rejected': 1, 'malformed': 1}
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import tuner
+from PID import DEFAULT_GAINS, PID, Gains, load_gains, save_gains
+from simulator import DEFAULT_SIM_CONFIG, LecternPhysics, SimConfig
+
+PLANT = dict(max_velocity=2.7, down_scale=1.1, time_constant=0.08, deadband=15)
+
+
+def test_missing_profile_falls_back_to_the_default_gains(tmp_path):
+    gains = load_gains(str(tmp_path / 'missing.json'))
+    assert gains == DEFAULT_GAINS
+    gains['kp'] = -1
+    assert DEFAULT_GAINS['kp'] != -1 # A copy
+
+
+def test_gains_round_trip(tmp_path):
+    path = str(tmp_path / 'gains.json')
+    save_gains(Gains(kp=1, ki=0.25, kd=0.125), path, score=3.5)
+    assert load_gains(path) == Gains(kp=1, ki=0.25, kd=0.125)
+
+
+def test_integral_stops_winding_up_when_saturated(virtual_clock):
+    pid = PID(kp=1, ki=1, kd=0)
+    for _ in range(1000):
+        virtual_clock.advance(0.01)
+        output = pid.compute(10, 0, current_speed=1.0) # Far away, motor at full speed
+    assert output > 1
+    assert pid.integral == 0
+    # The integral term alone never exceeds the output range
+    for _ in range(1000):
+        virtual_clock.advance(0.01)
+        pid.compute(0.5, 0, current_speed=0.5)
+    assert pid.ki * pid.integral <= pid.output_limit
+
+
+def test_disabled_pid_has_no_output_and_forgets(virtual_clock):
+    pid = PID(kp=1, ki=1, kd=1)
+    virtual_clock.advance(0.01)
+    pid.compute(0.5, 0, current_speed=0)
+    pid.enabled = False
+    assert pid.compute(5, 0, current_speed=0) == 0
+    assert pid.integral == 0 and pid.last_time is None
+
+
+def commands() -> np.ndarray:
+    '''
+    :return: Rows of (time, speed, position) with positions from the simulator's own physics.
+    '''
+    config = SimConfig({**DEFAULT_SIM_CONFIG, **PLANT})
+    physics = LecternPhysics(config, 0.0)
+    rows = []
+    speeds = [0.5] * 40 + [0.02] * 20 + [-0.8] * 40 + [0.0] * 20 + [1.0] * 30
+    for i, speed in enumerate(speeds):
+        t = i * 0.02
+        physics.step(t)
+        rows.append((t, speed, physics.position))
+        physics.pulse_width = config['zero'] + (config['max'] - config['zero']) * speed if speed >= 0 else config['zero'] + (config['zero'] - config['min']) * speed
+    return np.array(rows)
+
+
+def test_simulate_trace_matches_the_simulator():
+    trace = commands()
+    params = {name: np.array([value]) for name, value in PLANT.items()}
+    positions = tuner.simulate_trace(trace, params, DEFAULT_SIM_CONFIG)[0]
+    assert positions == pytest.approx(trace[:, 2])
+
+
+def test_fit_plant_recovers_the_plant():
+    fit = tuner.fit_plant([commands()])
+    assert fit['rms'] < 0.05
+    assert fit['max_velocity'] == pytest.approx(PLANT['max_velocity'], rel=0.05)
+    assert fit['down_scale'] == pytest.approx(PLANT['down_scale'], rel=0.05)
+    assert fit['time_constant'] == pytest.approx(PLANT['time_constant'], rel=0.25)
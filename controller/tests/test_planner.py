@@ -0,0 +1,146 @@
+import asyncio
+import numpy as np
+import pytest
+import clock
+import hardware
+import simulate
+from lectern import CalibrationState, POS_TOLERANCE
+from planner import MotionLimits, Profile, Setpoint
+
+LIMITS = MotionLimits(velocity=2.0, acceleration=4.0, jerk=20.0)
+DT = 0.001
+
+
+def trace(profile: Profile) -> np.ndarray:
+    '''
+    :return: (position, velocity, acceleration) every DT over the move and a little after
+    '''
+    return np.array([profile.sample(t) for t in np.arange(0, profile.duration + 0.05, DT)])
+
+
+def assert_feasible(profile: Profile, limits: MotionLimits = LIMITS, bounded: bool = True):
+    samples = trace(profile)
+    positions, velocities, accelerations = samples.T
+    assert np.all(np.abs(velocities) <= limits['velocity'] + 1e-9)
+    assert np.all(np.abs(accelerations) <= limits['acceleration'] + 1e-9)
+    assert np.all(np.abs(np.diff(accelerations)) <= limits['jerk'] * DT + 1e-9)
+    # Continuous: no jumps in position or velocity anywhere, segment boundaries included
+    assert np.all(np.abs(np.diff(positions)) <= limits['velocity'] * DT + 1e-9)
+    assert np.all(np.abs(np.diff(velocities)) <= limits['acceleration'] * DT + 1e-9)
+    if bounded:
+        low, high = sorted((profile.start, profile.end))
+        assert np.all((positions >= low - 1e-9) & (positions <= high + 1e-9))
+    assert tuple(samples[0]) == (profile.start, profile.start_velocity, 0.0)
+    assert tuple(samples[-1]) == (profile.end, 0.0, 0.0)
+
+
+@pytest.mark.parametrize('start, end', [(2, 20), (20, 2)])
+def test_long_move_cruises_at_the_velocity_limit(start, end):
+    profile = Profile(start, end, LIMITS)
+    assert_feasible(profile)
+    v, a, j = LIMITS['velocity'], LIMITS['acceleration'], LIMITS['jerk']
+    assert profile.duration == pytest.approx(abs(end - start) / v + v / a + a / j)
+    assert profile.peak_velocity == pytest.approx(v if end > start else -v)
+    assert profile.sample(profile.duration / 2).velocity == pytest.approx(profile.peak_velocity)
+
+
+@pytest.mark.parametrize('distance', [0.01, 0.3, 1.0])
+def test_short_move_never_reaches_the_velocity_limit(distance):
+    profile = Profile(10, 10 + distance, LIMITS)
+    assert_feasible(profile)
+    assert 0 < profile.peak_velocity < LIMITS['velocity']
+    assert trace(profile)[:, 1].max() == pytest.approx(profile.peak_velocity, rel=1e-3)
+
+
+def test_no_move():
+    profile = Profile(5, 5, LIMITS)
+    assert profile.duration == 0
+    assert profile.sample(0) == Setpoint(5, 0.0, 0.0)
+
+
+def test_timed_move_takes_exactly_the_time_asked():
+    fastest = Profile(2, 12, LIMITS)
+    profile = Profile.timed(2, 12, fastest.duration * 1.5, LIMITS)
+    assert profile.duration == pytest.approx(fastest.duration * 1.5, rel=1e-6)
+    assert abs(profile.peak_velocity) < LIMITS['velocity']
+    assert_feasible(profile)
+
+
+@pytest.mark.parametrize('duration', [0, -1, 1.0])
+def test_timed_move_that_cannot_be_made_is_refused(duration):
+    with pytest.raises(ValueError):
+        Profile.timed(2, 12, duration, LIMITS)
+
+
+def test_table_matches_the_profile_on_its_grid():
+    profile = Profile(3, 15, LIMITS)
+    table = profile.table(0.015)
+    assert len(table) == int(np.ceil(profile.duration / 0.015)) + 1
+    for i in range(len(table) - 1):
+        assert table.sample(i * 0.015) == pytest.approx(profile.sample(i * 0.015), abs=1e-9)
+    assert table.sample(profile.duration + 1) == Setpoint(15, 0.0, 0.0)
+    assert table.sample(-1) == Setpoint(3, 0.0, 0.0)
+
+
+@pytest.mark.parametrize('end, velocity', [(15, 1.0), (15, 2.0), (10.5, 1.0), (10, 0.5)])
+def test_move_from_a_moving_start_stops_at_the_end(end, velocity):
+    profile = Profile(10, end, LIMITS, velocity)
+    # Too fast to stop before the end overshoots and comes back
+    assert_feasible(profile, bounded=False)
+    positions = trace(profile)[:, 0]
+    stop = velocity ** 2 / (2 * LIMITS['acceleration']) + velocity * LIMITS['acceleration'] / (2 * LIMITS['jerk'])
+    assert positions.max() <= max(end, 10 + stop) + 1e-6
+
+
+def test_move_against_the_current_velocity_stops_first():
+    profile = Profile(10, 5, LIMITS, 1.5)
+    assert_feasible(profile, bounded=False)
+    samples = trace(profile)
+    turn = np.argmax(samples[:, 1] <= 0)
+    assert 10 < samples[turn, 0] < 10.5
+    assert np.all(samples[turn:, 1] <= 1e-9)
+
+
+def test_retarget_mid_move_keeps_the_velocity():
+    first = Profile(2, 18, LIMITS)
+    t = first.duration / 3
+    position, velocity, _ = first.sample(t)
+    assert velocity == pytest.approx(LIMITS['velocity'])
+    for end in (12, 5):
+        second = Profile(position, end, LIMITS, velocity)
+        assert_feasible(second, bounded=False)
+        assert second.sample(0) == Setpoint(position, velocity, 0.0)
+        assert second.sample(DT).velocity == pytest.approx(velocity, abs=LIMITS['acceleration'] * DT)
+
+
+def test_timed_move_from_a_moving_start():
+    profile = Profile.timed(10, 15, 6.0, LIMITS, 1.0)
+    assert profile.duration == pytest.approx(6.0, rel=1e-6)
+    assert_feasible(profile, bounded=False)
+
+
+def test_lectern_retargeted_mid_move_carries_on_from_its_velocity():
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        await lectern.start()
+        await asyncio.sleep(3) # start_up jog
+        lectern.calibrate()
+        await lectern.calibration_task
+        assert lectern.calibration_state == CalibrationState.DONE
+        lectern.go_to(18)
+        await asyncio.sleep(1.5)
+        moving = lectern.estimate['velocity']
+        lectern.go_to(10)
+        started = lectern.profile.sample(0).velocity
+        await asyncio.sleep(15)
+        position = backend.position
+        await lectern.cleanup()
+        return moving, started, position
+
+    try:
+        moving, started, position = clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+    assert moving > 0.5
+    assert started == moving
+    assert position == pytest.approx(10, abs=POS_TOLERANCE * 2) # Reached, as simulate.run_move counts it
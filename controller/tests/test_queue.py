@@ -0,0 +1,116 @@
+import asyncio
+from Q import SystemQueue, System_Command
+from router import Router, number
+
+ROUTER = Router()
+ROUTER.add('lectern', 'move', print, (number,), coalesce=True, source=True, motion=True)
+ROUTER.add('lectern', 'go_to', print, (number, 'in', number), required=1, coalesce=True, motion=True)
+ROUTER.add('lectern', 'bump', print, (number,), motion=True)
+ROUTER.add('lectern', 'calibrate', print, motion=True)
+ROUTER.add('lectern', 'clear_fault', print)
+ROUTER.add('lectern', 'stop', print, priority=True)
+ROUTER.add('teleprompter', 'next', print)
+ROUTER.add('all', 'system_reboot', print)
+
+
+def command(path: str, source: tuple = None) -> System_Command:
+    command = ROUTER.parse(path)
+    command.source = source
+    return command
+
+
+def paths(queue: SystemQueue) -> list[str]:
+    return [item.command for item in queue.queue]
+
+
+def test_commands_come_out_in_order(virtual_clock):
+    queue = SystemQueue()
+    for path in ('/lectern/bump/1', '/teleprompter/next', '/lectern/calibrate'):
+        queue.put(command(path))
+    virtual_clock.advance(0.5)
+    assert [queue.get_nowait().command for _ in range(3)] == ['/lectern/bump/1', '/teleprompter/next', '/lectern/calibrate']
+    assert queue.get_nowait() is None
+    stats = queue.stats()
+    assert stats['commands'] == 3 and stats['depth'] == 0 and stats['max_depth'] == 3
+    assert stats['max_wait'] == 0.5
+
+
+def test_clear_lectern_keeps_the_other_targets():
+    queue = SystemQueue()
+    for path in ('/lectern/bump/1', '/teleprompter/next', '/lectern/calibrate', '/system_reboot'):
+        queue.put(command(path))
+    queue.clear_lectern()
+    assert paths(queue) == ['/teleprompter/next', '/system_reboot']
+
+
+def test_clear_motion_keeps_the_commands_that_do_not_move_the_lectern():
+    queue = SystemQueue()
+    for path in ('/lectern/go_to/12', '/lectern/clear_fault', '/teleprompter/next', '/lectern/move/0.5', '/system_reboot'):
+        queue.put(command(path))
+    queue.clear_motion()
+    assert paths(queue) == ['/lectern/clear_fault', '/teleprompter/next', '/system_reboot']
+    assert queue.pending == {}
+
+
+def test_get_wakes_up_for_a_command_from_another_thread():
+    async def main():
+        queue = SystemQueue()
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, queue.put, command('/lectern/bump/1'))
+        item = await asyncio.wait_for(queue.get(), 1)
+        return item, queue.stats()
+
+    item, stats = asyncio.run(main())
+    assert item.command == '/lectern/bump/1'
+    assert stats['commands'] == 1
+    assert stats['depth'] == 0
+
+
+def test_setpoints_coalesce_in_place():
+    queue = SystemQueue()
+    queue.put(command('/lectern/move/0.1'))
+    queue.put(command('/teleprompter/next')) # Another target does not stand in the way
+    queue.put(command('/lectern/move/0.2'))
+    queue.put(command('/lectern/go_to/5'))
+    queue.put(command('/lectern/go_to/6/in/2'))
+    assert paths(queue) == ['/lectern/move/0.2', '/teleprompter/next', '/lectern/go_to/6/in/2']
+    assert queue.stats()['coalesced'] == 2
+
+
+def test_other_commands_are_a_barrier():
+    queue = SystemQueue()
+    for path in ('/lectern/move/0.1', '/lectern/bump/1', '/lectern/move/0.2', '/lectern/go_to/5', '/lectern/move/0.3', '/lectern/move/0.4'):
+        queue.put(command(path))
+    assert paths(queue) == ['/lectern/move/0.1', '/lectern/bump/1', '/lectern/move/0.2', '/lectern/go_to/5', '/lectern/move/0.4']
+
+
+def test_a_taken_setpoint_is_not_replaced():
+    queue = SystemQueue()
+    queue.put(command('/lectern/move/0.1'))
+    first = queue.get_nowait()
+    queue.put(command('/lectern/move/0.2'))
+    assert first.command == '/lectern/move/0.1'
+    assert queue.get_nowait().command == '/lectern/move/0.2'
+
+
+def test_priority_commands_skip_the_queue():
+    handled = []
+    queue = SystemQueue(priority=handled.append)
+    queue.put(command('/lectern/move/0.1'))
+    queue.put(command('/lectern/stop'))
+    assert [item.command for item in handled] == ['/lectern/stop']
+    assert paths(queue) == ['/lectern/move/0.1']
+    # Without a handler they queue like anything else
+    queue = SystemQueue()
+    queue.put(command('/lectern/stop'))
+    assert len(queue) == 1
+
+
+def test_coalesced_command_takes_the_newest_source():
+    queue = SystemQueue()
+    queue.put(command('/lectern/move/0.1', ('10.0.0.1', 1000)))
+    queue.put(command('/lectern/move/0.2', ('10.0.0.2', 2000)))
+    assert len(queue) == 1
+    item = queue.get_nowait()
+    assert item.args == (0.2,)
+    assert item.source == ('10.0.0.2', 2000)
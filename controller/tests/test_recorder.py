@@ -0,0 +1,62 @@
+import asyncio
+import numpy as np
+import pytest
+import clock
+import hardware
+import recorder
+import simulate
+from recorder import FlightRecorder
+
+
+@pytest.fixture
+def short_segments(monkeypatch):
+    '''
+    One second segments, so a few seconds of simulation go round the ring.
+    '''
+    monkeypatch.setattr(recorder, 'SEGMENT_SECONDS', 1)
+    yield
+    hardware.set_backend(None)
+
+
+def record(directory, seconds: float, dumps: int = 1) -> tuple[FlightRecorder, dict, list[tuple[int, str]]]:
+    '''
+    Run the simulated lectern for seconds with a 3 segment recorder, then dump.
+
+    :return: (the closed recorder, the switch masks of the last frame, (the last tick when it was asked for, path) of
+    each dump)
+    '''
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        flight = FlightRecorder(str(directory), lectern.tick_speed, minutes=3 / 60)
+        flight.open()
+        lectern.recorder = flight
+        await lectern.start()
+        await asyncio.sleep(seconds)
+        paths = [(flight.seq, await flight.dump(1)) for _ in range(dumps)]
+        masks = lectern.bus.latest.switches.masks
+        await lectern.cleanup()
+        flight.close()
+        return flight, masks, paths
+    return clock.run(main(), virtual=True)
+
+
+def test_dump_round_trips_the_ring_in_order(tmp_path, short_segments):
+    flight, masks, ((last, path),) = record(tmp_path, 5)
+    assert flight.rotations > flight.segment_count # Wrapped round the ring
+    data = np.load(path)
+    seq = data['records']['seq']
+    assert np.all(np.diff(seq) == 1)
+    assert seq[-1] == last # Ticks recorded while the dump was written are not in it
+    assert len(seq) > (flight.segment_count - 1) * flight.segment_size
+    assert np.all(np.diff(data['records']['timestamp']) > 0)
+    assert dict(zip(data['switch_names'], data['switch_masks'].tolist())) == masks
+
+
+def test_dumps_with_the_same_name_do_not_overwrite(tmp_path, short_segments, monkeypatch):
+    monkeypatch.setattr(recorder.time, 'strftime', lambda format, stamp: 'flight-20261017-201500')
+    monkeypatch.setattr(recorder.time, 'time', lambda: 1.5)
+    _, _, paths = record(tmp_path, 0.5, dumps=3)
+    paths = [path for _, path in paths]
+    assert [path.rsplit('/', 1)[1] for path in paths] == [
+        'flight-20261017-201500.500.npz', 'flight-20261017-201500.500-2.npz', 'flight-20261017-201500.500-3.npz']
+    assert all(len(np.load(path)['records']) > 0 for path in paths)
@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from router import ANY_VERB, CommandError, Router, number
+
+
+def make_router() -> Router:
+    router = Router()
+    router.add('lectern', 'move', lambda speed: ('move', speed), (number,))
+    router.add('lectern', 'go_to', lambda *args: ('go_to', *args), (number, 'in', number), required=1)
+    router.add('lectern', 'calibrate', lambda: 'calibrate')
+    router.add('lectern', 'lock', lambda source: ('lock', source), source=True)
+    router.add('teleprompter', ANY_VERB, lambda *args: args, None)
+    router.add('all', 'system_reboot', lambda: 'reboot')
+    return router
+
+
+def test_parses_targets_verbs_and_arguments():
+    router = make_router()
+    command = router.parse('/lectern/go_to/12/in/5')
+    assert (command.who, command.verb, command.args) == ('lectern', 'go_to', (12.0, 5.0))
+    assert router.parse('/lectern/go_to/12').args == (12.0,)
+    assert router.parse('lectern/move/-0.5/\n').args == (-0.5,)
+    assert router.parse('/system_reboot').who == 'all'
+
+
+def test_typed_arguments_follow_the_path():
+    router = make_router()
+    assert router.parse('/lectern/move', (0.25,)).args == (0.25,)
+    assert router.parse('/lectern/go_to/12', ('in', 3)).args == (12.0, 3.0)
+    with pytest.raises(CommandError, match='not a finite number'):
+        router.parse('/lectern/move', (float('nan'),))
+
+
+def test_any_verb_gets_the_verb_and_the_raw_arguments():
+    command = make_router().parse('/teleprompter/scroll/3/fast')
+    assert command.verb == 'scroll'
+    assert command.args == ('scroll', '3', 'fast')
+
+
+@pytest.mark.parametrize('path, message', [
+    ('/lectern/fly/1', 'Unknown command lectern/fly'),
+    ('/reboot', 'Unknown command all/reboot'),
+    ('/lectern', 'No command'),
+    ('/', 'No command'),
+    ('/lectern/move/fast', "'fast' is not a number"),
+    ('/lectern/move/inf', 'not a finite number'),
+    ('/lectern/move', 'needs at least 1 arguments, got 0'),
+    ('/lectern/move/1/2', 'takes at most 1 arguments, got 2'),
+    ('/lectern/go_to/12/at/5', "expected 'in', got 'at'"),
+    ('/lectern/calibrate/now', 'takes at most 0 arguments'),
+])
+def test_malformed_commands_are_rejected(path, message):
+    with pytest.raises(CommandError, match=message):
+        make_router().parse(path)
+
+
+def test_lookups_are_cached_until_the_table_changes():
+    router = make_router()
+    router.parse('/lectern/move/1')
+    assert '/lectern/move/1' in router.paths
+    with pytest.raises(CommandError):
+        router.parse('/lectern/bump/1')
+    router.add('lectern', 'bump', lambda distance: distance, (number,))
+    assert not router.paths
+    assert router.parse('/lectern/bump/1').args == (1.0,)
+
+
+def test_a_cached_path_is_still_checked_every_time():
+    router = make_router()
+    router.parse('/lectern/move', (1,))
+    with pytest.raises(CommandError):
+        router.parse('/lectern/move', ('fast',))
+
+
+def test_dispatch_passes_the_source_when_the_route_asks_for_it():
+    router = make_router()
+    command = router.parse('/lectern/lock')
+    command.source = ('10.0.0.1', 1000)
+    assert asyncio.run(router.dispatch(command)) == ('lock', ('10.0.0.1', 1000))
+    assert asyncio.run(router.dispatch(router.parse('/lectern/move/2'))) == ('move', 2.0)
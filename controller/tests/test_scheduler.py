@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from scheduler import TickScheduler, TickPolicy
+
+PERIOD = 0.01
+
+
+def overrun(virtual_clock, scheduler: TickScheduler, seconds: float) -> float:
+    '''
+    A tick that takes seconds without yielding, then the wait for the next one.
+    '''
+    virtual_clock.advance(seconds)
+    return asyncio.run(scheduler.wait())
+
+
+def test_first_wait_starts_the_grid(virtual_clock):
+    scheduler = TickScheduler(PERIOD * 1000)
+    assert asyncio.run(scheduler.wait()) == pytest.approx(PERIOD)
+    assert scheduler.deadline == 0
+    assert scheduler.ticks == 1
+
+
+def test_skip_drops_missed_ticks_and_realigns(virtual_clock):
+    scheduler = TickScheduler(PERIOD * 1000, TickPolicy.SKIP)
+    asyncio.run(scheduler.wait())
+    dt = overrun(virtual_clock, scheduler, 3.5 * PERIOD)
+    assert dt == pytest.approx(3.5 * PERIOD)
+    assert scheduler.missed == 1
+    assert scheduler.skipped == 2
+    assert scheduler.deadline == pytest.approx(3 * PERIOD) # Back on the grid
+
+
+def test_catch_up_runs_missed_ticks_back_to_back(virtual_clock):
+    scheduler = TickScheduler(PERIOD * 1000, TickPolicy.CATCH_UP)
+    asyncio.run(scheduler.wait())
+    overrun(virtual_clock, scheduler, 3.5 * PERIOD)
+    # The ticks at 2 and 3 periods are run straight away, no time passes between them
+    overrun(virtual_clock, scheduler, 0)
+    overrun(virtual_clock, scheduler, 0)
+    assert scheduler.missed == 3
+    assert scheduler.skipped == 0
+    assert scheduler.deadline == pytest.approx(3 * PERIOD)
+
+
+def test_catch_up_realigns_when_too_far_behind(virtual_clock):
+    scheduler = TickScheduler(PERIOD * 1000, TickPolicy.CATCH_UP, max_catch_up=2)
+    asyncio.run(scheduler.wait())
+    overrun(virtual_clock, scheduler, 10.5 * PERIOD)
+    assert scheduler.skipped == 9
+    assert scheduler.deadline == pytest.approx(10 * PERIOD)
+
+
+@pytest.mark.parametrize('policy', list(TickPolicy))
+def test_overrunning_ticks_still_yield(virtual_clock, policy):
+    scheduler = TickScheduler(PERIOD * 1000, policy)
+    other_ran = 0
+
+    async def other():
+        nonlocal other_ran
+        while True:
+            other_ran += 1
+            await asyncio.sleep(0)
+
+    async def loop():
+        await scheduler.wait()
+        task = asyncio.create_task(other())
+        await asyncio.sleep(0)
+        ran = other_ran
+        for _ in range(10):
+            virtual_clock.advance(2 * PERIOD) # Every tick takes two periods
+            await scheduler.wait()
+        task.cancel()
+        return other_ran - ran
+
+    assert asyncio.run(loop()) >= 10
+    assert scheduler.missed == 10
@@ -0,0 +1,93 @@
+import pytest
+from simulator import DEFAULT_SIM_CONFIG, LecternPhysics, SimBackend, SimConfig
+
+CONFIG = SimConfig(DEFAULT_SIM_CONFIG)
+FULL_UP = CONFIG['max']
+
+
+def physics(**config) -> LecternPhysics:
+    return LecternPhysics(SimConfig({**CONFIG, **config}), 0.0)
+
+
+def test_deadband_does_not_move():
+    model = physics()
+    model.pulse_width = CONFIG['zero'] + CONFIG['deadband']
+    model.step(1.0)
+    assert model.position == CONFIG['start_position']
+
+
+def test_full_pulse_width_reaches_max_velocity():
+    model = physics()
+    model.pulse_width = FULL_UP
+    model.step(2.0)
+    assert model.velocity == pytest.approx(CONFIG['max_velocity'])
+
+
+def test_down_is_faster():
+    model = physics()
+    model.pulse_width = CONFIG['min']
+    model.step(2.0)
+    assert model.velocity == pytest.approx(-CONFIG['max_velocity'] * CONFIG['down_scale'])
+
+
+def test_first_order_lag():
+    model = physics()
+    model.pulse_width = FULL_UP
+    model.step(CONFIG['time_constant'])
+    assert model.velocity == pytest.approx(CONFIG['max_velocity'] * (1 - 1 / 2.718281828), rel=1e-6)
+    # The actuator travels less than it would have at full speed from the start
+    assert model.position - CONFIG['start_position'] < CONFIG['max_velocity'] * CONFIG['time_constant']
+
+
+def test_step_is_independent_of_the_step_size():
+    coarse, fine = physics(), physics()
+    coarse.pulse_width = fine.pulse_width = FULL_UP
+    coarse.step(0.5)
+    for i in range(1, 51):
+        fine.step(i * 0.01)
+    assert fine.position == pytest.approx(coarse.position)
+    assert fine.velocity == pytest.approx(coarse.velocity)
+
+
+def test_hard_stop_past_the_limit_switch():
+    model = physics()
+    model.pulse_width = FULL_UP
+    model.step(60.0)
+    assert model.position == CONFIG['top'] + CONFIG['overtravel']
+    assert model.velocity == 0
+
+
+def test_position_at_interpolates_the_history():
+    model = physics()
+    model.pulse_width = FULL_UP
+    model.step(1.0)
+    model.step(2.0)
+    assert model.position_at(-1.0) == CONFIG['start_position']
+    assert model.position_at(1.5) == pytest.approx((model.position_at(1.0) + model.position_at(2.0)) / 2)
+    assert model.position_at(5.0) == model.position
+
+
+@pytest.mark.parametrize('position, max_level, min_level', [
+    (12.0, 1, 1),
+    (CONFIG['top'] + 0.1, 0, 1),
+    (CONFIG['bottom'] - 0.1, 1, 0),
+])
+def test_limit_switches_are_normally_closed(position, max_level, min_level):
+    backend = SimBackend(SimConfig(start_position=position))
+    assert backend.read(CONFIG['max_limit_pin']) == max_level
+    assert backend.read(CONFIG['min_limit_pin']) == min_level
+
+
+def test_tof_reports_the_position_in_mm():
+    backend = SimBackend(SimConfig(tof_noise=0))
+    assert backend.tof().range == int(CONFIG['start_position'] * 25.4)
+
+
+def test_inputs_are_driven_by_the_scenario():
+    backend = SimBackend()
+    backend.setup_input(5)
+    assert backend.read(5) == 0
+    backend.press(5)
+    assert backend.read(5) == 1
+    backend.release(5)
+    assert backend.read(5) == 0
@@ -0,0 +1,72 @@
+import asyncio
+import pytest
+import clock
+import hardware
+import simulate
+
+FRAMES = 20
+
+
+def run(body):
+    '''
+    Run body(lectern, backend) against the simulated lectern, on virtual time.
+    '''
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        await lectern.start()
+        try:
+            return await body(lectern, backend)
+        finally:
+            await lectern.cleanup()
+    try:
+        return clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+
+
+def test_one_frame_per_tick():
+    async def body(lectern, backend):
+        frames = [await lectern.bus.next_frame() for _ in range(FRAMES)]
+        return frames, lectern.tick_speed / 1000
+
+    frames, period = run(body)
+    assert [frame.seq for frame in frames] == list(range(frames[0].seq, frames[0].seq + FRAMES))
+    for previous, frame in zip(frames, frames[1:]):
+        assert frame.timestamp - previous.timestamp == pytest.approx(period)
+
+
+def test_frames_are_immutable():
+    async def body(lectern, backend):
+        return await lectern.bus.next_frame()
+
+    frame = run(body)
+    with pytest.raises(AttributeError):
+        frame.seq = 0
+    state = frame.to_dict()
+    state['position'] = -1
+    assert frame['position'] != -1
+
+
+def test_latest_is_the_frame_just_published():
+    async def body(lectern, backend):
+        frame = await lectern.bus.next_frame()
+        return frame, lectern.bus.latest, frame.age()
+
+    frame, latest, age = run(body)
+    assert latest is frame
+    assert age == 0
+
+
+def test_wait_for_returns_the_first_matching_frame():
+    async def body(lectern, backend):
+        await lectern.bus.next_frame()
+        backend.press(lectern.config['main_up_pin'])
+        frame = await lectern.bus.wait_for(lambda frame: frame['main_up'])
+        backend.release(lectern.config['main_up_pin'])
+        released = await lectern.bus.wait_for(lambda frame: not frame['main_up'])
+        return frame, released
+
+    pressed, released = run(body)
+    assert pressed['main_up']
+    assert not released['main_up']
+    assert released.seq > pressed.seq
@@ -0,0 +1,132 @@
+import socket
+import pytest
+from router import CommandError
+from subscribers import SubscriberRegistry, SUBSCRIPTION_TTL
+from telemetry import TelemetryFormat
+
+PORT = 41234
+APP = ('127.0.0.1', PORT)
+RATE = 30 # Hz
+HEARTBEAT = 4 # Hz
+
+
+@pytest.fixture
+def registry(virtual_clock):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    registry = SubscriberRegistry(sock, PORT, rate=RATE, heartbeat=HEARTBEAT, format=TelemetryFormat.JSON, keyframe_interval=20)
+    registry.add(APP, permanent=True)
+    yield registry
+    sock.close()
+
+
+def test_streams_run_at_their_own_rate_while_active(registry):
+    stream, = registry.streams.values()
+    assert registry.due(0) == [stream]
+    assert registry.due(0.01) == []
+    assert registry.due(1 / RATE) == [stream]
+    assert stream.next_due == pytest.approx(2 / RATE)
+
+
+def test_idle_streams_drop_to_the_heartbeat(registry):
+    registry.subscribe(('10.0.0.1', 50000), 41235, 1) # Slower than the heartbeat already
+    registry.set_active(False)
+    default, slow = registry.streams.values()
+    assert registry.due(0) == [default, slow]
+    assert registry.due(1 / RATE) == []
+    assert registry.due(1 / HEARTBEAT) == [default]
+    assert registry.due(1) == [default, slow]
+    registry.set_active(True) # A transition, which comes with a burst
+    registry.burst(1.1)
+    registry.due(1.1)
+    assert default.next_due == pytest.approx(1.1 + 1 / RATE)
+
+
+def test_burst_makes_every_stream_due(registry):
+    registry.subscribe(('10.0.0.1', 50000), 41235, 1)
+    registry.set_active(False)
+    registry.due(0)
+    registry.burst(0.1)
+    assert len(registry.due(0.1)) == 2
+    assert registry.bursts == 1
+
+
+def test_a_late_emitter_skips_the_frames_it_missed(registry):
+    stream, = registry.streams.values()
+    registry.due(0)
+    assert registry.due(10) == [stream]
+    assert stream.next_due == pytest.approx(10 + 1 / RATE)
+    assert registry.due(10.01) == []
+
+
+def test_tcp_client_cannot_take_over_the_default_feed(registry):
+    client = ('127.0.0.1', 50000)
+    registry.connected(client)
+    with pytest.raises(CommandError):
+        registry.subscribe(client, PORT, 10, TelemetryFormat.BINARY)
+    feed = registry.subscribers[APP]
+    assert feed.permanent
+    assert feed.stream.format == TelemetryFormat.JSON
+    assert feed.stream.interval == pytest.approx(1 / RATE)
+
+    registry.disconnected(client)
+    registry.expire(SUBSCRIPTION_TTL + 1)
+    assert registry.subscribers[APP] is feed
+
+
+def test_unsubscribe_keeps_the_default_feed(registry):
+    registry.unsubscribe(('127.0.0.1', 50000))
+    assert APP in registry.subscribers
+
+
+def test_subscription_on_another_port_lives_next_to_the_default_feed(registry, virtual_clock):
+    client = ('127.0.0.1', 50000)
+    registry.connected(client)
+    registry.subscribe(client, 41235, 10, TelemetryFormat.BINARY, frozenset(('sensors',)))
+    subscriber = registry.subscribers[('127.0.0.1', 41235)]
+    assert subscriber.stream.format == TelemetryFormat.BINARY
+    assert subscriber.stream is not registry.subscribers[APP].stream
+
+    registry.disconnected(client)
+    registry.expire(virtual_clock.now() + SUBSCRIPTION_TTL - 1)
+    assert ('127.0.0.1', 41235) in registry.subscribers
+    registry.expire(virtual_clock.now() + SUBSCRIPTION_TTL)
+    assert ('127.0.0.1', 41235) not in registry.subscribers
+    assert APP in registry.subscribers
+
+
+def test_subscribers_with_the_same_request_share_a_stream(registry):
+    for port in (41235, 41236):
+        registry.subscribe(('10.0.0.1', 50000 + port), port, 10, TelemetryFormat.BINARY)
+    first, second = registry.subscribers[('10.0.0.1', 41235)], registry.subscribers[('10.0.0.1', 41236)]
+    assert first.stream is second.stream
+    assert len(registry.streams) == 2 # And the default feed's
+
+
+def test_clients_on_one_ip_share_the_default_feed_until_the_last_one_leaves(registry):
+    first, second = ('10.0.0.1', 50000), ('10.0.0.1', 50001)
+    feed = ('10.0.0.1', PORT)
+    registry.connected(first)
+    registry.connected(second)
+    assert registry.subscribers[feed].implicit
+
+    registry.disconnected(first)
+    assert feed in registry.subscribers
+    registry.disconnected(second)
+    assert feed not in registry.subscribers
+
+
+def test_subscribing_leaves_the_default_feed_to_the_other_clients_on_the_ip(registry, virtual_clock):
+    first, second = ('10.0.0.1', 50000), ('10.0.0.1', 50001)
+    feed = ('10.0.0.1', PORT)
+    registry.connected(first)
+    registry.connected(second)
+    registry.subscribe(first, 41235, 10)
+    assert registry.subscribers[feed].implicit
+
+    registry.subscribe(second, PORT, 10) # Takes the default feed's address over
+    registry.connected(('10.0.0.1', 50002))
+    registry.disconnected(second)
+    registry.expire(virtual_clock.now() + SUBSCRIPTION_TTL)
+    subscriber = registry.subscribers[feed]
+    assert subscriber.implicit # Back to the default feed for the client still connected
+    assert subscriber.stream.interval == pytest.approx(1 / RATE)
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+import clock
+import hardware
+import simulate
+from router import CommandError
+from system import System, SystemConfig
+
+
+def run(body):
+    '''
+    Run body(system) on a System driving the simulated lectern, with its queue handlers but no servers, on virtual
+    time.
+    '''
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        system = System(SystemConfig(lectern=lectern, ip='127.0.0.1', osc_port=0, udp_port=0, tcp_port=0, emit_tick_speed=75))
+        await lectern.start()
+        handlers = [asyncio.create_task(system.handle_osc_queue()), asyncio.create_task(system.handle_tcp_queue())]
+        await asyncio.sleep(3)
+        try:
+            return await body(system)
+        finally:
+            for handler in handlers:
+                handler.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await lectern.cleanup()
+    try:
+        return clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+
+
+def test_stop_preempts_the_lectern_commands():
+    async def body(system):
+        calls = []
+        async def slow_bump(distance: float):
+            calls.append('started')
+            await asyncio.sleep(5)
+            calls.append('finished')
+        system.osc_router.routes[('lectern', 'bump')].handler = slow_bump
+        system.osc_queue.put(system.osc_router.parse('/lectern/bump/1'))
+        system.osc_queue.put(system.osc_router.parse('/lectern/calibrate'))
+        await asyncio.sleep(0.1)
+        system.osc_queue.put(system.osc_router.parse('/lectern/stop'))
+        await asyncio.sleep(6)
+        return calls, len(system.osc_queue.queue)
+
+    calls, depth = run(body)
+    assert calls == ['started']
+    assert depth == 0
+
+
+def test_stop_leaves_a_clear_fault_waiting_for_the_lectern_to_finish():
+    async def body(system):
+        system.lectern.motor.trip()
+        system.tcp_queue.put(system.tcp_router.parse('/lectern/clear_fault'))
+        await asyncio.sleep(0.1) # Waiting in stop_for_maintenance
+        system.tcp_queue.put(system.tcp_router.parse('/lectern/stop'))
+        await asyncio.sleep(1)
+        return system.e_stop.fault
+
+    assert not run(body)
+
+
+def test_e_stop_trip_leaves_the_other_commands_alone():
+    async def body(system):
+        calls = []
+        async def slow_home():
+            await asyncio.sleep(0.5)
+            calls.append('homed')
+        system.tcp_router.routes[('lectern', 'home')].handler = slow_home
+        subscribe = system.tcp_router.parse('/subscribe/9100')
+        subscribe.source = ('10.0.0.2', 50000)
+        system.tcp_queue.put(system.tcp_router.parse('/lectern/home'))
+        system.tcp_queue.put(subscribe)
+        await asyncio.sleep(0.1)
+        system.handle_e_stop_trip('test')
+        await asyncio.sleep(1)
+        return calls, ('10.0.0.2', 9100) in system.subscribers.subscribers
+
+    calls, subscribed = run(body)
+    assert calls == []
+    assert subscribed
+
+
+def test_a_fault_is_only_cleared_over_tcp():
+    async def body(system):
+        system.lectern.motor.trip()
+        with pytest.raises(CommandError):
+            system.osc_router.parse('/lectern/clear_fault')
+        system.tcp_queue.put(system.tcp_router.parse('/lectern/clear_fault'))
+        await asyncio.sleep(1)
+        return system.e_stop.fault
+
+    assert not run(body)
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import pytest
+import clock
+import hardware
+import simulate
+import telemetry_decoder
+from system import System, SystemConfig
+from telemetry import TelemetryEncoder
+from telemetry_decoder import DELTA_FRAME, FIELD_NAMES, HEADER, MASK_BYTES, MAX_STRING, TelemetryDecoder, TelemetryError
+
+FRAMES = 60
+EMIT_INTERVAL = 0.075 # s
+
+
+def run(body):
+    '''
+    Run body(system) on a System driving the simulated lectern, on virtual time, after the start up jog.
+    '''
+    async def main():
+        lectern, backend = simulate.make_lectern()
+        system = System(SystemConfig(lectern=lectern, ip='127.0.0.1', osc_port=0, udp_port=0, tcp_port=0, emit_tick_speed=EMIT_INTERVAL * 1000))
+        await lectern.start()
+        await asyncio.sleep(3)
+        try:
+            return await body(system)
+        finally:
+            await lectern.cleanup()
+    try:
+        return clock.run(main(), virtual=True)
+    finally:
+        hardware.set_backend(None)
+
+
+def same(a: dict, b: dict) -> bool:
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True) # NaN equals NaN
+
+
+def assert_matches(decoded, state, path: str = ''):
+    '''
+    The JSON state rounds its numbers and the frame carries float32, so numbers only have to be close.
+    '''
+    if isinstance(state, dict):
+        assert isinstance(decoded, dict), path
+        assert set(state) <= set(decoded), path
+        for key, value in state.items():
+            assert_matches(decoded[key], value, f'{path}.{key}')
+    elif isinstance(state, float):
+        assert decoded == pytest.approx(state, abs=0.006), path
+    else:
+        assert decoded == state, path
+
+
+def test_full_frame_decodes_to_the_json_state():
+    async def body(system):
+        system.lectern.go_to(16)
+        await asyncio.sleep(1)
+        for path in ('/lectern/bump/1', '/teleprompter/next'):
+            system.osc_queue.queue.append(system.osc_router.parse(path))
+        state = json.loads(json.dumps(system.state()))
+        return state, telemetry_decoder.decode(bytes(TelemetryEncoder().encode(system)))
+
+    state, decoded = run(body)
+    assert state['setpoint'] is not None # Moving
+    assert state['backlog'] == ['/lectern/bump/1', '/teleprompter/next']
+    assert set(decoded) - set(state) == {'seq', 'timestamp'}
+    assert_matches(decoded, state)
+
+
+def test_frames_are_numbered():
+    async def body(system):
+        encoder = TelemetryEncoder()
+        decoder = TelemetryDecoder()
+        frames = []
+        for _ in range(3):
+            frames.append(decoder.decode(bytes(encoder.encode(system))))
+            await asyncio.sleep(EMIT_INTERVAL)
+        return frames
+
+    frames = run(body)
+    assert [frame['seq'] for frame in frames] == [frames[0]['seq'] + i for i in range(3)]
+    assert frames[1]['timestamp'] - frames[0]['timestamp'] == pytest.approx(EMIT_INTERVAL)
+
+
+def test_long_commands_are_cut():
+    async def body(system):
+        system.osc_queue.queue.append(system.osc_router.parse('/teleprompter/' + 'x' * 300))
+        return telemetry_decoder.decode(bytes(TelemetryEncoder().encode(system)))
+
+    [command] = run(body)['backlog']
+    assert len(command) == MAX_STRING
+
+
+def test_bad_frames_are_rejected():
+    async def body(system):
+        return bytes(TelemetryEncoder().encode(system))
+
+    frame = run(body)
+    for bad in (frame[:HEADER.size - 1], frame[:HEADER.size + 8], b'XX' + frame[2:], frame[:2] + b'\x63' + frame[3:]):
+        with pytest.raises(TelemetryError):
+            telemetry_decoder.decode(bad)
+
+
+def test_delta_stream_decodes_to_the_full_frames():
+    async def body(system):
+        full = TelemetryEncoder(keyframe_interval=1)
+        deltas = TelemetryEncoder()
+        decoder = TelemetryDecoder()
+        sizes = []
+        lectern = system.lectern
+        for _ in range(FRAMES):
+            if lectern.profile is None:
+                lectern.go_to(18 if lectern.estimate['position'] < 12 else 7)
+            expected = telemetry_decoder.decode(bytes(full.encode(system)))
+            frame = bytes(deltas.encode(system))
+            assert same(decoder.decode(frame), expected)
+            if frame[3] == DELTA_FRAME:
+                sizes.append((len(frame), HEADER.size + telemetry_decoder.BODY.size))
+            await asyncio.sleep(EMIT_INTERVAL)
+        return expected, sizes
+
+    state, sizes = run(body)
+    assert state['setpoint'] is not None # It was moving
+    assert len(sizes) > FRAMES // 2
+    assert all(size < full for size, full in sizes)
+
+
+def test_lost_frame_waits_for_a_keyframe():
+    async def body(system):
+        encoder = TelemetryEncoder()
+        decoder = TelemetryDecoder()
+        assert decoder.decode(bytes(encoder.encode(system))) is not None
+        encoder.encode(system) # Lost
+        lost = decoder.decode(bytes(encoder.encode(system)))
+        need_keyframe = decoder.need_keyframe
+        encoder.request_keyframe()
+        recovered = decoder.decode(bytes(encoder.encode(system)))
+        return lost, need_keyframe, recovered, telemetry_decoder.decode(bytes(TelemetryEncoder(1).encode(system)))
+
+    lost, need_keyframe, recovered, expected = run(body)
+    assert lost is None
+    assert need_keyframe
+    expected['seq'] = recovered['seq']
+    assert same(recovered, expected)
+
+
+def test_deltas_carry_the_fields_whose_float32_value_changed():
+    async def body(system):
+        encoder = TelemetryEncoder()
+        values = list(encoder.values(system))
+        encoder.values = lambda system: tuple(values)
+        position = FIELD_NAMES.index('sensors.position')
+        values[position] = 10.0
+        encoder.encode(system) # Keyframe
+        masks = []
+        for change in (0.0, 1e-12, 0.5): # 1e-12 is lost in float32, 0.5 is not
+            values[position] = 10.0 + change
+            frame = encoder.encode(system)
+            masks.append(int.from_bytes(frame[HEADER.size:HEADER.size + MASK_BYTES], 'little'))
+        return masks, position
+
+    masks, position = run(body)
+    assert masks == [0, 0, 1 << position]
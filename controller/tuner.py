@@ -0,0 +1,254 @@
+'''
+fileoverview: Offline PID auto-tuning. Candidate gain sets are run through the simulator (simulate.run_scenario on
+virtual time) across a process pool, scored on settle time, overshoot and steady state error, and the best set is
+written as a gains profile that the lectern loads on start (PID.GAINS_FILE unless LecternConfig.gains_file says
+otherwise).
+
+The simulated actuator can first be fitted to position traces recorded on the real lectern, so the gains are tuned
+against how it actually responds:
+
+    python3 tuner.py                                       # tune against the default simulator plant
+    python3 tuner.py --trace up_down.csv --trace jog.csv   # fit the plant to recorded traces, then tune
+    python3 tuner.py --candidates 128 --workers 8 --output gains.json
+
+A trace is a CSV file with a header row and the columns time (s), speed (motor command, -1 to 1) and position (in).
+'''
+
+import argparse
+import contextlib
+import io
+import math
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import TypedDict
+import numpy as np
+import clock
+import simulate
+from simulator import SimConfig, DEFAULT_SIM_CONFIG
+from PID import Gains, DEFAULT_GAINS, GAINS_FILE, save_gains
+
+# Moves every candidate is scored on, long moves both ways plus short bumps where overshoot shows most
+TARGETS = [15, 8, 8.6, 12.5, 18, 17.3, 10]
+
+# Score weights, in seconds of settle time per inch
+OVERSHOOT_WEIGHT = 10
+ERROR_WEIGHT = 20
+FAILED_MOVE_PENALTY = simulate.MOVE_TIMEOUT
+
+# Candidate ranges (log uniform)
+KP_RANGE = (0.5, 8)
+KI_RANGE = (0.05, 4)
+KD_RANGE = (0.005, 0.5)
+
+# Plant parameters searched when fitting traces: (low, high) of the first grid
+FIT_RANGES = {
+    'max_velocity': (1, 5), # in/s
+    'down_scale': (0.7, 1.5),
+    'time_constant': (0.01, 0.4), # s
+    'deadband': (0, 40), # us
+}
+FIT_GRID = 8 # Points per parameter per pass
+FIT_PASSES = 4 # Each pass narrows the grid around the best point
+
+
+class PlantFit(TypedDict):
+    max_velocity: float
+    down_scale: float
+    time_constant: float
+    deadband: float
+    rms: float # Position error of the fitted model over the traces (in)
+
+
+class Score(TypedDict):
+    gains: Gains
+    score: float
+    settle_time: float # s, mean over the moves
+    overshoot: float # in, mean
+    error: float # in, mean absolute steady state error
+    failed: int # Moves that did not reach their target
+
+
+def load_trace(path: str) -> np.ndarray:
+    '''
+    :return: Array of rows (time, speed, position)
+    '''
+    data = np.genfromtxt(path, delimiter=',', names=True)
+    return np.column_stack((data['time'], data['speed'], data['position']))
+
+
+def simulate_trace(trace: np.ndarray, params: dict[str, np.ndarray], config: SimConfig) -> np.ndarray:
+    '''
+    Replay the recorded motor commands through the actuator model of the simulator for many parameter sets at once.
+
+    :param params: Plant parameters, one array entry per parameter set
+    :return: Modelled positions, one row per parameter set
+    '''
+    max_velocity = params['max_velocity']
+    down_scale = params['down_scale']
+    tau = params['time_constant']
+    deadband = params['deadband']
+    up_span = config['max'] - config['zero'] - deadband
+    down_span = config['zero'] - config['min'] - deadband
+
+    positions = np.empty((len(max_velocity), len(trace)))
+    position = np.full(len(max_velocity), trace[0, 2])
+    velocity = np.zeros(len(max_velocity))
+    positions[:, 0] = position
+    for i in range(1, len(trace)):
+        dt = trace[i, 0] - trace[i - 1, 0]
+        speed = trace[i - 1, 1] # The command held over the interval
+        offset = (config['max'] - config['zero']) * speed if speed >= 0 else (config['zero'] - config['min']) * speed
+        if config['invert']:
+            offset = -offset
+        if offset > 0:
+            target = np.maximum(offset - deadband, 0) / up_span
+        else:
+            target = np.minimum(offset + deadband, 0) / down_span * down_scale
+        if config['invert']:
+            target = -target
+        target = np.clip(target, -1.5, 1.5) * max_velocity
+        decay = np.exp(-dt / tau)
+        # Same exact first order integration as LecternPhysics.step
+        position = position + target * dt + (velocity - target) * tau * (1 - decay)
+        velocity = target + (velocity - target) * decay
+        positions[:, i] = position
+    return positions
+
+
+def fit_plant(traces: list[np.ndarray], config: SimConfig = DEFAULT_SIM_CONFIG) -> PlantFit:
+    '''
+    Fit the simulator's actuator parameters to recorded traces by least squares over a grid that is narrowed around
+    the best point on every pass.
+    '''
+    ranges = dict(FIT_RANGES)
+    best = None
+    for _ in range(FIT_PASSES):
+        axes = [np.linspace(low, high, FIT_GRID) for low, high in ranges.values()]
+        grid = np.meshgrid(*axes, indexing='ij')
+        params = {name: axis.ravel() for name, axis in zip(ranges, grid)}
+        cost = np.zeros(len(params['max_velocity']))
+        samples = 0
+        for trace in traces:
+            cost += ((simulate_trace(trace, params, config) - trace[:, 2]) ** 2).sum(axis=1)
+            samples += len(trace)
+        i = int(np.argmin(cost))
+        best = {name: float(values[i]) for name, values in params.items()}
+        best['rms'] = math.sqrt(cost[i] / samples)
+        # Next pass: two grid steps either side of the best point
+        ranges = {}
+        for name, axis in zip(best, axes):
+            step = axis[1] - axis[0]
+            low = max(best[name] - 2 * step, FIT_RANGES[name][0] if name == 'deadband' else 1e-3)
+            ranges[name] = (low, best[name] + 2 * step)
+    return PlantFit(**best)
+
+
+def score_moves(gains: Gains, moves: list[simulate.MoveResult], expected: int) -> Score:
+    failed = expected - sum(1 for move in moves if move['reached'])
+    if not moves:
+        return Score(gains=gains, score=math.inf, settle_time=math.inf, overshoot=math.inf, error=math.inf, failed=failed)
+    settle_time = sum(move['settle_time'] for move in moves) / len(moves)
+    overshoot = sum(move['overshoot'] for move in moves) / len(moves)
+    error = sum(abs(move['error']) for move in moves) / len(moves)
+    score = settle_time + OVERSHOOT_WEIGHT * overshoot + ERROR_WEIGHT * error + FAILED_MOVE_PENALTY * failed
+    return Score(gains=gains, score=score, settle_time=settle_time, overshoot=overshoot, error=error, failed=failed)
+
+
+def evaluate(gains: Gains, sim_config: SimConfig, targets: list[float]) -> Score:
+    '''
+    Run one gain set through the simulator. Runs in a worker process, each with its own virtual clock and backend.
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = clock.run(simulate.run_scenario(targets, sim_config, gains), virtual=True)
+    return score_moves(gains, result['moves'], len(targets))
+
+
+def log_uniform(rng: random.Random, low: float, high: float) -> float:
+    return math.exp(rng.uniform(math.log(low), math.log(high)))
+
+
+def random_gains(rng: random.Random) -> Gains:
+    return Gains(
+        kp=round(log_uniform(rng, *KP_RANGE), 3),
+        ki=round(log_uniform(rng, *KI_RANGE), 3),
+        kd=round(log_uniform(rng, *KD_RANGE), 4),
+    )
+
+
+def perturb(rng: random.Random, gains: Gains, spread: float) -> Gains:
+    return Gains(
+        kp=round(gains['kp'] * math.exp(rng.uniform(-spread, spread)), 3),
+        ki=round(gains['ki'] * math.exp(rng.uniform(-spread, spread)), 3),
+        kd=round(gains['kd'] * math.exp(rng.uniform(-spread, spread)), 4),
+    )
+
+
+def tune(sim_config: SimConfig, candidates: int, rounds: int, workers: int, seed: int = 0, start: Gains = DEFAULT_GAINS) -> list[Score]:
+    '''
+    First round: start plus random candidates over the whole range. Each later round samples around the best few
+    so far with a narrowing spread.
+
+    :return: Every score, best first
+    '''
+    rng = random.Random(seed)
+    scores: list[Score] = []
+    batch = [Gains(start)] + [random_gains(rng) for _ in range(candidates - 1)]
+    spread = 0.5
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for round_ in range(rounds):
+            wall = time.perf_counter()
+            scores.extend(pool.map(evaluate, batch, repeat(sim_config), repeat(TARGETS)))
+            scores.sort(key=lambda s: s['score'])
+            best = scores[0]
+            print(f"Round {round_ + 1}/{rounds}: {len(batch)} candidates in {time.perf_counter() - wall:.1f}s, best {best['gains']} score {best['score']:.3f}")
+            parents = [s['gains'] for s in scores[:max(candidates // 8, 1)]]
+            batch = [perturb(rng, parents[i % len(parents)], spread) for i in range(candidates)]
+            spread /= 2
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", action="append", default=[], help="Recorded trace CSV to fit the plant to (repeatable)")
+    parser.add_argument("--candidates", type=int, default=48, help="Gain sets per round")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=GAINS_FILE, help="Where to write the gains profile")
+    args = parser.parse_args()
+
+    sim_config = SimConfig(seed=args.seed)
+    plant = None
+    if args.trace:
+        wall = time.perf_counter()
+        plant = fit_plant([load_trace(path) for path in args.trace])
+        print(f"Fitted plant to {len(args.trace)} trace(s) in {time.perf_counter() - wall:.1f}s: {plant}")
+        sim_config.update({name: value for name, value in plant.items() if name != 'rms'})
+
+    wall = time.perf_counter()
+    scores = tune(sim_config, args.candidates, args.rounds, args.workers, args.seed)
+    wall = time.perf_counter() - wall
+
+    print(f"{'kp':>7} {'ki':>7} {'kd':>7} {'score':>7} {'settle':>7} {'overshoot':>9} {'error':>7} failed")
+    for s in scores[:5]:
+        g = s['gains']
+        print(f"{g['kp']:7.3f} {g['ki']:7.3f} {g['kd']:7.4f} {s['score']:7.3f} {s['settle_time']:6.2f}s {s['overshoot']:8.3f}in {s['error']:6.3f}in {s['failed']}")
+    baseline = next(s for s in scores if s['gains'] == DEFAULT_GAINS)
+    print(f"Default gains {DEFAULT_GAINS} scored {baseline['score']:.3f}")
+    print(f"Evaluated {len(scores)} candidates in {wall:.0f}s")
+
+    best = scores[0]
+    save_gains(
+        best['gains'], args.output,
+        score={key: value for key, value in best.items() if key != 'gains'},
+        plant=plant,
+        tuned=time.strftime('%Y-%m-%d %H:%M:%S'),
+    )
+    print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()